@@ -0,0 +1,337 @@
+"""Load test of the web service.
+
+The real application created by :func:`ceiba.app.create_app` is served on a local port,
+using a stand-in of GitHub's API to authenticate the workers and either a local
+``mongod`` or an in-memory stand-in of MongoDB (which requires ``mongomock``).
+A number of concurrent clients send a mix of the requests done by the workers and the dashboards:
+
+* ``reserve``: reserve a few available jobs,
+* ``report``: report the results of the reserved jobs,
+* ``merge``: report again the results of some finished jobs using the MERGE policy,
+* ``dashboard``: query the collections, the finished jobs and the properties.
+
+The throughput, the latency percentiles and the MongoDB operations per request are printed as JSON.
+The report can be stored as a baseline, and later runs fail if they regress with respect to it::
+
+  python -m benchmarks.load_test --mongo_url localhost --save_baseline baseline.json
+  python -m benchmarks.load_test --mongo_url localhost --baseline baseline.json --tolerance 0.2
+
+"""
+
+import argparse
+import asyncio
+import inspect
+import json
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Any, DefaultDict, Deque, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+from pymongo import MongoClient
+from pymongo.database import Database
+
+from ceiba.app import create_app, create_context, read_cli_args
+from ceiba.profiling import PROFILE_HEADER
+from ceiba.user_authentication import GitHubClient
+
+BENCHMARK_DATABASE = "ceiba_benchmark"
+COLLECTION = "benchmark_data"
+WORKER = "benchmark-worker"
+
+#: Number of jobs reserved or reported by each request
+BATCH_SIZE = 5
+
+DEFAULT_MIX = "reserve=4,report=4,merge=1,dashboard=1"
+
+#: Operations of :class:`Workload` that can be part of the mix
+OPERATIONS = {"reserve", "report", "merge", "dashboard"}
+
+AUTHENTICATE = 'mutation { authenticateUser(token: "benchmark") { status text } }'
+
+CREATE_JOBS = """
+mutation CreateJobs($cookie: String!, $input: [InputJob!]!) {
+  createJobs(cookie: $cookie, input: $input) { status created }
+}"""
+
+RESERVE_JOBS = """
+mutation ReserveJobs($cookie: String!, $collection_name: String!, $max_jobs: Int!, $worker: String!) {
+  reserveJobs(cookie: $cookie, collection_name: $collection_name, max_jobs: $max_jobs, worker: $worker) {
+    status
+    jobs { _id property { _id metadata } }
+  }
+}"""
+
+REPORT_JOBS = """
+mutation ReportJobs($cookie: String!, $input: [InputJob!]!, $policy: DuplicationPolicy) {
+  reportJobs(cookie: $cookie, input: $input, duplication_policy: $policy) { status created duplicates }
+}"""
+
+DASHBOARD = """
+query Dashboard($collection_name: String!) {
+  collections { name size jobs { status count } }
+  jobs(status: DONE, collection_name: $collection_name, max_jobs: 100) { _id status }
+  properties(collection_name: $collection_name, first: 100) { _id data }
+}"""
+
+
+class GraphQLClient:
+    """Send GraphQL requests to the service, returning the data and the MongoDB operations."""
+
+    def __init__(self, session: aiohttp.ClientSession, url: str) -> None:
+        self.session = session
+        self.url = url
+        self.cookie = ""
+
+    async def execute(self, query: str, variables: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], int]:
+        body = {"query": query, "variables": {"cookie": self.cookie, **(variables or {})}}
+        async with self.session.post(self.url, json=body, headers={PROFILE_HEADER: "1"}) as response:
+            reply = await response.json()
+        if reply.get("errors"):
+            raise RuntimeError(reply["errors"])
+        mongo = reply["extensions"]["profile"]["sections"].get("mongo", {}).get("calls", 0)
+        return reply["data"], mongo
+
+
+class Workload:
+    """Jobs reserved and finished during the load test."""
+
+    def __init__(self, client: GraphQLClient, rng: random.Random) -> None:
+        self.client = client
+        self.rng = rng
+        self.reserved: Deque[Dict[str, Any]] = deque()
+        self.done: List[Dict[str, Any]] = []
+
+    def job_input(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        data = {"gap": self.rng.uniform(0, 5), "homo": self.rng.uniform(-10, 0), "lumo": self.rng.uniform(-5, 5)}
+        prop = {"_id": job["property"]["_id"], "collection_name": COLLECTION,
+                "metadata": job["property"]["metadata"], "data": json.dumps(data)}
+        return {"_id": job["_id"], "status": "DONE", "property": prop, "user": WORKER,
+                "report_time": time.time(), "platform": "benchmark"}
+
+    async def reserve(self) -> int:
+        variables = {"collection_name": COLLECTION, "max_jobs": BATCH_SIZE, "worker": WORKER}
+        data, mongo = await self.client.execute(RESERVE_JOBS, variables)
+        self.reserved.extend(data["reserveJobs"]["jobs"] or [])
+        return mongo
+
+    async def report(self) -> int:
+        jobs = [self.reserved.popleft() for _ in range(min(BATCH_SIZE, len(self.reserved)))]
+        if not jobs:
+            return await self.reserve()
+        variables = {"input": [self.job_input(job) for job in jobs], "policy": "KEEP"}
+        _, mongo = await self.client.execute(REPORT_JOBS, variables)
+        self.done.extend(jobs)
+        return mongo
+
+    async def merge(self) -> int:
+        if not self.done:
+            return await self.reserve()
+        jobs = self.rng.sample(self.done, min(BATCH_SIZE, len(self.done)))
+        variables = {"input": [self.job_input(job) for job in jobs], "policy": "MERGE"}
+        _, mongo = await self.client.execute(REPORT_JOBS, variables)
+        return mongo
+
+    async def dashboard(self) -> int:
+        _, mongo = await self.client.execute(DASHBOARD, {"collection_name": COLLECTION})
+        return mongo
+
+
+async def create_jobs(client: GraphQLClient, number: int, batch_size: int = 500) -> None:
+    """Store ``number`` available jobs in the benchmark collection."""
+    for start in range(0, number, batch_size):
+        jobs = [{"_id": index, "status": "AVAILABLE", "settings": "{}", "property": {
+            "_id": index, "collection_name": COLLECTION, "metadata": f"molecule-{index}"}}
+            for index in range(start, min(start + batch_size, number))]
+        await client.execute(CREATE_JOBS, {"input": jobs})
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """Read the weights of the operations, like ``reserve=4,report=4,merge=1,dashboard=1``."""
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in OPERATIONS:
+            raise ValueError(f"Unknown operation: {name}")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Return the value at ``fraction`` of the sorted ``values``."""
+    ordered = sorted(values)
+    return ordered[round(fraction * (len(ordered) - 1))] if ordered else 0.0
+
+
+async def drive(
+        workload: Workload, weights: Dict[str, float], requests: int, concurrency: int) -> Dict[str, Any]:
+    """Send ``requests`` operations chosen using ``weights`` from ``concurrency`` concurrent clients."""
+    latencies: DefaultDict[str, List[float]] = defaultdict(list)
+    mongo_ops: DefaultDict[str, int] = defaultdict(int)
+    errors: List[str] = []
+    names, values = list(weights), list(weights.values())
+    remaining = requests
+
+    async def client() -> None:
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            name = workload.rng.choices(names, values)[0]
+            start = time.perf_counter()
+            try:
+                calls = await getattr(workload, name)()
+            except Exception as ex:  # Report the failure and keep the load
+                errors.append(f"{name}: {ex}")
+                continue
+            latencies[name].append(time.perf_counter() - start)
+            mongo_ops[name] += calls
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    duration = time.perf_counter() - start
+
+    every = [value for values in latencies.values() for value in values]
+    return {
+        "requests": len(every),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "duration": duration,
+        "throughput": len(every) / duration,
+        "p50": percentile(every, 0.5),
+        "p99": percentile(every, 0.99),
+        "mongo_ops_per_request": sum(mongo_ops.values()) / max(1, len(every)),
+        "operations": {name: {
+            "requests": len(values),
+            "p50": percentile(values, 0.5),
+            "p99": percentile(values, 0.99),
+            "mongo_ops_per_request": mongo_ops[name] / max(1, len(values))}
+            for name, values in sorted(latencies.items())}}
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Return the regressions of ``report`` with respect to ``baseline``."""
+    regressions = []
+    if report["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(f"throughput {report['throughput']:.1f} < {baseline['throughput']:.1f} req/s")
+    if report["errors"] > baseline["errors"]:
+        regressions.append(f"errors {report['errors']} > {baseline['errors']}")
+    for name, old in baseline["operations"].items():
+        new = report["operations"].get(name)
+        if new is None:
+            continue
+        for key in ("p50", "p99", "mongo_ops_per_request"):
+            if new[key] > old[key] * (1 + tolerance):
+                regressions.append(f"{name} {key} {new[key]:.4g} > {old[key]:.4g}")
+    return regressions
+
+
+def patch_mongomock(mongomock: Any) -> None:
+    """Accept the ``sort`` option that recent versions of pymongo pass to the bulk updates."""
+    builder = mongomock.collection.BulkOperationBuilder
+    if "sort" in inspect.signature(builder.add_update).parameters:
+        return
+    add_update = builder.add_update
+
+    def add_update_without_sort(self: Any, *args: Any, sort: Any = None, **kwargs: Any) -> Any:
+        return add_update(self, *args, **kwargs)
+
+    builder.add_update = add_update_without_sort
+
+
+def connect(mongo_url: Optional[str]) -> Database:
+    """Return an empty benchmark database, in memory if there is no ``mongo_url``."""
+    if mongo_url is None:
+        try:
+            import mongomock
+        except ImportError:
+            raise RuntimeError("The in-memory database requires mongomock: pip install mongomock")
+        patch_mongomock(mongomock)
+        client: Any = mongomock.MongoClient()
+    else:
+        client = MongoClient(mongo_url)
+    client.drop_database(BENCHMARK_DATABASE)
+    return client[BENCHMARK_DATABASE]
+
+
+async def github_stand_in() -> web.AppRunner:
+    """Serve a replacement of GitHub's API that knows a single user."""
+    async def viewer(request: web.Request) -> web.Response:
+        return web.json_response({"data": {"viewer": {"login": WORKER}}})
+
+    app = web.Application()
+    app.router.add_post("/graphql", viewer)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner
+
+
+def address(runner: web.AppRunner) -> str:
+    host, port = runner.addresses[0][:2]
+    return f"http://{host}:{port}"
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    """Serve the application and drive the load described by ``args``."""
+    github = await github_stand_in()
+    with tempfile.TemporaryDirectory() as workdir:
+        users = Path(workdir) / "users.txt"
+        users.write_text(f"{WORKER}\n")
+        service_args = read_cli_args(["-f", users.as_posix(), "-s", "benchmark", "--slow_threshold", "inf"])
+        if args.mongo_url is None:
+            # mongomock is not thread safe
+            service_args.mongo_threads = 1
+        context = create_context(service_args, connect(args.mongo_url))
+        context["github"] = GitHubClient(f"{address(github)}/graphql")
+        runner = web.AppRunner(create_app(service_args, context), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        try:
+            async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+                client = GraphQLClient(session, f"{address(runner)}/graphql")
+                data, _ = await client.execute(AUTHENTICATE)
+                client.cookie = data["authenticateUser"]["text"]
+                await create_jobs(client, args.jobs)
+                workload = Workload(client, random.Random(args.seed))
+                return await drive(workload, parse_mix(args.mix), args.requests, args.concurrency)
+        finally:
+            await runner.cleanup()
+            await github.cleanup()
+
+
+def read_cli_args_benchmark(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Read the command line arguments."""
+    parser = argparse.ArgumentParser("load_test")
+    parser.add_argument('-m', '--mongo_url', default=None, help="mongo URL (default: in-memory database)")
+    parser.add_argument("--requests", type=int, default=2000, help="number of requests to send")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of concurrent clients")
+    parser.add_argument("--jobs", type=int, default=5000, help="number of jobs available at the start")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="relative weight of each operation")
+    parser.add_argument("--seed", type=int, default=42, help="seed to choose the operations")
+    parser.add_argument("--baseline", type=Path, default=None, help="fail on regressions against this report")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--save_baseline", type=Path, default=None, help="store the report as a baseline")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run the load test and return 1 if there are regressions."""
+    args = read_cli_args_benchmark(argv)
+    report = asyncio.run(run_benchmark(args))
+    print(json.dumps(report, indent=2))
+    if args.save_baseline is not None:
+        args.save_baseline.write_text(json.dumps(report, indent=2))
+    if args.baseline is not None:
+        regressions = compare(report, json.loads(args.baseline.read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return int(bool(regressions))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
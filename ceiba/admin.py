@@ -0,0 +1,59 @@
+"""Administration commands.
+
+.. autofunction:: main
+
+"""
+
+import argparse
+import logging
+from typing import List, Optional
+
+from .indexes import deduplicate_jobs
+from .mongo_interface import DATABASE_NAME, DatabaseConfig, connect_to_db
+from .registry import rebuild_registry
+from .user_authentication import restore_user, revoke_user
+
+__all__ = ["main"]
+
+logger = logging.getLogger(__name__)
+
+
+def read_cli_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Read the command line arguments."""
+    parser = argparse.ArgumentParser("ceiba-admin")
+    parser.add_argument(
+        "command", choices=["rebuild-registry", "deduplicate-jobs", "revoke-user", "restore-user"],
+        help="rebuild-registry: count again the properties and jobs of all the collections, "
+        "deduplicate-jobs: keep a single job per property and rebuild the registry, "
+        "revoke-user: reject the session tokens of a user, "
+        "restore-user: accept again the session tokens of a revoked user")
+    parser.add_argument('user', nargs='?', default=None, help="GitHub username to revoke or restore")
+    parser.add_argument('-m', '--mongo_url', default="localhost")
+    parser.add_argument('-u', '--username', default=None, help="mongo username")
+    parser.add_argument('-p', '--password', default=None, help="mongo password")
+    args = parser.parse_args(argv)
+    if args.command in {"revoke-user", "restore-user"} and args.user is None:
+        parser.error(f"{args.command} requires a username")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Entry point of the administration commands."""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s  %(message)s', datefmt='[%I:%M:%S]')
+    args = read_cli_args(argv)
+    db_info = DatabaseConfig(
+        DATABASE_NAME, host=args.mongo_url, username=args.username, password=args.password)
+    database = connect_to_db(db_info)
+    if args.command == "rebuild-registry":
+        rebuild_registry(database)
+        logger.info("The collections registry has been rebuilt")
+    elif args.command == "deduplicate-jobs":
+        removed = deduplicate_jobs(database)
+        rebuild_registry(database)
+        logger.info(f"Removed {removed} duplicated jobs and rebuilt the collections registry")
+    elif args.command == "revoke-user":
+        revoke_user(database, args.user)
+        logger.info(f"The session tokens of {args.user} are rejected from now on")
+    elif args.command == "restore-user":
+        restore_user(database, args.user)
+        logger.info(f"The session tokens of {args.user} are accepted again")
@@ -1,41 +1,125 @@
 """Main loop event.
 
 .. autofunction:: run
+.. autofunction:: create_app
 
 """
 
 import argparse
+import asyncio
 import logging
+import os
+import secrets
+import socket
+import tempfile
+import tracemalloc
+from functools import lru_cache, partial
+from multiprocessing.connection import Connection
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Union
 
 import pkg_resources as pkg
 from aiohttp import web
+from pymongo import monitoring
+from pymongo.database import Database
 from tartiflette_aiohttp import register_graphql_handlers
-from .mongo_interface import DatabaseConfig, add_users_to_db, connect_to_db
+from .compression import DEFAULT_COMPRESSION_THRESHOLD, DEFAULT_MAX_SIZE, compression_middleware
+from .indexes import IndexManager
+from .large_objects import LargeObjectStore, register_large_object_handlers
+from .metrics import (MongoMetricsListener, SharedMetrics, TimedEngine, measure_event_loop_lag,
+                      metrics_handler, metrics_middleware)
+from .mongo_interface import (DATABASE_NAME, DEFAULT_MONGO_THREADS, AsyncDatabase,
+                              DatabaseConfig, PropertyStorage, add_users_to_db,
+                              connect_to_db)
+from .notifications import JobsNotifier
+from .persisted_queries import DEFAULT_PERSISTED_QUERIES, PersistedQueries, persisted_queries_middleware
+from .profiling import (DEFAULT_SLOW_THRESHOLD, ProfilingSettings, profiled, profiled_response,
+                        profiling_middleware)
+from .registry import ensure_registry
+from .user_authentication import TOKEN_LIFETIME, GitHubClient, TokenAuthority
+from .workers import Supervisor, bind_socket
 
 from .__version__ import __version__
 
-__all__ = ["run"]
+__all__ = ["create_app", "run"]
 
 PATH_LIB = Path(pkg.resource_filename('ceiba', ''))
+
+READ_PREFERENCES = ["primary", "primaryPreferred", "secondary", "secondaryPreferred", "nearest"]
+
+#: Number of parsed and validated GraphQL documents kept in memory
+DEFAULT_QUERY_CACHE_SIZE = 512
 logger = logging.getLogger(__name__)
 
 
-def create_context(args: argparse.Namespace) -> Dict[str, Any]:
-    """Create context to run the app."""
+def create_context(
+        args: argparse.Namespace, database: Optional[Database] = None,
+        relay: Optional[Connection] = None) -> Dict[str, Any]:
+    """Create context to run the app, connecting to the database in ``args`` unless one is given.
+
+    The jobs published by the mutations are sent through ``relay`` to the other workers, if any.
+    """
     # Create Database
-    db_info = DatabaseConfig(
-        "properties", host=args.mongo_url, username=args.username, password=args.password)
+    if database is None:
+        database = connect_to_db(DatabaseConfig(
+            DATABASE_NAME, host=args.mongo_url, username=args.username, password=args.password,
+            max_pool_size=args.mongo_pool_size, min_pool_size=args.mongo_min_pool_size,
+            server_selection_timeout=args.mongo_server_selection_timeout,
+            connect_timeout=args.mongo_connect_timeout, socket_timeout=args.mongo_socket_timeout,
+            compressors=args.mongo_compressors, write_concern=args.write_concern))
     # Add Allow users
-    database = connect_to_db(db_info)
     add_users_to_db(database, args.file)
+    ensure_registry(database)
+    mongodb = AsyncDatabase(database, args.mongo_threads, read_preference=args.read_preference)
     context = {
-        "mongodb": connect_to_db(db_info)
+        "mongodb": mongodb,
+        "indexes": IndexManager(mongodb),
+        "storage": PropertyStorage(native_data=args.native_data, max_history=args.max_history),
+        "tokens": TokenAuthority(read_secret(args.secret), args.token_lifetime),
+        "github": GitHubClient(),
+        "notifier": JobsNotifier(relay)
     }
     return context
 
 
+def query_cache(size: int) -> Callable[[Callable], Callable]:
+    """Cache the ``size`` latest parsed and validated queries, measuring the time to get them."""
+    def decorator(parse_and_validate: Callable) -> Callable:
+        return profiled("parse")(lru_cache(maxsize=size)(parse_and_validate))
+    return decorator
+
+
+def read_secret(secret: Optional[str] = None) -> bytes:
+    """Return the key to sign the session tokens.
+
+    If no secret is provided, a random one is generated and the tokens
+    are invalidated when the server restarts.
+    """
+    if secret is None:
+        logger.warning("No secret provided, the session tokens won't survive a server restart\n")
+        return secrets.token_bytes(32)
+
+    return secret.encode()
+
+
+async def background_tasks(
+        context: Dict[str, Any], shared_metrics: Optional[SharedMetrics],
+        app: web.Application) -> AsyncIterator[None]:
+    """Run the tasks and open the sessions that live as long as the application."""
+    await context["indexes"].provision()
+    await context["github"].start()
+    context["notifier"].start()
+    tasks = [asyncio.create_task(context["tokens"].refresh_periodically(context["mongodb"])),
+             asyncio.create_task(measure_event_loop_lag())]
+    if shared_metrics is not None:
+        tasks.append(asyncio.create_task(shared_metrics.share_periodically()))
+    yield
+    for task in tasks:
+        task.cancel()
+    context["notifier"].stop()
+    await context["github"].close()
+
+
 def configure_logger(workdir: Path, package_name: str) -> None:
     """Set the logging infrasctucture."""
     file_log = workdir / 'server.log'
@@ -62,32 +146,170 @@ def exists(input_file: str) -> Path:
     return path
 
 
-def read_cli_args() -> argparse.Namespace:
+def write_concern(value: str) -> Union[int, str]:
+    """Read the number of nodes acknowledging the writes, or a tag like ``majority``."""
+    return int(value) if value.isdigit() else value
+
+
+def positive_int(value: str) -> int:
+    """Read an integer larger than zero."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+
+    return number
+
+
+def non_negative_int(value: str) -> int:
+    """Read an integer larger than or equal to zero."""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value} is a negative integer")
+
+    return number
+
+
+def read_cli_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
     """Read the command line arguments."""
     parser = argparse.ArgumentParser("ceiba")
     parser.add_argument(
         '-f', "--file", required=True, type=exists, help="File with the allow users")
     parser.add_argument('-m', '--mongo_url', default="localhost")
+    parser.add_argument('--host', default="0.0.0.0", help="address to listen on")
+    parser.add_argument('--port', default=8080, type=int, help="port to listen on")
+    parser.add_argument(
+        '--workers', default=1, type=non_negative_int,
+        help="number of server processes sharing the port (0: one per core)")
     parser.add_argument('-u', '--username', default=None, help="mongo username")
     parser.add_argument('-p', '--password', default=None, help="mongo password")
-    return parser.parse_args()
+    parser.add_argument(
+        '--mongo_threads', default=DEFAULT_MONGO_THREADS, type=int,
+        help="maximum number of concurrent mongo operations")
+    parser.add_argument(
+        '--mongo_pool_size', default=None, type=int,
+        help="maximum number of connections to mongo (default: driver default)")
+    parser.add_argument(
+        '--mongo_min_pool_size', default=None, type=int,
+        help="number of connections to mongo kept open when idle")
+    parser.add_argument(
+        '--mongo_server_selection_timeout', default=None, type=float,
+        help="seconds to find an available mongo server before failing")
+    parser.add_argument(
+        '--mongo_connect_timeout', default=None, type=float, help="seconds to connect to mongo")
+    parser.add_argument(
+        '--mongo_socket_timeout', default=None, type=float,
+        help="seconds to wait for the reply of a mongo operation")
+    parser.add_argument(
+        '--mongo_compressors', default=None,
+        help="comma separated compressors of the mongo traffic, like zstd,zlib")
+    parser.add_argument(
+        '--write_concern', default=None, type=write_concern,
+        help="number of mongo nodes acknowledging the writes, or majority")
+    parser.add_argument(
+        '--read_preference', default="primary", choices=READ_PREFERENCES,
+        help="mongo servers answering the queries, the mutations always use the primary")
+    parser.add_argument(
+        '-s', '--secret', default=os.environ.get("CEIBA_SECRET"),
+        help="key to sign the session tokens (default: CEIBA_SECRET environment variable)")
+    parser.add_argument(
+        '--token_lifetime', default=TOKEN_LIFETIME, type=float,
+        help="seconds during which a session token is valid")
+    parser.add_argument(
+        '--native_data', action="store_true",
+        help="store the data of the new properties as documents instead of JSON strings")
+    parser.add_argument(
+        '--max_history', default=None, type=positive_int,
+        help="maximum number of results kept by the APPEND duplication policy (default: all)")
+    parser.add_argument(
+        '--large_objects_dir', default=None, type=Path,
+        help="directory to store the large objects uploaded to /large_objects (default: disabled)")
+    parser.add_argument(
+        '--compression_threshold', default=DEFAULT_COMPRESSION_THRESHOLD, type=int,
+        help="minimum size in bytes of the compressed replies")
+    parser.add_argument(
+        '--query_cache_size', default=DEFAULT_QUERY_CACHE_SIZE, type=int,
+        help="number of parsed and validated queries kept in memory")
+    parser.add_argument(
+        '--persisted_queries', default=DEFAULT_PERSISTED_QUERIES, type=int,
+        help="number of persisted queries kept in memory")
+    parser.add_argument(
+        '--slow_threshold', default=DEFAULT_SLOW_THRESHOLD, type=float,
+        help="log the GraphQL requests slower than this number of seconds")
+    parser.add_argument(
+        '--profile_dir', default=None, type=Path,
+        help="directory to store the cProfile (and tracemalloc) results of the sampled requests")
+    parser.add_argument(
+        '--profile_sample_rate', default=0.01, type=float,
+        help="fraction of the GraphQL requests profiled when using --profile_dir")
+    parser.add_argument(
+        '--profile_memory', action="store_true",
+        help="trace the memory allocations and store a snapshot for each profiled request")
+    return parser.parse_args(argv)
+
+
+def create_app(
+        args: argparse.Namespace, context: Dict[str, Any],
+        shared_metrics: Optional[SharedMetrics] = None) -> web.Application:
+    """Create the web application serving the GraphQL API with the given ``context``.
+
+    If the server runs several workers, ``shared_metrics`` reports the metrics of all of them.
+    """
+    app = web.Application(client_max_size=DEFAULT_MAX_SIZE, middlewares=[
+        metrics_middleware,
+        profiling_middleware(ProfilingSettings(
+            args.slow_threshold, args.profile_dir, args.profile_sample_rate), "/graphql"),
+        compression_middleware("/graphql", args.compression_threshold, DEFAULT_MAX_SIZE),
+        persisted_queries_middleware(PersistedQueries(args.persisted_queries), "/graphql")])
+    app.cleanup_ctx.append(partial(background_tasks, context, shared_metrics))
+    app.router.add_get("/metrics", metrics_handler if shared_metrics is None else shared_metrics.handler)
+    if args.large_objects_dir is not None:
+        register_large_object_handlers(app, LargeObjectStore(args.large_objects_dir), context["tokens"])
+    return register_graphql_handlers(
+        app=app,
+        executor_context=context,
+        engine=TimedEngine(query_cache_decorator=query_cache(args.query_cache_size)),
+        engine_sdl=(PATH_LIB / "sdl").absolute().as_posix(),
+        engine_modules=[
+            "ceiba.query_resolvers",
+            "ceiba.mutation_resolvers",
+            "ceiba.subscription_resolvers",
+        ],
+        executor_http_endpoint="/graphql",
+        executor_http_methods=["POST"],
+        subscription_ws_endpoint="/subscriptions",
+        graphiql_enabled=True,
+        response_formatter=profiled_response
+    )
+
+
+def serve(args: argparse.Namespace, metrics_dir: Path, sock: socket.socket, relay: Connection) -> None:
+    """Serve the application on the socket shared by the workers.
+
+    The workers share their metrics through ``metrics_dir`` and their jobs notifications
+    through the ``relay`` pipe to the supervisor.
+    """
+    app = create_app(args, create_context(args, relay=relay), SharedMetrics(metrics_dir))
+    web.run_app(app, sock=sock, print=logger.info)
 
 
 def run() -> None:
     """Entry point of the application."""
     configure_logger(Path("."), "ceiba")
     args = read_cli_args()
-    web.run_app(
-        register_graphql_handlers(
-            app=web.Application(),
-            executor_context=create_context(args),
-            engine_sdl=(PATH_LIB / "sdl").absolute().as_posix(),
-            engine_modules=[
-                "ceiba.query_resolvers",
-                "ceiba.mutation_resolvers",
-            ],
-            executor_http_endpoint="/graphql",
-            executor_http_methods=["POST"],
-            graphiql_enabled=True
-        )
-    )
+    if args.profile_memory:
+        tracemalloc.start()
+    # The listener must be registered before creating the MongoDB clients
+    monitoring.register(MongoMetricsListener())
+    workers = args.workers or os.cpu_count() or 1
+    if workers == 1:
+        web.run_app(create_app(args, create_context(args)), host=args.host, port=args.port)
+        return
+
+    if args.secret is None:
+        # All the workers must sign the session tokens with the same key
+        logger.warning("No secret provided, the session tokens won't survive a server restart\n")
+        args.secret = secrets.token_hex(32)
+    sock = bind_socket(args.host, args.port)
+    logger.info(f"Serving on {args.host}:{args.port} with {workers} workers\n")
+    with tempfile.TemporaryDirectory(prefix="ceiba-metrics-") as metrics_dir:
+        Supervisor(partial(serve, args, Path(metrics_dir)), sock, workers).run()
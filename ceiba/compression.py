@@ -0,0 +1,186 @@
+"""Compress the replies of the GraphQL endpoint and decompress the requests sent to it.
+
+The encoding of the replies is negotiated using the ``Accept-Encoding`` header of the request.
+``gzip`` is always available, while ``br`` and ``zstd`` require the optional
+``brotli`` and ``zstandard`` dependencies: ``pip install ceiba[compression]``.
+
+API
+---
+.. autofunction:: compression_middleware
+.. autofunction:: negotiate_encoding
+.. autofunction:: with_body
+
+"""
+
+__all__ = ["CODECS", "DEFAULT_COMPRESSION_THRESHOLD", "DEFAULT_MAX_SIZE", "compression_middleware",
+           "negotiate_encoding", "with_body"]
+
+import asyncio
+import json
+import zlib
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Optional, cast
+
+from aiohttp import hdrs, web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore[assignment]
+
+#: Replies smaller than this number of bytes are not compressed
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+
+#: Maximum size in bytes of a decompressed request, the default ``client_max_size`` of aiohttp
+DEFAULT_MAX_SIZE = 1024 ** 2
+
+#: Bytes decompressed at once
+DECOMPRESSION_CHUNK = 1 << 16
+
+#: Level of the gzip replies, the lowest level is about twice as fast as the default
+#: and compresses the JSON replies almost as well
+GZIP_LEVEL = 1
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+
+def gzip_compress(data: bytes) -> bytes:
+    compressor = zlib.compressobj(level=GZIP_LEVEL, wbits=31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class BodyTooLarge(Exception):
+    """The decompressed body is larger than the maximum size of the requests."""
+
+
+def zstd_decompress(data: bytes, max_size: int) -> bytes:
+    # Decompress in chunks, the size announced by the frame can't be trusted
+    reader = zstandard.ZstdDecompressor().stream_reader(data)
+    body = bytearray()
+    while True:
+        chunk = reader.read(DECOMPRESSION_CHUNK)
+        if not chunk:
+            return bytes(body)
+        body.extend(chunk)
+        if len(body) > max_size:
+            raise BodyTooLarge()
+
+
+#: Functions compressing the replies, sorted by preference
+CODECS: Dict[str, Callable[[bytes], bytes]] = {}
+if zstandard is not None:
+    CODECS["zstd"] = zstandard.ZstdCompressor(level=3).compress
+if brotli is not None:
+    CODECS["br"] = partial(brotli.compress, quality=4)
+CODECS["gzip"] = gzip_compress
+
+#: Request encodings decoded by aiohttp itself
+NATIVE_DECODINGS = {"identity", "gzip", "deflate"} | ({"br"} if brotli is not None else set())
+
+#: Functions decompressing the request encodings unknown to aiohttp, up to a maximum size
+DECODERS: Dict[str, Callable[[bytes, int], bytes]] = {}
+if zstandard is not None:
+    DECODERS["zstd"] = zstd_decompress
+
+
+class RequestWithBody:
+    """View of a request with another body, since the body of an aiohttp request can't be replaced.
+
+    Reading the body returns ``body``, everything else comes from the original request.
+    """
+
+    def __init__(self, request: web.Request, body: bytes) -> None:
+        self._request = request
+        self._body = body
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._request, name)
+
+    async def read(self) -> bytes:
+        return self._body
+
+    async def text(self) -> str:
+        return self._body.decode(self._request.charset or "utf-8")
+
+    async def json(self, *, loads: Callable[[str], Any] = json.loads) -> Any:
+        return loads(await self.text())
+
+
+def with_body(request: web.Request, body: bytes) -> web.Request:
+    """Return a view of ``request`` whose body is ``body``, to pass to the next handler."""
+    return cast(web.Request, RequestWithBody(request, body))
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Return the available encoding with the highest weight in ``accept_encoding``, if any.
+
+    Encodings with the same weight are chosen in the order of :data:`CODECS`.
+    """
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        try:
+            weight = float(params.strip()[2:]) if params.strip().startswith("q=") else 1.0
+        except ValueError:
+            continue
+        weights[name.strip()] = weight
+
+    default = weights.get("*", 0.0)
+    candidates = [(weights.get(name, default), -rank, name) for rank, name in enumerate(CODECS)]
+    weight, _, name = max(candidates)
+    return name if weight > 0 else None
+
+
+def compression_middleware(
+        endpoint: str = "/graphql", threshold: int = DEFAULT_COMPRESSION_THRESHOLD,
+        max_size: int = DEFAULT_MAX_SIZE) -> Callable:
+    """Create a middleware compressing the replies of ``endpoint`` of at least ``threshold`` bytes.
+
+    aiohttp decompresses the ``gzip``, ``deflate`` and ``br`` requests by itself, the ``zstd``
+    requests sent to ``endpoint`` are decompressed before they reach the handler.
+    A request with an unknown encoding is rejected with a 415 error, and a request
+    larger than ``max_size`` bytes once decompressed with a 413 error. ``max_size`` must
+    be the ``client_max_size`` of the application, which limits the other requests.
+    """
+    @web.middleware
+    async def middleware(request: web.Request, handler: Handler) -> web.StreamResponse:
+        if request.path != endpoint:
+            return await handler(request)
+
+        loop = asyncio.get_running_loop()
+        encoding = request.headers.get(hdrs.CONTENT_ENCODING, "identity").strip().lower()
+        if encoding not in NATIVE_DECODINGS:
+            decoder = DECODERS.get(encoding)
+            if decoder is None:
+                raise web.HTTPUnsupportedMediaType(
+                    text=f"Unsupported content encoding: {encoding}",
+                    headers={hdrs.ACCEPT_ENCODING: ", ".join(sorted(NATIVE_DECODINGS | set(DECODERS)))})
+            body = await request.read()
+            try:
+                decoded = await loop.run_in_executor(None, decoder, body, max_size)
+            except BodyTooLarge:
+                raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=max_size + 1)
+            except Exception:
+                raise web.HTTPBadRequest(text=f"Invalid {encoding} body")
+            request = with_body(request, decoded)
+
+        response = await handler(request)
+        if not isinstance(response, web.Response) or hdrs.CONTENT_ENCODING in response.headers:
+            return response
+        response.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+        reply = response.body
+        if not isinstance(reply, bytes) or len(reply) < threshold:
+            return response
+
+        accepted = negotiate_encoding(request.headers.get(hdrs.ACCEPT_ENCODING, ""))
+        if accepted is not None:
+            response.body = await loop.run_in_executor(None, CODECS[accepted], reply)
+            response.headers[hdrs.CONTENT_ENCODING] = accepted
+        return response
+
+    return middleware
@@ -0,0 +1,291 @@
+"""Import large tables of properties into a collection.
+
+The rows are read in fixed-size chunks and stored using unordered bulk inserts,
+with a bounded number of chunks in flight. The number of rows committed is stored
+in the database after each chunk, so an interrupted import can be resumed.
+The new rows of each chunk are added to the size of the collection in the registry,
+which is built first if it doesn't exist yet, before the chunk is committed,
+so the rows stored before an interruption are counted too.
+
+API
+---
+.. autofunction:: import_table
+.. autofunction:: read_chunks
+.. autofunction:: main
+
+"""
+
+__all__ = ["import_table", "main", "read_chunks"]
+
+import argparse
+import itertools
+import json
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError
+
+from .app import positive_int
+from .indexes import indexes_for
+from .mongo_interface import DATABASE_NAME, IMPORTS_COLLECTION, DatabaseConfig, connect_to_db
+from .registry import REGISTRY_COLLECTION, ensure_registry
+
+#: Number of rows stored with each bulk insert
+DEFAULT_CHUNK_SIZE = 10_000
+
+#: Maximum number of chunks being inserted at the same time
+DEFAULT_IN_FLIGHT = 4
+
+#: Error code of MongoDB for documents that are already stored
+DUPLICATE_KEY_ERROR = 11000
+
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".json": "jsonl", ".parquet": "parquet"}
+
+logger = logging.getLogger(__name__)
+
+Records = List[Dict[str, Any]]
+
+
+def read_csv_chunks(path: Path, chunk_size: int, skip: int = 0) -> Iterator[Records]:
+    """Read a CSV whose first column is the identifier of the rows."""
+    reader = pd.read_csv(path, index_col=0, chunksize=chunk_size, skiprows=range(1, skip + 1))
+    for data in reader:
+        data.reset_index(inplace=True)
+        data.rename(columns={"index": "_id"}, inplace=True)
+        yield data.to_dict("records")
+
+
+def check_identifiers(chunks: Iterator[Records], skip: int) -> Iterator[Records]:
+    """Check that all the rows have an ``_id``, which makes inserting them again harmless."""
+    row = skip
+    for chunk in chunks:
+        for record in chunk:
+            if "_id" not in record:
+                raise ValueError(f"Row {row} has no _id, the rows must be identified to be imported safely")
+            row += 1
+        yield chunk
+
+
+def read_jsonl_chunks(path: Path, chunk_size: int, skip: int = 0) -> Iterator[Records]:
+    """Read a file with a JSON object per line."""
+    with open(path, 'r') as handler:
+        lines = itertools.islice((line for line in handler if line.strip()), skip, None)
+        while True:
+            chunk = [json.loads(line) for line in itertools.islice(lines, chunk_size)]
+            if not chunk:
+                break
+            yield chunk
+
+
+def read_parquet_chunks(path: Path, chunk_size: int, skip: int = 0) -> Iterator[Records]:
+    """Read a Parquet file, which requires the optional ``pyarrow`` dependency."""
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Reading Parquet files requires pyarrow: pip install ceiba[parquet]")
+
+    # The batches do not cross the row groups, so they are regrouped in chunks of the same size
+    buffer: Records = []
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+        if skip >= batch.num_rows:
+            skip -= batch.num_rows
+            continue
+        buffer.extend(batch.slice(skip).to_pylist())
+        skip = 0
+        while len(buffer) >= chunk_size:
+            yield buffer[:chunk_size]
+            buffer = buffer[chunk_size:]
+    if buffer:
+        yield buffer
+
+
+READERS = {"csv": read_csv_chunks, "jsonl": read_jsonl_chunks, "parquet": read_parquet_chunks}
+
+
+def read_chunks(
+        path: Path, chunk_size: int = DEFAULT_CHUNK_SIZE, skip: int = 0,
+        file_format: Optional[str] = None) -> Iterator[Records]:
+    """Read the rows of ``path`` in chunks of ``chunk_size`` rows, skipping the first ``skip`` rows.
+
+    The rows of a CSV file are identified by its first column, while the rows of
+    the JSONL and Parquet files must have an ``_id`` field.
+
+    Parameters
+    ----------
+    path
+        CSV, JSONL or Parquet file
+    chunk_size
+        Number of rows in each chunk, only the last chunk can be smaller
+    skip
+        Number of rows to skip
+    file_format
+        One of csv, jsonl or parquet. By default it is deduced from the file extension
+
+    Raises
+    ------
+    ValueError
+        If the format is unknown or a JSONL or Parquet row has no ``_id``
+
+    """
+    if file_format is None:
+        file_format = FORMATS.get(path.suffix.lower())
+        if file_format is None:
+            raise ValueError(f"Cannot deduce the format of {path}, use one of: {sorted(READERS)}")
+
+    chunks = READERS[file_format](path, chunk_size, skip)
+    return chunks if file_format == "csv" else check_identifiers(chunks, skip)
+
+
+def insert_chunk(collection: Collection, chunk: Records) -> int:
+    """Insert the rows ignoring the ones that are already stored and return the number of new rows."""
+    try:
+        return len(collection.insert_many(chunk, ordered=False).inserted_ids)
+    except BulkWriteError as ex:
+        errors = [error for error in ex.details["writeErrors"] if error["code"] != DUPLICATE_KEY_ERROR]
+        if errors:
+            raise
+        return ex.details["nInserted"]
+
+
+class ImportProgress:
+    """Commit the chunks in the order in which they are read, as soon as they are inserted.
+
+    The committed rows are stored in the database, together with the rate of the import
+    in rows per second, and the new rows are added to the size of the collection in the registry.
+    """
+
+    def __init__(self, database: Database, collection_name: str, import_id: str, rows: int) -> None:
+        self.checkpoints = database[IMPORTS_COLLECTION]
+        self.registry = database[REGISTRY_COLLECTION]
+        self.collection_name = collection_name
+        self.import_id = import_id
+        self.rows = rows
+        self.imported = 0
+        self.new_rows = 0
+        self.next_chunk = 0
+        self.inserted: Dict[int, Tuple[int, int]] = {}
+        self.start = time.perf_counter()
+
+    def chunk_done(self, index: int, size: int, new_rows: int) -> None:
+        """Mark the chunk ``index`` as inserted and commit all the consecutive inserted chunks.
+
+        The registry is updated before the checkpoint: if the import stops in between,
+        the rows of the chunk are found to be already stored after resuming, so they
+        are never counted twice.
+        """
+        self.inserted[index] = (size, new_rows)
+        while self.next_chunk in self.inserted:
+            size, new_rows = self.inserted.pop(self.next_chunk)
+            self.next_chunk += 1
+            self.rows += size
+            self.imported += size
+            self.new_rows += new_rows
+            if new_rows:
+                self.registry.update_one(
+                    {"_id": self.collection_name}, {"$inc": {"size": new_rows}}, upsert=True)
+            rate = self.imported / (time.perf_counter() - self.start)
+            self.checkpoints.replace_one(
+                {"_id": self.import_id}, {"rows": self.rows, "rate": rate}, upsert=True)
+            logger.info(f"Committed {self.rows} rows of {self.import_id} ({rate:.0f} rows/s)")
+
+
+def import_table(
+        database: Database, collection_name: str, path: Path,
+        chunk_size: int = DEFAULT_CHUNK_SIZE, in_flight: int = DEFAULT_IN_FLIGHT,
+        resume: bool = False, file_format: Optional[str] = None) -> int:
+    """Store the rows of ``path`` in ``collection_name`` chunk by chunk.
+
+    Since the rows already stored are ignored, the chunks that were in flight
+    when an import was interrupted are safely inserted again after resuming.
+
+    Parameters
+    ----------
+    database
+        Database handler
+    collection_name
+        Collection where the rows are stored
+    path
+        CSV, JSONL or Parquet file
+    chunk_size
+        Number of rows of each bulk insert
+    in_flight
+        Maximum number of chunks being inserted at the same time
+    resume
+        Skip the rows committed by a previous import of the same file
+    file_format
+        One of csv, jsonl or parquet. By default it is deduced from the file extension
+
+    Returns
+    -------
+    Total number of rows committed for this file
+
+    """
+    # The registry is built before adding the new rows, so it also counts the other collections
+    ensure_registry(database)
+    collection = database[collection_name]
+    import_id = f"{collection_name}/{path.name}"
+    checkpoint = database[IMPORTS_COLLECTION].find_one({"_id": import_id}) if resume else None
+    progress = ImportProgress(
+        database, collection_name, import_id, 0 if checkpoint is None else checkpoint["rows"])
+    if progress.rows:
+        logger.info(f"Resuming the import of {path} after {progress.rows} rows")
+
+    # Chunks being inserted with their index and size
+    pending: Dict[Future, Tuple[int, int]] = {}
+    with ThreadPoolExecutor(max_workers=in_flight, thread_name_prefix="ceiba-import") as executor:
+        for index, chunk in enumerate(read_chunks(path, chunk_size, progress.rows, file_format)):
+            # Keep at most in_flight chunks in memory
+            if len(pending) >= in_flight:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    progress.chunk_done(*pending.pop(future), future.result())
+            pending[executor.submit(insert_chunk, collection, chunk)] = (index, len(chunk))
+
+        for future in as_completed(pending):
+            progress.chunk_done(*pending[future], future.result())
+
+    # Building the indexes once all the data is stored is faster than updating them with each chunk
+    for spec in indexes_for(collection_name):
+        collection.create_index(spec.keys, unique=spec.unique)
+
+    return progress.rows
+
+
+def read_cli_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Read the command line arguments."""
+    parser = argparse.ArgumentParser("ceiba-import")
+    parser.add_argument("file", type=Path, help="CSV, JSONL or Parquet file with the properties")
+    parser.add_argument('-c', "--collection_name", required=True, help="collection to store the properties")
+    parser.add_argument('-m', '--mongo_url', default="localhost")
+    parser.add_argument('-u', '--username', default=None, help="mongo username")
+    parser.add_argument('-p', '--password', default=None, help="mongo password")
+    parser.add_argument(
+        "--format", dest="file_format", choices=sorted(READERS), default=None,
+        help="format of the file (default: deduced from the extension)")
+    parser.add_argument(
+        "--chunk_size", type=positive_int, default=DEFAULT_CHUNK_SIZE, help="rows stored with each bulk insert")
+    parser.add_argument(
+        "--in_flight", type=positive_int, default=DEFAULT_IN_FLIGHT,
+        help="maximum number of chunks being inserted at the same time")
+    parser.add_argument(
+        "--resume", action="store_true", help="skip the rows committed by a previous import of the file")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Entry point of the import command."""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s  %(message)s', datefmt='[%I:%M:%S]')
+    args = read_cli_args(argv)
+    db_info = DatabaseConfig(
+        DATABASE_NAME, host=args.mongo_url, username=args.username, password=args.password)
+    database = connect_to_db(db_info)
+    rows = import_table(
+        database, args.collection_name, args.file, chunk_size=args.chunk_size,
+        in_flight=args.in_flight, resume=args.resume, file_format=args.file_format)
+    logger.info(f"{rows} rows of {args.file} are stored in collection {args.collection_name}")
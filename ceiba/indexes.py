@@ -0,0 +1,165 @@
+"""Provision the indexes used by the queries and mutations.
+
+API
+---
+.. autoclass:: IndexManager
+   :members:
+.. autoclass:: IndexSpec
+.. autofunction:: deduplicate_jobs
+.. autofunction:: indexes_for
+
+"""
+
+__all__ = ["JOB_INDEXES", "PROPERTY_INDEXES", "USER_INDEXES", "IndexManager", "IndexSpec", "deduplicate_jobs",
+           "indexes_for"]
+
+import logging
+import time
+from typing import Any, Dict, List, NamedTuple, Set, Tuple, Union
+
+from pymongo import ASCENDING, HASHED
+from pymongo.database import Database
+from pymongo.errors import OperationFailure, PyMongoError
+
+from .mongo_interface import USERS_COLLECTION, AsyncDatabase
+from .registry import is_property_collection
+
+
+class IndexSpec(NamedTuple):
+    """Keys and options of an index."""
+    keys: List[Tuple[str, Union[int, str]]]
+    unique: bool = False
+
+
+#: Indexes backing the job queries filtered by status and sorted by identifier or schedule time.
+#: There is at most one job per property, which makes the job upserts atomic. The databases
+#: created before this constraint may have several jobs per property, which must be removed
+#: with :func:`deduplicate_jobs` before the unique index can be built.
+JOB_INDEXES = [
+    IndexSpec([("status", ASCENDING), ("_id", ASCENDING)]),
+    IndexSpec([("status", ASCENDING), ("schedule_time", ASCENDING), ("_id", ASCENDING)]),
+    IndexSpec([("property._id", ASCENDING)], unique=True)
+]
+
+#: Index backing the lookup of the properties by metadata. The index stores a hash
+#: of the metadata instead of the whole string, so long metadata can be indexed too.
+PROPERTY_INDEXES = [IndexSpec([("metadata", HASHED)])]
+
+#: Index backing the lookup of the allowed users
+USER_INDEXES = [IndexSpec([("username", ASCENDING)])]
+
+#: Seconds before provisioning again a collection after a transient error,
+#: doubled after each consecutive failure up to :data:`MAX_RETRY_DELAY`
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 300.0
+
+#: Error code of the server when a unique index finds duplicated keys
+DUPLICATE_KEY_ERROR = 11000
+
+logger = logging.getLogger(__name__)
+
+
+def indexes_for(collection_name: str) -> List[IndexSpec]:
+    """Return the indexes required by the collection called ``collection_name``."""
+    if collection_name == USERS_COLLECTION:
+        return USER_INDEXES
+    elif collection_name.startswith("jobs_"):
+        return JOB_INDEXES
+    elif is_property_collection(collection_name):
+        return PROPERTY_INDEXES
+
+    return []
+
+
+class IndexManager:
+    """Create the indexes of the collections the first time they are seen.
+
+    Creating an index that already exists is a no-op in MongoDB,
+    therefore provisioning the same collection twice is harmless.
+    """
+
+    def __init__(self, database: AsyncDatabase) -> None:
+        self.database = database
+        self.provisioned: Set[str] = set()
+        #: Time of the next attempt and current delay of the collections that failed transiently
+        self.retries: Dict[str, Tuple[float, float]] = {}
+
+    async def provision(self) -> None:
+        """Create the indexes of the users collection and all the existing collections."""
+        names = await self.database.list_collection_names()
+        for name in [USERS_COLLECTION, *names]:
+            await self.ensure(name)
+
+    async def ensure(self, collection_name: str) -> None:
+        """Create the indexes of ``collection_name`` unless it has already been provisioned.
+
+        An index rejected by the server, for example a unique index over duplicated keys,
+        is logged once and not built again until the server restarts. After a transient
+        error, like a lost connection, the collection is provisioned again the next time
+        it is seen, waiting longer after each consecutive failure.
+        """
+        if collection_name in self.provisioned:
+            return
+        retry = self.retries.get(collection_name)
+        if retry is not None and time.monotonic() < retry[0]:
+            return
+
+        self.provisioned.add(collection_name)
+        collection = self.database[collection_name]
+        for spec in indexes_for(collection_name):
+            start = time.perf_counter()
+            logger.info(f"Building index {spec.keys} on collection {collection_name}\n")
+            try:
+                name = await collection.create_index(spec.keys, unique=spec.unique)
+            except OperationFailure as ex:
+                if ex.code == DUPLICATE_KEY_ERROR:
+                    logger.error(f"Collection {collection_name} has duplicated values of {spec.keys}, "
+                                 "the server stores one job per property, remove the duplicated jobs "
+                                 "using `ceiba-admin deduplicate-jobs` and restart the server:\n{ex}\n")
+                    continue
+                logger.error(f"Cannot create index {spec.keys} on collection {collection_name}, "
+                             f"it won't be built again until the server restarts:\n{ex}\n")
+                continue
+            except PyMongoError as ex:
+                self.provisioned.discard(collection_name)
+                delay = RETRY_DELAY if retry is None else min(2 * retry[1], MAX_RETRY_DELAY)
+                self.retries[collection_name] = (time.monotonic() + delay, delay)
+                logger.warning(f"Cannot create the indexes of collection {collection_name}, "
+                               f"retrying in {delay:.0f} seconds:\n{ex}\n")
+                return
+            logger.info(f"Index {name} on collection {collection_name} is ready "
+                        f"after {time.perf_counter() - start:.2f} seconds\n")
+
+        self.retries.pop(collection_name, None)
+
+
+def deduplicate_jobs(database: Database) -> int:
+    """Keep a single job per property in all the jobs collections.
+
+    The kept job is the first one that is DONE, or the one with the smallest identifier
+    if none is DONE. The registry must be rebuilt afterwards to count the jobs again.
+
+    Returns
+    -------
+    The number of removed jobs
+
+    """
+    pipeline: List[Dict[str, Any]] = [
+        {"$sort": {"_id": ASCENDING}},
+        {"$group": {"_id": "$property._id", "jobs": {"$push": {"_id": "$_id", "status": "$status"}},
+                    "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}]
+    removed = 0
+    for name in database.list_collection_names():
+        if not name.startswith("jobs_"):
+            continue
+        collection = database[name]
+        for group in collection.aggregate(pipeline, allowDiskUse=True):
+            jobs = group["jobs"]
+            kept = next((job for job in jobs if job["status"] == "DONE"), jobs[0])
+            result = collection.delete_many({"_id": {"$in": [job["_id"] for job in jobs if job is not kept]}})
+            removed += result.deleted_count
+            logger.info(f"Kept job {kept['_id']} of property {group['_id']} in collection {name}, "
+                        f"removed {result.deleted_count} duplicated jobs\n")
+
+    return removed
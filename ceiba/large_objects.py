@@ -0,0 +1,127 @@
+"""Store the large objects of the properties, like wavefunctions, next to the GraphQL endpoint.
+
+The objects are stored in a local directory and addressed by the SHA-256 of their content.
+They are streamed from and to the clients in chunks, therefore they are never fully held
+in memory. The handle returned by the upload is the value to record in the
+``large_objects`` field of the property.
+
+API
+---
+.. autoclass:: LargeObjectStore
+   :members:
+.. autofunction:: register_large_object_handlers
+
+"""
+
+__all__ = ["LARGE_OBJECTS_ENDPOINT", "LargeObjectStore", "register_large_object_handlers"]
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from functools import partial
+from pathlib import Path
+from typing import Tuple
+
+from aiohttp import StreamReader, web
+
+from .user_authentication import TokenAuthority
+
+LARGE_OBJECTS_ENDPOINT = "/large_objects"
+
+#: Number of bytes read from or written to the disk at once
+CHUNK_SIZE = 1 << 20
+
+HANDLE_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+logger = logging.getLogger(__name__)
+
+
+class LargeObjectStore:
+    """Content-addressed store in the directory ``root``.
+
+    Each object lives in ``root/<first two characters of the handle>/<handle>``,
+    therefore uploading the same content twice stores it only once.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.incoming = root / "incoming"
+        self.incoming.mkdir(parents=True, exist_ok=True)
+
+    def path(self, handle: str) -> Path:
+        """Return the path of the object identified by ``handle``.
+
+        Raises
+        ------
+        ValueError
+            If ``handle`` is not a SHA-256 hexadecimal digest
+        """
+        if HANDLE_PATTERN.match(handle) is None:
+            raise ValueError(f"Invalid large object handle: {handle}")
+        return self.root / handle[:2] / handle
+
+    async def store(self, stream: StreamReader) -> Tuple[str, int]:
+        """Write the content of ``stream`` to the store chunk by chunk.
+
+        The content is written to a temporary file that is moved to its final
+        location once complete, so a partial upload is never visible.
+
+        Returns
+        -------
+        The handle of the object and its size in bytes
+        """
+        loop = asyncio.get_running_loop()
+        digest = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=self.incoming, delete=False) as handler:
+            try:
+                async for chunk in stream.iter_chunked(CHUNK_SIZE):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    await loop.run_in_executor(None, handler.write, chunk)
+            except BaseException:
+                handler.close()
+                os.unlink(handler.name)
+                raise
+
+        handle = digest.hexdigest()
+        path = self.path(handle)
+        path.parent.mkdir(exist_ok=True)
+        os.replace(handler.name, path)
+        logger.info(f"Stored large object {handle} of {size} bytes\n")
+        return handle, size
+
+
+async def upload_large_object(
+        store: LargeObjectStore, authority: TokenAuthority, request: web.Request) -> web.Response:
+    """Store the body of the request, which requires the session token as ``Bearer`` token."""
+    token = request.headers.get("Authorization", "").partition("Bearer ")[2]
+    if authority.verify(token) is None:
+        raise web.HTTPUnauthorized(text="The user is not authenticated")
+
+    handle, size = await store.store(request.content)
+    return web.json_response(
+        {"handle": handle, "size": size, "url": f"{LARGE_OBJECTS_ENDPOINT}/{handle}"}, status=201)
+
+
+async def download_large_object(store: LargeObjectStore, request: web.Request) -> web.StreamResponse:
+    """Stream the object, honouring the ``Range`` header of the request."""
+    try:
+        path = store.path(request.match_info["handle"])
+    except ValueError as ex:
+        raise web.HTTPBadRequest(text=str(ex))
+    if not path.is_file():
+        raise web.HTTPNotFound(text="Unknown large object")
+
+    return web.FileResponse(
+        path, chunk_size=CHUNK_SIZE, headers={"Content-Type": "application/octet-stream"})
+
+
+def register_large_object_handlers(
+        app: web.Application, store: LargeObjectStore, authority: TokenAuthority) -> None:
+    """Add the upload and download endpoints of the large objects to ``app``."""
+    app.router.add_post(LARGE_OBJECTS_ENDPOINT, partial(upload_large_object, store, authority))
+    app.router.add_get(f"{LARGE_OBJECTS_ENDPOINT}/{{handle}}", partial(download_large_object, store))
@@ -0,0 +1,463 @@
+"""Collect the metrics of the web service and expose them in the Prometheus text format.
+
+The ``/metrics`` endpoint reports:
+
+* the latency of the GraphQL operations, by operation name, and of the resolvers,
+* the number, size and latency of the HTTP requests,
+* the number, failures and latency of the MongoDB commands, using the driver command monitoring,
+* the connections of the MongoDB pool that are open and in use,
+* the lag of the event loop.
+
+When the server runs several workers, :class:`SharedMetrics` adds the metrics of all of them.
+
+API
+---
+.. autoclass:: MetricsRegistry
+   :members:
+.. autoclass:: SharedMetrics
+   :members:
+.. autoclass:: MongoMetricsListener
+.. autoclass:: TimedEngine
+.. autofunction:: timed
+.. autofunction:: metrics_middleware
+.. autofunction:: measure_event_loop_lag
+
+"""
+
+__all__ = ["REGISTRY", "MetricsRegistry", "MongoMetricsListener", "SharedMetrics", "TimedEngine",
+           "measure_event_loop_lag", "metrics_handler", "metrics_middleware", "timed"]
+
+import abc
+import asyncio
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import (Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Set,
+                    Tuple, Union)
+
+from aiohttp import web
+from pymongo import monitoring
+from tartiflette import Engine
+
+from .profiling import record
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = tuple(float(4 ** power) for power in range(4, 14))
+
+#: Maximum number of operation names used as labels, the rest are reported as "other"
+MAX_OPERATION_LABELS = 100
+
+#: Intervals without updates after which the snapshot of a worker is considered stale
+STALE_INTERVALS = 5
+
+#: Media type of the Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Labels = Tuple[str, ...]
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """Format the labels of a sample, escaping their values."""
+    if not names:
+        return ""
+    escaped = (value.replace("\\", r"\\").replace('"', r'\"').replace("\n", r"\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Metric(abc.ABC):
+    """Family of samples with the same name, one for each value of the labels.
+
+    The samples are updated by the event loop and by the threads running the
+    MongoDB operations, therefore every update holds a lock.
+    """
+
+    kind = "untyped"
+    #: Whether the values of the workers that have exited are still reported
+    cumulative = True
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def key(self, labels: Dict[str, str]) -> Labels:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    @abc.abstractmethod
+    def snapshot(self) -> List[Any]:
+        """Return the values as a JSON serializable list."""
+
+    @abc.abstractmethod
+    def merge(self, values: Dict[Labels, Any], snapshot: List[Any]) -> None:
+        """Add the values of ``snapshot`` to ``values``."""
+
+    @abc.abstractmethod
+    def samples(self, values: Dict[Labels, Any]) -> Iterator[str]:
+        """Yield the lines of the samples with the given ``values``."""
+
+    def render(self, others: Sequence[List[Any]] = ()) -> str:
+        """Return the samples in the Prometheus text format, adding the snapshots of ``others``."""
+        values: Dict[Labels, Any] = {}
+        for snapshot in (self.snapshot(), *others):
+            self.merge(values, snapshot)
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples(values))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Value that only increases."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, description, labels)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self) -> List[Any]:
+        with self.lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+    def merge(self, values: Dict[Labels, Any], snapshot: List[Any]) -> None:
+        for key, value in snapshot:
+            values[tuple(key)] = values.get(tuple(key), 0) + value
+
+    def samples(self, values: Dict[Labels, Any]) -> Iterator[str]:
+        for key, value in values.items():
+            yield f"{self.name}{format_labels(self.labels, key)} {value}"
+
+
+class Gauge(Counter):
+    """Value that goes up and down."""
+
+    kind = "gauge"
+    cumulative = False
+
+
+class Histogram(Metric):
+    """Distribution of the observed values in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(
+            self, name: str, description: str, labels: Sequence[str] = (),
+            buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        # Number of observations in each bucket, plus the +Inf one, and the sum of the observations
+        self.values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def snapshot(self) -> List[Any]:
+        with self.lock:
+            return [[list(key), list(counts), total[0]] for key, (counts, total) in self.values.items()]
+
+    def merge(self, values: Dict[Labels, Any], snapshot: List[Any]) -> None:
+        for key, counts, total in snapshot:
+            merged_counts, merged_total = values.setdefault(
+                tuple(key), ([0] * (len(self.buckets) + 1), [0.0]))
+            for index, count in enumerate(counts):
+                merged_counts[index] += count
+            merged_total[0] += total
+
+    def samples(self, values: Dict[Labels, Any]) -> Iterator[str]:
+        bucket_labels = (*self.labels, "le")
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(bucket_labels, (*key, str(bound)))} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, key)} {total[0]}"
+            yield f"{self.name}_count{format_labels(self.labels, key)} {cumulative}"
+
+
+class MetricsRegistry:
+    """Collection of the metrics exposed by the service."""
+
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+
+    def counter(self, name: str, description: str, labels: Sequence[str] = ()) -> Counter:
+        """Register a new :class:`Counter`."""
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name: str, description: str, labels: Sequence[str] = ()) -> Gauge:
+        """Register a new :class:`Gauge`."""
+        return self.register(Gauge(name, description, labels))
+
+    def histogram(
+            self, name: str, description: str, labels: Sequence[str] = (),
+            buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        """Register a new :class:`Histogram`."""
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def register(self, metric: Any) -> Any:
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self) -> Dict[str, List[Any]]:
+        """Return the values of all the metrics, by name, as a JSON serializable dictionary."""
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def render(
+            self, live: Sequence[Dict[str, List[Any]]] = (),
+            exited: Sequence[Dict[str, List[Any]]] = ()) -> str:
+        """Return all the metrics in the Prometheus text format.
+
+        Parameters
+        ----------
+        live
+            Snapshots of the other processes that are running
+        exited
+            Snapshots of the processes that have exited, only the cumulative metrics are added
+
+        """
+        return "\n".join(metric.render([
+            snapshot[metric.name] for snapshot in (*live, *(exited if metric.cumulative else ()))
+            if metric.name in snapshot]) for metric in self.metrics) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+OPERATION_LATENCY = REGISTRY.histogram(
+    "ceiba_graphql_operation_duration_seconds", "Time to execute each GraphQL operation",
+    ["operation", "outcome"])
+RESOLVER_LATENCY = REGISTRY.histogram(
+    "ceiba_resolver_duration_seconds", "Time spent in each GraphQL resolver", ["resolver", "outcome"])
+HTTP_LATENCY = REGISTRY.histogram(
+    "ceiba_http_request_duration_seconds", "Time to reply the HTTP requests", ["path", "method", "status"])
+HTTP_REQUEST_SIZE = REGISTRY.histogram(
+    "ceiba_http_request_size_bytes", "Size of the body of the HTTP requests", ["path"], SIZE_BUCKETS)
+HTTP_RESPONSE_SIZE = REGISTRY.histogram(
+    "ceiba_http_response_size_bytes", "Size of the body of the HTTP replies", ["path"], SIZE_BUCKETS)
+MONGO_LATENCY = REGISTRY.histogram(
+    "ceiba_mongo_command_duration_seconds", "Latency of the MongoDB commands", ["command", "outcome"])
+MONGO_CONNECTIONS = REGISTRY.gauge(
+    "ceiba_mongo_pool_connections", "Connections of the MongoDB pools by state", ["state"])
+EVENT_LOOP_LAG = REGISTRY.histogram(
+    "ceiba_event_loop_lag_seconds", "Delay of the event loop to run a scheduled callback")
+
+
+def timed(resolver: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """Measure the latency of ``resolver``, labelled by the type and name of the resolved field.
+
+    The latency is also added to the profile of the request, see :mod:`ceiba.profiling`.
+    """
+    @functools.wraps(resolver)
+    async def wrapper(parent: Any, args: Dict[str, Any], ctx: Dict[str, Any], info: Any) -> Any:
+        name = resolver.__name__ if info is None else f"{info.parent_type.name}.{info.field_name}"
+        outcome = "error"
+        start = time.perf_counter()
+        try:
+            result = await resolver(parent, args, ctx, info)
+            outcome = "success"
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            RESOLVER_LATENCY.observe(elapsed, resolver=name, outcome=outcome)
+            record(name, elapsed)
+
+    return wrapper
+
+
+class TimedEngine(Engine):
+    """GraphQL engine measuring the latency of the operations, labelled by their name.
+
+    The operation names are chosen by the clients, so only the first :data:`MAX_OPERATION_LABELS`
+    distinct names are used as labels. The anonymous operations are labelled ``anonymous``.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.operation_names: Set[str] = set()
+
+    def operation_label(self, operation_name: Optional[str]) -> str:
+        """Return the label of the operation called ``operation_name``."""
+        if not operation_name:
+            return "anonymous"
+        if operation_name not in self.operation_names:
+            if len(self.operation_names) >= MAX_OPERATION_LABELS:
+                return "other"
+            self.operation_names.add(operation_name)
+        return operation_name
+
+    async def execute(
+            self, query: Union[str, bytes], operation_name: Optional[str] = None,
+            context: Optional[Any] = None, variables: Optional[Dict[str, Any]] = None,
+            initial_value: Optional[Any] = None) -> Dict[str, Any]:
+        outcome = "error"
+        start = time.perf_counter()
+        try:
+            result = await super().execute(
+                query, operation_name=operation_name, context=context, variables=variables,
+                initial_value=initial_value)
+            if not result.get("errors"):
+                outcome = "success"
+            return result
+        finally:
+            OPERATION_LATENCY.observe(
+                time.perf_counter() - start, operation=self.operation_label(operation_name),
+                outcome=outcome)
+
+
+class MongoMetricsListener(monitoring.CommandListener, monitoring.ConnectionPoolListener):
+    """Measure the MongoDB commands and the usage of the connection pools.
+
+    Register it with :func:`pymongo.monitoring.register` before creating the clients.
+    """
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        MONGO_LATENCY.observe(event.duration_micros / 1e6, command=event.command_name, outcome="success")
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        MONGO_LATENCY.observe(event.duration_micros / 1e6, command=event.command_name, outcome="failure")
+
+    def connection_created(self, event: monitoring.ConnectionCreatedEvent) -> None:
+        MONGO_CONNECTIONS.inc(state="open")
+
+    def connection_closed(self, event: monitoring.ConnectionClosedEvent) -> None:
+        MONGO_CONNECTIONS.inc(-1, state="open")
+
+    def connection_checked_out(self, event: monitoring.ConnectionCheckedOutEvent) -> None:
+        MONGO_CONNECTIONS.inc(state="in_use")
+
+    def connection_checked_in(self, event: monitoring.ConnectionCheckedInEvent) -> None:
+        MONGO_CONNECTIONS.inc(-1, state="in_use")
+
+    def connection_check_out_failed(self, event: monitoring.ConnectionCheckOutFailedEvent) -> None:
+        pass
+
+    def connection_check_out_started(self, event: monitoring.ConnectionCheckOutStartedEvent) -> None:
+        pass
+
+    def connection_ready(self, event: monitoring.ConnectionReadyEvent) -> None:
+        pass
+
+    def pool_created(self, event: monitoring.PoolCreatedEvent) -> None:
+        pass
+
+    def pool_ready(self, event: monitoring.PoolReadyEvent) -> None:
+        pass
+
+    def pool_cleared(self, event: monitoring.PoolClearedEvent) -> None:
+        pass
+
+    def pool_closed(self, event: monitoring.PoolClosedEvent) -> None:
+        pass
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler: Handler) -> web.StreamResponse:
+    """Measure the latency and the size of the HTTP requests and replies."""
+    start = time.perf_counter()
+    # Use the route instead of the path, so each large object isn't a different label
+    resource = request.match_info.route.resource
+    path = request.path if resource is None else resource.canonical
+    response: Optional[web.StreamResponse] = None
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as ex:
+        status = ex.status
+        raise
+    finally:
+        HTTP_LATENCY.observe(
+            time.perf_counter() - start, path=path, method=request.method, status=str(status))
+        HTTP_REQUEST_SIZE.observe(request.content_length or 0, path=path)
+        # The size of the streamed replies is unknown until they are sent
+        if response is not None and response.content_length is not None:
+            HTTP_RESPONSE_SIZE.observe(response.content_length, path=path)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """Reply with the metrics in the Prometheus text format."""
+    return web.Response(body=REGISTRY.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+
+class SharedMetrics:
+    """Report the metrics of all the workers of the server, sharing them through ``directory``.
+
+    Each worker writes a snapshot of its metrics every ``interval`` seconds and its
+    :meth:`handler` adds the latest snapshots of the other workers to its own metrics.
+    The snapshots not updated in :data:`STALE_INTERVALS` intervals belong to workers that
+    have exited: their counters and histograms are still added, so the totals don't
+    decrease when a worker is restarted, but not their gauges.
+    """
+
+    def __init__(self, directory: Path, interval: float = 1.0, registry: MetricsRegistry = REGISTRY) -> None:
+        self.directory = directory
+        self.interval = interval
+        self.registry = registry
+
+    @property
+    def path(self) -> Path:
+        """File with the snapshot of the current process."""
+        return self.directory / f"{os.getpid()}.json"
+
+    def write(self) -> None:
+        """Replace the snapshot of the current process."""
+        path = self.path
+        partial = path.with_suffix(".tmp")
+        partial.write_text(json.dumps(self.registry.snapshot()))
+        os.replace(partial, path)
+
+    def read(self) -> Tuple[List[Dict[str, List[Any]]], List[Dict[str, List[Any]]]]:
+        """Return the snapshots of the other running workers and of the exited ones."""
+        live: List[Dict[str, List[Any]]] = []
+        exited: List[Dict[str, List[Any]]] = []
+        deadline = time.time() - STALE_INTERVALS * self.interval
+        for path in self.directory.glob("*.json"):
+            if path == self.path:
+                continue
+            try:
+                updated = path.stat().st_mtime
+                snapshot = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+            (live if updated >= deadline else exited).append(snapshot)
+        return live, exited
+
+    def render(self) -> str:
+        """Return the metrics of all the workers in the Prometheus text format."""
+        return self.registry.render(*self.read())
+
+    async def handler(self, request: web.Request) -> web.Response:
+        """Reply with the metrics of all the workers."""
+        return web.Response(body=self.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    async def share_periodically(self) -> None:
+        """Write the snapshot of the current process every ``interval`` seconds."""
+        while True:
+            self.write()
+            await asyncio.sleep(self.interval)
+
+
+async def measure_event_loop_lag(interval: float = 1.0, histogram: Histogram = EVENT_LOOP_LAG) -> None:
+    """Periodically measure how late the event loop wakes up from a sleep of ``interval`` seconds."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, loop.time() - start - interval))
@@ -3,34 +3,101 @@
 API
 ---
 .. autoclass:: DatabaseConfig
+.. autoclass:: PropertyStorage
+   :members:
+.. autoclass:: AsyncDatabase
+   :members:
+.. autoclass:: AsyncCollection
+   :members:
 .. autofunction:: connect_to_db
 
 """
 
-__all__ = ["USERS_COLLECTION", "DatabaseConfig", "connect_to_db"]
+__all__ = ["DATABASE_NAME", "IMPORTS_COLLECTION", "USERS_COLLECTION", "AsyncCollection", "AsyncDatabase",
+           "DatabaseConfig", "PropertyStorage", "connect_to_db"]
 
 
+import asyncio
+import json
 import logging
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import Dict, List, NamedTuple, Optional
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, TypeVar, Union
 
 import pandas as pd
 from pymongo import MongoClient
 from pymongo.collection import Collection
 from pymongo.database import Database
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
 
+from .profiling import section
+
+DATABASE_NAME = "properties"
 USERS_COLLECTION = "authenticated_users"
+IMPORTS_COLLECTION = "import_checkpoints"
+
+#: Maximum number of MongoDB operations running concurrently
+DEFAULT_MONGO_THREADS = 32
+
+T = TypeVar("T")
 
 logger = logging.getLogger(__name__)
 
 
 class DatabaseConfig(NamedTuple):
-    """Data to store the database configuration."""
+    """Data to store the database configuration.
+
+    The options left as None take the default value of the driver.
+    """
     db_name: str
     host: Optional[str] = "localhost"
     port: Optional[int] = 27017
     username: Optional[str] = None
     password: Optional[str] = None
+    #: Maximum number of connections of the pool
+    max_pool_size: Optional[int] = None
+    #: Connections of the pool kept open even when idle
+    min_pool_size: Optional[int] = None
+    #: Seconds to find an available server before failing an operation
+    server_selection_timeout: Optional[float] = None
+    #: Seconds to open a connection
+    connect_timeout: Optional[float] = None
+    #: Seconds to wait for the reply of an operation
+    socket_timeout: Optional[float] = None
+    #: Comma separated list of wire protocol compressors, like ``zstd,zlib``
+    compressors: Optional[str] = None
+    #: Write concern of the operations, a number of nodes or ``majority``
+    write_concern: Optional[Union[int, str]] = None
+
+
+class PropertyStorage(NamedTuple):
+    """How the data of the properties is stored in the database."""
+    #: Store the data as a sub-document instead of the JSON string sent by the client,
+    #: which allows the database to merge the data of a property atomically
+    native_data: bool = False
+    #: Maximum number of results kept by the APPEND duplication policy, all of them by default
+    max_history: Optional[int] = None
+
+    def encode(self, prop_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Return the property with its data in the storage format.
+
+        Raises
+        ------
+        ValueError
+            If the data must be stored as a document but it isn't a JSON object
+        """
+        data = prop_data.get("data")
+        if self.native_data and isinstance(data, str):
+            try:
+                document = json.loads(data)
+            except ValueError:
+                document = None
+            if not isinstance(document, dict):
+                raise ValueError(f"The data of the property with id {prop_data.get('_id')} is not a JSON object")
+            return {**prop_data, "data": document}
+
+        return prop_data
 
 
 def connect_to_db(db_config: DatabaseConfig) -> Database:
@@ -46,13 +113,113 @@ def connect_to_db(db_config: DatabaseConfig) -> Database:
         Database
 
     """
+    seconds = {
+        "serverSelectionTimeoutMS": db_config.server_selection_timeout,
+        "connectTimeoutMS": db_config.connect_timeout,
+        "socketTimeoutMS": db_config.socket_timeout}
+    options: Dict[str, Any] = {
+        "maxPoolSize": db_config.max_pool_size,
+        "minPoolSize": db_config.min_pool_size,
+        "compressors": db_config.compressors,
+        "w": db_config.write_concern,
+        **{key: value * 1000 for key, value in seconds.items() if value is not None}}
     client = MongoClient(
         host=db_config.host, port=db_config.port,
-        username=db_config.username, password=db_config.password)
+        username=db_config.username, password=db_config.password,
+        **{key: value for key, value in options.items() if value is not None})
 
     return client[db_config.db_name]
 
 
+async def run_in_executor(executor: Executor, fun: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Call the blocking driver function ``fun`` in ``executor``, profiled as a Mongo operation."""
+    loop = asyncio.get_running_loop()
+    with section("mongo"):
+        return await loop.run_in_executor(executor, partial(fun, *args, **kwargs))
+
+
+class AsyncCollection:
+    """Awaitable interface to a :class:`pymongo.collection.Collection`.
+
+    The blocking driver calls run in a bounded thread pool,
+    so they never stall the event loop.
+    """
+
+    def __init__(self, collection: Collection, executor: Executor) -> None:
+        self.collection = collection
+        self.executor = executor
+
+    async def _run(self, fun: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Call ``fun`` in the executor and wait for the result."""
+        return await run_in_executor(self.executor, fun, *args, **kwargs)
+
+    async def find_one(self, *args: Any, **kwargs: Any) -> Optional[Dict[str, Any]]:
+        """Return a single document or None."""
+        return await self._run(self.collection.find_one, *args, **kwargs)
+
+    async def find(self, *args: Any, **kwargs: Any) -> List[Dict[str, Any]]:
+        """Return all the documents matching the query."""
+        return await self._run(lambda: list(self.collection.find(*args, **kwargs)))
+
+    async def insert_one(self, *args: Any, **kwargs: Any) -> Any:
+        """Insert a single document."""
+        return await self._run(self.collection.insert_one, *args, **kwargs)
+
+    async def update_one(self, *args: Any, **kwargs: Any) -> Any:
+        """Update a single document."""
+        return await self._run(self.collection.update_one, *args, **kwargs)
+
+    async def replace_one(self, *args: Any, **kwargs: Any) -> Any:
+        """Replace a single document."""
+        return await self._run(self.collection.replace_one, *args, **kwargs)
+
+    async def bulk_write(self, *args: Any, **kwargs: Any) -> Any:
+        """Send a batch of write operations."""
+        return await self._run(self.collection.bulk_write, *args, **kwargs)
+
+    async def find_one_and_update(self, *args: Any, **kwargs: Any) -> Optional[Dict[str, Any]]:
+        """Atomically update a single document and return it."""
+        return await self._run(self.collection.find_one_and_update, *args, **kwargs)
+
+    async def create_index(self, *args: Any, **kwargs: Any) -> str:
+        """Create an index unless it already exists and return its name."""
+        return await self._run(self.collection.create_index, *args, **kwargs)
+
+    async def estimated_document_count(self) -> int:
+        """Return the number of documents using the collection metadata."""
+        return await self._run(self.collection.estimated_document_count)
+
+
+class AsyncDatabase:
+    """Awaitable interface to a :class:`pymongo.database.Database`.
+
+    All the collections share an executor with at most ``max_workers`` threads,
+    bounding the number of Mongo operations in flight.
+
+    The read-only queries use :attr:`reader`, which reads from the servers chosen by
+    ``read_preference`` (like ``secondaryPreferred``) using the same client and executor.
+    By default it is the database itself, reading from the primary.
+    """
+
+    def __init__(
+            self, database: Database, max_workers: int = DEFAULT_MONGO_THREADS,
+            read_preference: Optional[str] = None, executor: Optional[Executor] = None) -> None:
+        self.database = database
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="ceiba-mongo")
+        self.reader = self
+        if read_preference is not None and read_preference != "primary":
+            mode = make_read_preference(read_pref_mode_from_name(read_preference), None)
+            self.reader = AsyncDatabase(database.with_options(read_preference=mode), executor=self.executor)
+
+    def __getitem__(self, name: str) -> AsyncCollection:
+        return AsyncCollection(self.database[name], self.executor)
+
+    async def list_collection_names(self) -> List[str]:
+        """Return the names of the collections in the database."""
+        return await run_in_executor(self.executor, self.database.list_collection_names)
+
+
 def store_dataframe_in_mongo(
         collection: Collection, path_csv: Path) -> List[int]:
     """Store a pandas dataframe in the database specified in `db_config`.
@@ -3,27 +3,36 @@
 API
 ---
 .. autofunction:: resolve_mutation_add_job
+.. autofunction:: resolve_mutation_add_jobs
 .. autofunction:: resolve_mutation_authentication
+.. autofunction:: resolve_mutation_report_jobs
+.. autofunction:: resolve_mutation_reserve_jobs
 .. autofunction:: resolve_mutation_update_job
 .. autofunction:: resolve_mutation_update_job_status
 .. autofunction:: resolve_mutation_update_property
 
 """
+import asyncio
 import json
 import logging
-import secrets
+from collections import Counter, defaultdict
 from datetime import datetime
-from typing import Any, Dict, Optional, Set
+from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple
 
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 from tartiflette import Resolver
-from pymongo.database import Database
-from pymongo.collection import Collection
 
+from .metrics import timed
 from .user_authentication import authenticate_username, is_user_authenticated
-from .mongo_interface import USERS_COLLECTION
+from .mongo_interface import USERS_COLLECTION, AsyncCollection, AsyncDatabase, PropertyStorage
+from .profiling import profiled
+from .query_resolvers import MAX_PAGE_SIZE, encode_data
+from .registry import record_changes, status_change
 
 
-__all__ = ["resolve_mutation_add_job", "resolve_mutation_update_job",
+__all__ = ["resolve_mutation_add_job", "resolve_mutation_add_jobs", "resolve_mutation_report_jobs",
+           "resolve_mutation_reserve_jobs", "resolve_mutation_update_job",
            "resolve_mutation_update_job_status", "resolve_mutation_update_property"]
 
 logger = logging.getLogger(__name__)
@@ -32,8 +41,13 @@ PROPERTY_MUTABLE_KEYWORDS = {"data", "input", "metadata", "large_objects"}
 JOB_MUTABLE_KEYWORDS = {"status", "user", "platform", "report_time", "schedule_time"}
 AUTHENTICATION_ERROR_MESSAGE = {"status": "FAILED", "text": "The user is not authenticated"}
 
+#: Query matching the properties whose data can be merged by the database, the data
+#: stored as JSON before enabling :attr:`PropertyStorage.native_data` can't
+MERGEABLE_DATA = {"$or": [{"data": {"$type": "object"}}, {"data": None}]}
+
 
 @Resolver("Mutation.authenticateUser")
+@timed
 async def resolve_mutation_authentication(
     parent: Optional[Any],
     args: Dict[str, Any],
@@ -61,28 +75,21 @@ async def resolve_mutation_authentication(
 """
     # Extract property data
     token = args['token']
-    known_user = authenticate_username(token)
+    known_user = await authenticate_username(token, ctx["github"])
     if known_user is None:
         return {"status": "FAILED", "text": "Invalid Token!"}
 
     database = ctx["mongodb"]
     # Check if the user is allowed to interact with the service
     collection = database[USERS_COLLECTION]
-    user_data = collection.find_one({"username": known_user})
-    if user_data is None:
+    user_data = await collection.find_one({"username": known_user})
+    if user_data is None or known_user in ctx["tokens"].denied:
         msg = f"User `{known_user}` doesn't have permissions to access the service"
         return {"status": "FAILED",
                 "text": msg}
 
-    # Update the token used to authenticate the client
-    reply_token = secrets.token_hex(16)
-
-    filter_name = {"username": known_user}
-    entry = {"token": reply_token, "username": known_user,
-             "time": datetime.now()}
-
-    # Insert new entry if not previously find
-    collection.replace_one(filter_name, entry)
+    # Sign a token that the client uses to authenticate the following requests
+    reply_token = ctx["tokens"].issue(known_user)
 
     cookie = json.dumps({"username": known_user, "token": reply_token})
 
@@ -90,6 +97,7 @@ async def resolve_mutation_authentication(
 
 
 @Resolver("Mutation.updateProperty")
+@timed
 async def resolve_mutation_update_property(
     parent: Optional[Any],
     args: Dict[str, Any],
@@ -117,20 +125,26 @@ async def resolve_mutation_update_property(
     """
     database = ctx["mongodb"]
     # Check if the user is authenticated
-    if not is_user_authenticated(args['cookie'], database):
+    if not is_user_authenticated(args['cookie'], ctx["tokens"]):
         return AUTHENTICATION_ERROR_MESSAGE
 
     # Extract property data
-    property_data = args['input']
+    try:
+        property_data = ctx["storage"].encode(args['input'])
+    except ValueError as ex:
+        return {"status": "FAILED", "text": str(ex)}
 
     # Update the following keywords
+    await ctx["indexes"].ensure(property_data["collection_name"])
     collection = database[property_data["collection_name"]]
-    update_entry(collection, property_data, PROPERTY_MUTABLE_KEYWORDS)
+    result = await update_entry(collection, property_data, PROPERTY_MUTABLE_KEYWORDS)
+    await record_changes(database, property_data["collection_name"], size=int(result.upserted_id is not None))
 
     return {"status": "DONE"}
 
 
 @Resolver("Mutation.createJob")
+@timed
 async def resolve_mutation_add_job(
     parent: Optional[Any],
     args: Dict[str, Any],
@@ -157,36 +171,100 @@ async def resolve_mutation_add_job(
     """
     database = ctx["mongodb"]
     # Check if the user is authenticated
-    if not is_user_authenticated(args['cookie'], database):
+    if not is_user_authenticated(args['cookie'], ctx["tokens"]):
         return AUTHENTICATION_ERROR_MESSAGE
 
     # Extract property data
-    property_data = args['input'].pop('property')
+    try:
+        property_data = ctx["storage"].encode(args['input'].pop('property'))
+    except ValueError as ex:
+        return {"status": "FAILED", "text": str(ex)}
     property_collection = property_data["collection_name"]
     jobs_collection = database[f"jobs_{property_collection}"]
+    await ensure_indexes(ctx, property_collection)
 
     # Try to store property.
-    store_property(database, property_data)
+    new_property = await store_property(database, property_data)
 
-    # Search if the job already exists. If the job already exists return its identifier
-    query = {"property._id": property_data["_id"]}
-
-    job_data = jobs_collection.find_one(query)
-    if job_data is None:
-        # Extract job metadataa
-        job_data = args['input']
-        job_data["property"] = {
-            key: property_data[key] for key in ("_id", "metadata", "collection_name")}
-        # Save jobs into the database
-        job_id = jobs_collection.insert_one(job_data).inserted_id
-        msg = f"Stored job with id {job_id} into collection jobs_{property_data['collection_name']}"
+    # Extract job metadata
+    job_data = args['input']
+    job_data["property"] = {
+        key: property_data[key] for key in ("_id", "metadata", "collection_name")}
+
+    # Store the job unless there is already a job for the property, in which case return its identifier
+    old_job = await jobs_collection.find_one_and_update(
+        {"property._id": property_data["_id"]}, {"$setOnInsert": job_data}, projection={"_id": True},
+        upsert=True, return_document=ReturnDocument.BEFORE)
+    if old_job is None:
+        msg = f"Stored job with id {job_data['_id']} into collection jobs_{property_collection}"
     else:
-        msg = f"Job with id {job_data['_id']} is already in collection jobs_{property_data['collection_name']}"
+        msg = f"Job with id {old_job['_id']} is already in collection jobs_{property_collection}"
+    new_jobs = {job_data["status"]: 1} if old_job is None else None
+    await record_changes(database, property_collection, size=int(new_property), jobs=new_jobs)
+    ctx["notifier"].publish(property_collection, (new_jobs or {}).get("AVAILABLE", 0))
 
     return {"status": "DONE", "text": msg}
 
 
+@Resolver("Mutation.createJobs")
+@timed
+async def resolve_mutation_add_jobs(
+    parent: Optional[Any],
+    args: Dict[str, Any],
+    ctx: Dict[str, Any],
+    info: Dict[str, Any],
+) -> Dict[str, Any]:
+    """
+    Resolver in charge of creating a batch of jobs using bulk writes.
+
+    Properties and jobs that already exist are kept untouched, like in
+    :func:`resolve_mutation_add_job`.
+
+    Parameters
+    ----------
+    paren
+        initial value filled in to the engine `execute` method
+    args
+        computed arguments related to the field
+    ctx
+        context filled in at engine initialization
+    info
+        information related to the execution and field resolution
+
+    Returns
+    -------
+    Status message with the outcome of each job
+    """
+    database = ctx["mongodb"]
+    # Check if the user is authenticated
+    if not is_user_authenticated(args['cookie'], ctx["tokens"]):
+        return AUTHENTICATION_ERROR_MESSAGE
+
+    batches = group_by_collection(args["input"])
+
+    await asyncio.gather(*[ensure_indexes(ctx, name) for name in batches])
+
+    results: List[Dict[str, Any]] = [{} for _ in args["input"]]
+    await asyncio.gather(*[
+        store_jobs_batch(database, name, batch, results, ctx["storage"]) for name, batch in batches.items()])
+
+    for name, batch in batches.items():
+        ctx["notifier"].publish(name, sum(
+            job["status"] == "AVAILABLE" and results[index]["status"] == "DONE" and not results[index]["duplicate"]
+            for index, job in batch))
+
+    created = sum(item["status"] == "DONE" and not item["duplicate"] for item in results)
+    duplicates = sum(item["status"] == "DONE" and item["duplicate"] for item in results)
+    failed = len(results) - created - duplicates
+    msg = f"Created {created} jobs, {duplicates} jobs were already stored and {failed} failed"
+    logger.info(msg)
+
+    return {"status": "DONE" if failed == 0 else "FAILED", "text": msg,
+            "created": created, "duplicates": duplicates, "results": results}
+
+
 @Resolver("Mutation.updateJob")
+@timed
 async def resolve_mutation_update_job(
     parent: Optional[Any],
     args: Dict[str, Any],
@@ -213,7 +291,7 @@ async def resolve_mutation_update_job(
     """
     database = ctx["mongodb"]
     # Check if the user is authenticated
-    if not is_user_authenticated(args['cookie'], database):
+    if not is_user_authenticated(args['cookie'], ctx["tokens"]):
         return AUTHENTICATION_ERROR_MESSAGE
 
     msg = ""
@@ -221,27 +299,28 @@ async def resolve_mutation_update_job(
     # Extract property data and Filter non-null data
     job_data = {key: val for key, val in args["input"].items() if val is not None}
     prop_data = {key: val for key, val in job_data.pop("property").items() if val is not None}
+    try:
+        prop_data = ctx["storage"].encode(prop_data)
+    except ValueError as ex:
+        return {"status": "FAILED", "text": str(ex)}
 
     # Extract collections
     jobs_collection = database[f"jobs_{prop_data['collection_name']}"]
     prop_collection = database[prop_data["collection_name"]]
 
-    # Check that the job exists
-    old_job = check_entry_existence(jobs_collection, job_data["_id"])
-    # Report new data
-    if old_job["status"] != "DONE" and job_data['status'] == "DONE":
-        update_entry(jobs_collection, job_data, JOB_MUTABLE_KEYWORDS)
-
-    # Check that the property exists
-    old_prop = check_entry_existence(prop_collection, prop_data["_id"])
+    # Report new data and retrieve the previous state of the job
+    old_job = await report_job(jobs_collection, job_data)
 
     # Update property state
     if old_job['status'] != "DONE" and job_data['status'] == "DONE":
-        update_entry(prop_collection, prop_data, PROPERTY_MUTABLE_KEYWORDS)
+        # The job is already DONE, even if its property has been deleted in the meanwhile
+        await record_changes(
+            database, prop_data["collection_name"], jobs=status_change(old_job["status"], "DONE"))
+        await update_existing_entry(prop_collection, *entry_update(prop_data, PROPERTY_MUTABLE_KEYWORDS))
         msg = f"""The property with id {prop_data['_id']}, has been added to collection {prop_data['collection_name']}"""
     # There is a new job
     elif old_job['status'] == "DONE" and job_data['status'] == "DONE":
-        handle_duplication(prop_collection, prop_data, old_prop, args["duplication_policy"])
+        await handle_duplication(prop_collection, prop_data, args["duplication_policy"], ctx["storage"])
         msg = f"""Properties with id: {prop_data['_id']} have been previously reported.
 The new properties are handled using the {args['duplication_policy']} duplication policy"""
 
@@ -251,7 +330,58 @@ The new properties are handled using the {args['duplication_policy']} duplicatio
     return {"status": "DONE", "text": msg}
 
 
+@Resolver("Mutation.reportJobs")
+@timed
+async def resolve_mutation_report_jobs(
+    parent: Optional[Any],
+    args: Dict[str, Any],
+    ctx: Dict[str, Any],
+    info: Dict[str, Any],
+) -> Dict[str, Any]:
+    """
+    Resolver in charge of reporting the results of a batch of jobs.
+
+    Each job is moved to DONE with an atomic update and the properties are updated with
+    a bulk write per collection, applying the rules of :func:`resolve_mutation_update_job` to each job.
+
+    Parameters
+    ----------
+    paren
+        initial value filled in to the engine `execute` method
+    args
+        computed arguments related to the field
+    ctx
+        context filled in at engine initialization
+    info
+        information related to the execution and field resolution
+
+    Returns
+    -------
+    Status message with the outcome of each job
+    """
+    database = ctx["mongodb"]
+    # Check if the user is authenticated
+    if not is_user_authenticated(args['cookie'], ctx["tokens"]):
+        return AUTHENTICATION_ERROR_MESSAGE
+
+    batches = group_by_collection(args["input"])
+
+    results: List[Dict[str, Any]] = [{} for _ in args["input"]]
+    reported = await asyncio.gather(*[
+        report_jobs_batch(database, name, batch, args.get("duplication_policy"), results, ctx["storage"])
+        for name, batch in batches.items()])
+
+    created = sum(reported)
+    failed = sum(item["status"] == "FAILED" for item in results)
+    duplicates = sum(item["status"] == "DONE" and item["duplicate"] for item in results)
+    msg = f"Reported {created} new results, {duplicates} duplicated results and {failed} failures"
+
+    return {"status": "DONE" if failed == 0 else "FAILED", "text": msg,
+            "created": created, "duplicates": duplicates, "results": results}
+
+
 @Resolver("Mutation.updateJobStatus")
+@timed
 async def resolve_mutation_update_job_status(
         parent: Optional[Any],
         args: Dict[str, Any],
@@ -277,70 +407,429 @@ async def resolve_mutation_update_job_status(
     """
     database = ctx["mongodb"]
     # Check if the user is authenticated
-    if not is_user_authenticated(args['cookie'], database):
+    if not is_user_authenticated(args['cookie'], ctx["tokens"]):
         return AUTHENTICATION_ERROR_MESSAGE
 
     # Extract property data
     job_data = args['input']
     jobs_collection = database[f"jobs_{job_data['collection_name']}"]
 
-    # Retrieve the job
-    check_entry_existence(jobs_collection, job_data["_id"])
-
     # Update job status
-    update_entry(jobs_collection, job_data, JOB_MUTABLE_KEYWORDS)
+    query, update = entry_update(job_data, JOB_MUTABLE_KEYWORDS)
+    old_job = await jobs_collection.find_one_and_update(
+        query, update, projection={"status": True}, return_document=ReturnDocument.BEFORE)
+    if old_job is None:
+        raise RuntimeError(f"There is not element with id: {job_data['_id']} in the database!")
+    changes = status_change(old_job["status"], job_data["status"])
+    await record_changes(database, job_data['collection_name'], jobs=changes)
+    ctx["notifier"].publish(job_data['collection_name'], changes.get("AVAILABLE", 0))
 
     return {"status": "DONE"}
 
 
-def handle_duplication(
-        collection: Collection, prop_data: Dict[str, Any], old_prop: Dict[str, Any],
-        duplication_policy: str) -> None:
-    """Take care of the duplicated data following the user policy."""
+@Resolver("Mutation.reserveJobs")
+@timed
+async def resolve_mutation_reserve_jobs(
+        parent: Optional[Any],
+        args: Dict[str, Any],
+        ctx: Dict[str, Any],
+        info: Dict[str, Any]) -> Dict[str, Any]:
+    """Resolver in charge of atomically reserving available jobs for a worker.
+
+    Each job is claimed with a find-and-modify operation, therefore
+    concurrent workers never receive the same job. A request reserves
+    at most :data:`ceiba.query_resolvers.MAX_PAGE_SIZE` jobs.
+
+    Parameters
+    ----------
+    paren
+        initial value filled in to the engine `execute` method
+    args
+        computed arguments related to the field
+    ctx
+        context filled in at engine initialization
+    info
+        information related to the execution and field resolution
+
+    Returns
+    -------
+    Status message and the reserved jobs
+
+    """
+    database = ctx["mongodb"]
+    # Check if the user is authenticated
+    if not is_user_authenticated(args['cookie'], ctx["tokens"]):
+        return AUTHENTICATION_ERROR_MESSAGE
+
+    jobs_collection = database[f"jobs_{args['collection_name']}"]
+    update = {"$set": {
+        "status": "RESERVED", "user": args["worker"],
+        "schedule_time": datetime.now().timestamp()}}
+
+    max_jobs = min(args["max_jobs"], MAX_PAGE_SIZE)
+    jobs: List[Dict[str, Any]] = []
+    while len(jobs) < max_jobs:
+        job = await jobs_collection.find_one_and_update(
+            {"status": "AVAILABLE"}, update, sort=[("_id", ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+        if job is None:
+            break
+        jobs.append(job)
+
+    await record_changes(
+        database, args["collection_name"], jobs={"AVAILABLE": -len(jobs), "RESERVED": len(jobs)})
+
+    return {"status": "DONE", "text": f"Reserved {len(jobs)} jobs", "jobs": jobs}
+
+
+async def ensure_indexes(ctx: Dict[str, Any], collection_name: str) -> None:
+    """Create the indexes of a properties collection and its jobs the first time they are seen."""
+    indexes = ctx["indexes"]
+    await asyncio.gather(indexes.ensure(collection_name), indexes.ensure(f"jobs_{collection_name}"))
+
+
+async def handle_duplication(
+        collection: AsyncCollection, prop_data: Dict[str, Any], duplication_policy: str,
+        storage: PropertyStorage) -> None:
+    """Take care of the duplicated data following the user policy.
+
+    Only the MERGE policy of the data stored as JSON needs to read the stored property.
+    The data stored as a document is merged by the database, unless the property
+    was stored as JSON before enabling :attr:`PropertyStorage.native_data`,
+    in which case it is read and stored again as a document.
+    """
+    old_prop: Dict[str, Any] = {}
+    if duplication_policy == "MERGE" and storage.native_data:
+        # Without the stored data, the merged data is the new data
+        stages = duplication_stages(prop_data, prop_data, duplication_policy, storage)
+        result = await collection.update_one({"_id": prop_data["_id"], **MERGEABLE_DATA}, stages)
+        if result.matched_count:
+            return
+    if duplication_policy == "MERGE":
+        old_prop = await check_entry_existence(collection, prop_data["_id"])
+    new_prop = resolve_duplication(prop_data, old_prop, duplication_policy)
+    if new_prop is not None:
+        stages = duplication_stages(prop_data, new_prop, duplication_policy, storage)
+        await update_existing_entry(collection, {"_id": prop_data["_id"]}, stages)
+
+
+def resolve_duplication(
+        prop_data: Dict[str, Any], old_prop: Dict[str, Any],
+        duplication_policy: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Return the property to store following the user policy or None to keep the old one."""
     if duplication_policy == "OVERWRITE":
-        update_entry(collection, prop_data, PROPERTY_MUTABLE_KEYWORDS)
+        return prop_data
+    elif duplication_policy == "MERGE" and isinstance(prop_data.get("data"), dict):
+        return {**prop_data, "data": {**prop_data["data"], **stored_document(old_prop.get("data"))}}
     elif duplication_policy == "MERGE":
-        prop_data['data'] = merge_json_data(prop_data['data'], old_prop['data'])
-        update_entry(collection, prop_data, PROPERTY_MUTABLE_KEYWORDS)
+        # The data may have been stored as a document by a server using native_data
+        return {**prop_data, "data": merge_json_data(prop_data['data'], encode_data(old_prop['data']))}
     elif duplication_policy == "APPEND":
-        raise NotImplementedError("Append policy has not been implemented")
+        history = old_prop.get("data_history", [])
+        new_prop = {key: val for key, val in prop_data.items() if key != "data"}
+        return {**new_prop, "data_history": history + [prop_data.get("data")]}
+
+    return None
 
 
-def check_entry_existence(collection: Collection, identifier: int) -> Dict[str, Any]:
+async def check_entry_existence(collection: AsyncCollection, identifier: int) -> Dict[str, Any]:
     """Search for a jobs in the ``database`` raise error if no job is found."""
     query = {"_id": identifier}
-    job = collection.find_one(query)
+    job = await collection.find_one(query)
     if job is None:
         raise RuntimeError(f"There is not element with id: {identifier} in the database!")
 
     return job
 
 
-def update_entry(
-        collection: Collection, entry: Dict[str, Any],
-        mutable_keywords: Set[str]) -> None:
+async def report_job(collection: AsyncCollection, job_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Store the job data if the job is done for the first time and return its previous state.
+
+    The check of the previous status and the update run as a single atomic operation.
+    """
+    query = {"_id": job_data["_id"]}
+    projection = {"status": True}
+    if job_data["status"] == "DONE":
+        _, update = entry_update(job_data, JOB_MUTABLE_KEYWORDS)
+        first_time = {"$ne": ["$status", "DONE"]}
+        pipeline = [{"$set": {
+            key: {"$cond": [first_time, {"$literal": val}, f"${key}"]}
+            for key, val in update["$set"].items()}}]
+        old_job = await collection.find_one_and_update(
+            query, pipeline, projection=projection, return_document=ReturnDocument.BEFORE)
+    else:
+        old_job = await collection.find_one(query, projection)
+
+    if old_job is None:
+        raise RuntimeError(f"There is not element with id: {job_data['_id']} in the database!")
+
+    return old_job
+
+
+async def update_existing_entry(
+        collection: AsyncCollection, query: Dict[str, Any], update: Any) -> None:
+    """Update the entry matching ``query``, raise error if there is no such entry."""
+    result = await collection.update_one(query, update)
+    if result.matched_count == 0:
+        raise RuntimeError(f"There is not element with id: {query['_id']} in the database!")
+
+
+async def update_entry(
+        collection: AsyncCollection, entry: Dict[str, Any],
+        mutable_keywords: Set[str]) -> Any:
     """Update an entry in the collection changing only the allow keywords."""
+    query, update = entry_update(entry, mutable_keywords)
+    return await collection.update_one(query, update, upsert=True)
+
+
+def entry_update(
+        entry: Dict[str, Any], mutable_keywords: Set[str]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Return the query and the update changing only the allow keywords of ``entry``."""
     entry_updates = {key: entry[key] for key in entry.keys() if key in mutable_keywords}
-    query = {"_id": entry["_id"]}
-    update = {"$set": entry_updates}
-    collection.update_one(query, update, upsert=True)
+    return {"_id": entry["_id"]}, {"$set": entry_updates}
 
 
-def store_property(database: Database, property_data: Dict[str, Any]) -> None:
+def duplication_stages(
+        prop_data: Dict[str, Any], new_prop: Dict[str, Any], duplication_policy: Optional[str],
+        storage: PropertyStorage) -> List[Dict[str, Any]]:
+    """Return the update pipeline storing a property that has been reported before.
+
+    The data stored as a sub-document is merged by the database in a single atomic update,
+    keeping the stored values of the keys present in both the old and the new data.
+    The database can't parse the data stored as JSON, which is replaced by the data
+    of ``new_prop``, merged by :func:`resolve_duplication` with the stored JSON.
+    The APPEND policy keeps the stored data and atomically appends the new data to
+    the ``data_history`` list, keeping at most :attr:`PropertyStorage.max_history` items.
+    Otherwise ``new_prop`` is stored as it is.
+    """
+    _, update = entry_update(new_prop, PROPERTY_MUTABLE_KEYWORDS)
+    fields: Dict[str, Any] = {key: {"$literal": val} for key, val in update["$set"].items()}
+    if duplication_policy == "MERGE" and storage.native_data:
+        merged = {"$mergeObjects": [{"$literal": prop_data.get("data") or {}}, {"$ifNull": ["$data", {}]}]}
+        fields["data"] = {"$cond": [
+            {"$in": [{"$type": "$data"}, ["object", "null", "missing"]]}, merged,
+            {"$literal": new_prop.get("data") or {}}]}
+    elif duplication_policy == "APPEND":
+        history: Dict[str, Any] = {"$concatArrays": [
+            {"$ifNull": ["$data_history", []]}, [{"$literal": prop_data.get("data")}]]}
+        fields["data_history"] = history if storage.max_history is None else {
+            "$slice": [history, -storage.max_history]}
+
+    return [{"$set": fields}]
+
+
+async def store_property(database: AsyncDatabase, property_data: Dict[str, Any]) -> bool:
     """Store property if not already available in the database.
 
     If a property with the same identifier exists
-    then return it without modifying the existing property.
+    then it is kept without modification.
+
+    Returns
+    -------
+    Whether the property has been stored
+
     """
-    property_collection = database[property_data["collection_name"]]
+    collection_name = property_data["collection_name"]
     index = property_data["_id"]
-    query = {"_id": index}
-    prop = property_collection.find_one(query)
-    if prop is None:
-        property_collection.insert_one(property_data)
-        logger.info(f"Stored property with id {index} into collection {property_collection}")
+    result = await database[collection_name].update_one(
+        {"_id": index}, {"$setOnInsert": property_data}, upsert=True)
+    if result.upserted_id is None:
+        return False
+
+    logger.info(f"Stored property with id {index} into collection {collection_name}")
+    return True
+
+
+async def store_jobs_batch(
+        database: AsyncDatabase, collection_name: str, batch: List[Tuple[int, Dict[str, Any]]],
+        results: List[Dict[str, Any]], storage: PropertyStorage) -> None:
+    """Insert the properties and jobs of a batch that are not already in the database.
+
+    The outcome of each job is written in ``results`` at the job's position in the batch.
+    """
+    # Positions in the batch of the jobs with valid properties and the errors of the other ones
+    valid: List[int] = []
+    invalid: Dict[int, str] = {}
+    property_operations = []
+    job_operations = {}
+    for k, (_, job) in enumerate(batch):
+        job_data = {key: val for key, val in job.items() if key != "property"}
+        try:
+            property_data = storage.encode(job["property"])
+        except ValueError as ex:
+            invalid[k] = str(ex)
+            continue
+        valid.append(k)
+        property_operations.append(
+            UpdateOne({"_id": property_data["_id"]}, {"$setOnInsert": property_data}, upsert=True))
+        job_data["property"] = {
+            key: property_data[key] for key in ("_id", "metadata", "collection_name")}
+        job_operations[k] = UpdateOne(
+            {"property._id": property_data["_id"]}, {"$setOnInsert": job_data}, upsert=True)
+
+    new_properties, errors = await run_bulk_write(database[collection_name], property_operations)
+    property_errors = {**invalid, **{valid[position]: error for position, error in errors.items()}}
+    # Do not create the jobs whose property could not be stored
+    pending = [k for k in range(len(batch)) if k not in property_errors]
+    inserted, job_errors = await run_bulk_write(
+        database[f"jobs_{collection_name}"], [job_operations[k] for k in pending])
+    new_jobs = Counter(batch[pending[position]][1]["status"] for position in inserted)
+    await record_changes(database, collection_name, size=len(new_properties), jobs=new_jobs)
+
+    for k, (index, job) in enumerate(batch):
+        results[index] = {"_id": job["_id"], "status": "DONE", "duplicate": False}
+        if k in property_errors:
+            results[index].update({"status": "FAILED", "text": property_errors[k]})
+    for position, k in enumerate(pending):
+        index = batch[k][0]
+        if position in job_errors:
+            results[index].update({"status": "FAILED", "text": job_errors[position]})
+        elif position not in inserted:
+            results[index]["duplicate"] = True
+
+
+async def report_jobs_batch(
+        database: AsyncDatabase, collection_name: str, batch: List[Tuple[int, Dict[str, Any]]],
+        duplication_policy: Optional[str], results: List[Dict[str, Any]], storage: PropertyStorage) -> int:
+    """Report the results of a batch of jobs.
+
+    Each job follows the same rules as :func:`resolve_mutation_update_job`: the job is moved
+    to DONE with the atomic update of :func:`report_job`, whose previous state tells whether
+    the report is the first one, even if other requests report the same job concurrently.
+    The outcome of each job is written in ``results`` at the job's position in the batch.
+    The updates of a property reported several times in the batch are chained in a single
+    update pipeline, and the properties are written with a single unordered bulk write.
+
+    Returns
+    -------
+    The number of jobs whose results are reported for the first time
 
+    """
+    jobs_collection = database[f"jobs_{collection_name}"]
+    prop_collection = database[collection_name]
+
+    # Extract property data and Filter non-null data
+    reports = []
+    for index, job in batch:
+        job_data = {key: val for key, val in job.items() if val is not None}
+        prop_data = {key: val for key, val in job_data.pop("property").items() if val is not None}
+        try:
+            reports.append((index, job_data, storage.encode(prop_data)))
+        except ValueError as ex:
+            results[index] = {"_id": job_data["_id"], "status": "FAILED", "text": str(ex)}
+
+    # Read the stored data of all the properties at once
+    old_props = await prop_collection.find(
+        {"_id": {"$in": [prop["_id"] for _, _, prop in reports]}}, {"data": True, "data_history": True})
+    known_props = {prop["_id"]: prop for prop in old_props}
+
+    # Report each job once, using its first DONE report in the batch if there is any
+    first_reports: Dict[int, Dict[str, Any]] = {}
+    for _, job_data, prop_data in reports:
+        first = first_reports.get(job_data["_id"])
+        if prop_data["_id"] in known_props and (
+                first is None or (first["status"] != "DONE" and job_data["status"] == "DONE")):
+            first_reports[job_data["_id"]] = job_data
+    outcomes = await asyncio.gather(
+        *[report_job(jobs_collection, job_data) for job_data in first_reports.values()],
+        return_exceptions=True)
+    old_jobs: Dict[int, Any] = dict(zip(first_reports, outcomes))
+
+    reported = 0
+    changes: Counter = Counter()
+    # Positions in the batch and update pipeline of each property
+    prop_updates: Dict[int, Tuple[List[int], List[Dict[str, Any]]]] = {}
+    for index, job_data, prop_data in reports:
+        old_prop = known_props.get(prop_data["_id"])
+        if old_prop is None:
+            results[index] = {"_id": job_data["_id"], "status": "FAILED",
+                              "text": f"There is not element with id: {prop_data['_id']} in the database!"}
+            continue
+        old_job = old_jobs[job_data["_id"]]
+        if isinstance(old_job, Exception):
+            results[index] = {"_id": job_data["_id"], "status": "FAILED", "text": str(old_job)}
+            continue
+
+        results[index] = {"_id": job_data["_id"], "status": "DONE", "duplicate": False}
+        if job_data["status"] != "DONE":
+            results[index]["text"] = "Nothing new to report!"
+            continue
+        if job_data is first_reports[job_data["_id"]] and old_job["status"] != "DONE":
+            changes.update(status_change(old_job["status"], "DONE"))
+            new_prop: Optional[Dict[str, Any]] = prop_data
+            policy: Optional[str] = "OVERWRITE"
+            results[index]["text"] = f"The property with id {prop_data['_id']}, has been added"
+            reported += 1
+        else:
+            results[index]["duplicate"] = True
+            policy = duplication_policy
+            new_prop = resolve_duplication(prop_data, old_prop, duplication_policy)
+
+        if new_prop is not None:
+            positions, stages = prop_updates.setdefault(prop_data["_id"], ([], []))
+            positions.append(index)
+            stages.extend(duplication_stages(prop_data, new_prop, policy, storage))
+            # Later reports of the same property in the batch build on top of this one
+            known_props[prop_data["_id"]] = {**old_prop, **new_prop}
+
+    prop_operations = [
+        (positions, UpdateOne({"_id": identifier}, stages, upsert=True))
+        for identifier, (positions, stages) in prop_updates.items()]
+    upserted, prop_errors = await run_bulk_write(
+        prop_collection, [operation for _, operation in prop_operations])
+    for position, error in prop_errors.items():
+        for index in prop_operations[position][0]:
+            results[index].update({"status": "FAILED", "text": error})
+
+    # Count the jobs that have been moved to DONE by this request and the properties
+    # stored again because they have been deleted since they were read
+    await record_changes(database, collection_name, size=len(upserted), jobs=changes)
+
+    return reported
+
+
+def group_by_collection(jobs: List[Dict[str, Any]]) -> Dict[str, List[Tuple[int, Dict[str, Any]]]]:
+    """Group the jobs by the collection of their property, keeping their position in the batch."""
+    batches: DefaultDict[str, List[Tuple[int, Dict[str, Any]]]] = defaultdict(list)
+    for index, job in enumerate(jobs):
+        batches[job["property"]["collection_name"]].append((index, job))
+
+    return batches
+
+
+async def run_bulk_write(
+        collection: AsyncCollection, operations: List[UpdateOne]) -> Tuple[Set[int], Dict[int, str]]:
+    """Run the operations in a single unordered bulk write.
 
+    Returns
+    -------
+    The indices of the operations that inserted a document and the error of the failed ones
+
+    """
+    if not operations:
+        return set(), {}
+    try:
+        result = await collection.bulk_write(operations, ordered=False)
+        details = result.bulk_api_result
+    except BulkWriteError as ex:
+        details = ex.details
+
+    inserted = {entry["index"] for entry in details["upserted"]}
+    errors = {entry["index"]: entry["errmsg"] for entry in details["writeErrors"]}
+    return inserted, errors
+
+
+def stored_document(data: Any) -> Dict[str, Any]:
+    """Return the stored data of a property as a document, whether it is stored as JSON or as a document."""
+    if isinstance(data, str):
+        try:
+            data = json.loads(data)
+        except ValueError:
+            return {}
+    return data if isinstance(data, dict) else {}
+
+
+@profiled("merge_json_data")
 def merge_json_data(old_data: str, new_data: str) -> str:
     """Merge to dictionaries encoded as JSON."""
     if not old_data:
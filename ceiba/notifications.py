@@ -0,0 +1,150 @@
+"""Notify the waiting workers when new jobs become available.
+
+The mutations publish the number of new available jobs of a collection and each
+subscriber receives the jobs published since it last woke up, so a burst of
+new jobs wakes the subscribers only once.
+
+When the server runs several workers, each notifier sends its publications through
+a pipe to the supervisor, which relays them to the notifiers of the other workers,
+see :mod:`ceiba.workers`. The publications are only sent when the pipe can take them
+without blocking the event loop, the ones of the same collection waiting to be sent
+are added up.
+
+API
+---
+.. autoclass:: JobsNotifier
+   :members:
+
+"""
+
+__all__ = ["JobsNotifier"]
+
+import asyncio
+import logging
+import select
+from collections import Counter, defaultdict
+from multiprocessing.connection import Connection
+from typing import AsyncIterator, Awaitable, Callable, DefaultDict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class Waiter:
+    """Jobs published to a subscriber that it hasn't received yet."""
+
+    def __init__(self) -> None:
+        self.pending = 0
+        self.event = asyncio.Event()
+
+
+class JobsNotifier:
+    """Publisher of the jobs that become available in each collection.
+
+    Parameters
+    ----------
+    relay
+        Connection to the supervisor relaying the publications between the workers,
+        the notifier only reaches the subscribers of its own process without it
+
+    """
+
+    def __init__(self, relay: Optional[Connection] = None) -> None:
+        self.relay = relay
+        self.waiters: DefaultDict[str, Set[Waiter]] = defaultdict(set)
+        #: Jobs published by collection that haven't been sent to the supervisor yet
+        self.unsent: Counter = Counter()
+        self.writing = False
+
+    def publish(self, collection_name: str, count: int) -> None:
+        """Notify the subscribers of ``collection_name`` that ``count`` jobs became available."""
+        if count <= 0:
+            return
+        self.notify(collection_name, count)
+        if self.relay is not None:
+            self.unsent[collection_name] += count
+            self.flush()
+
+    def flush(self) -> None:
+        """Send the unsent publications to the supervisor if the pipe is writable.
+
+        Otherwise they are sent once the pipe becomes writable, so the event loop never blocks.
+        """
+        assert self.relay is not None
+        try:
+            _, writable, _ = select.select([], [self.relay], [], 0)
+            if writable:
+                while self.unsent:
+                    self.relay.send(self.unsent.popitem())
+        except OSError as ex:
+            logger.warning(f"Cannot relay the available jobs to the other workers: {ex}\n")
+            self.unsent.clear()
+
+        loop = asyncio.get_running_loop()
+        if self.unsent and not self.writing:
+            loop.add_writer(self.relay.fileno(), self.flush)
+            self.writing = True
+        elif not self.unsent and self.writing:
+            loop.remove_writer(self.relay.fileno())
+            self.writing = False
+
+    def notify(self, collection_name: str, count: int) -> None:
+        """Wake the subscribers of ``collection_name`` in this process."""
+        for waiter in self.waiters.get(collection_name, ()):
+            waiter.pending += count
+            waiter.event.set()
+
+    def start(self) -> None:
+        """Start receiving the jobs published by the other workers, if there is a relay."""
+        if self.relay is not None:
+            asyncio.get_running_loop().add_reader(self.relay.fileno(), self.receive)
+
+    def stop(self) -> None:
+        """Stop receiving and sending the jobs published by the workers."""
+        if self.relay is not None:
+            loop = asyncio.get_running_loop()
+            loop.remove_reader(self.relay.fileno())
+            if self.writing:
+                loop.remove_writer(self.relay.fileno())
+                self.writing = False
+
+    def receive(self) -> None:
+        """Notify the subscribers of the publications relayed from the other workers."""
+        assert self.relay is not None
+        try:
+            while self.relay.poll():
+                self.notify(*self.relay.recv())
+        except (EOFError, OSError):
+            # The supervisor is gone, the worker is about to be stopped
+            self.stop()
+
+    async def subscribe(
+            self, collection_name: str,
+            available: Optional[Callable[[], Awaitable[int]]] = None) -> AsyncIterator[int]:
+        """Yield the number of jobs that became available in ``collection_name`` since the last one.
+
+        Parameters
+        ----------
+        collection_name
+            Collection of the jobs
+        available
+            Coroutine function returning the jobs already available, which are yielded right away.
+            It is awaited once subscribed so no job published in the meantime is missed
+
+        """
+        waiter = Waiter()
+        self.waiters[collection_name].add(waiter)
+        try:
+            if available is not None:
+                count = await available()
+                waiter.pending += count
+                if waiter.pending > 0:
+                    waiter.event.set()
+            while True:
+                await waiter.event.wait()
+                waiter.event.clear()
+                count, waiter.pending = waiter.pending, 0
+                yield count
+        finally:
+            self.waiters[collection_name].discard(waiter)
+            if not self.waiters[collection_name]:
+                del self.waiters[collection_name]
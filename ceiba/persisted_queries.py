@@ -0,0 +1,107 @@
+"""Automatic persisted queries for the GraphQL endpoint.
+
+Instead of the full text of a query, the clients can send its SHA-256 hash in the
+``extensions`` of the request, following the protocol of Apollo::
+
+  {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": "<hash>"}}, "variables": {...}}
+
+If the server doesn't know the hash, it replies with a ``PERSISTED_QUERY_NOT_FOUND`` error
+and the client sends the request again including the ``query``, which is then stored.
+
+API
+---
+.. autoclass:: PersistedQueries
+   :members:
+.. autofunction:: persisted_queries_middleware
+
+"""
+
+__all__ = ["DEFAULT_PERSISTED_QUERIES", "PersistedQueries", "persisted_queries_middleware"]
+
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import web
+
+from .compression import with_body
+
+#: Maximum number of queries kept by the server
+DEFAULT_PERSISTED_QUERIES = 1024
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+NOT_FOUND = {"data": None, "errors": [{
+    "message": "PersistedQueryNotFound", "extensions": {"code": "PERSISTED_QUERY_NOT_FOUND"}}]}
+
+
+class PersistedQueries:
+    """Keep the text of the most recently used queries by their SHA-256 hash."""
+
+    def __init__(self, maxsize: int = DEFAULT_PERSISTED_QUERIES) -> None:
+        self.maxsize = maxsize
+        self.queries: "OrderedDict[str, str]" = OrderedDict()
+
+    def get(self, query_hash: str) -> Optional[str]:
+        """Return the query with ``query_hash`` or None if it is unknown."""
+        query = self.queries.get(query_hash)
+        if query is not None:
+            self.queries.move_to_end(query_hash)
+        return query
+
+    def register(self, query_hash: str, query: str) -> None:
+        """Store ``query`` if its hash is ``query_hash``, removing the least recently used query if full.
+
+        Raises
+        ------
+        ValueError
+            If ``query_hash`` is not the hash of ``query``
+        """
+        if hashlib.sha256(query.encode()).hexdigest() != query_hash:
+            raise ValueError("provided sha does not match query")
+        self.queries[query_hash] = query
+        self.queries.move_to_end(query_hash)
+        if len(self.queries) > self.maxsize:
+            self.queries.popitem(last=False)
+
+
+def error_reply(message: str) -> web.Response:
+    return web.json_response({"data": None, "errors": [{"message": message}]})
+
+
+def persisted_queries_middleware(store: PersistedQueries, endpoint: str = "/graphql") -> Callable:
+    """Create a middleware replacing the query hashes sent to ``endpoint`` by the queries in ``store``."""
+    @web.middleware
+    async def middleware(request: web.Request, handler: Handler) -> web.StreamResponse:
+        if request.path != endpoint or request.method != "POST":
+            return await handler(request)
+
+        body = await request.read()
+        # Avoid decoding the large requests that are not using persisted queries
+        if b'"persistedQuery"' not in body:
+            return await handler(request)
+        try:
+            content = json.loads(body)
+            query_hash = content["extensions"]["persistedQuery"]["sha256Hash"]
+        except (ValueError, KeyError, TypeError):
+            return await handler(request)
+
+        query = content.get("query")
+        if not isinstance(query_hash, str) or not isinstance(query, (str, type(None))):
+            return error_reply("The query and its sha256Hash must be strings")
+        if query is not None:
+            try:
+                store.register(query_hash, query)
+            except ValueError as ex:
+                return error_reply(str(ex))
+            return await handler(request)
+
+        query = store.get(query_hash)
+        if query is None:
+            return web.json_response(NOT_FOUND)
+        # Replace the body read by the handler with the request including the query
+        content["query"] = query
+        return await handler(with_body(request, json.dumps(content).encode()))
+
+    return middleware
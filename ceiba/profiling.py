@@ -0,0 +1,185 @@
+"""Measure where the time of each GraphQL request goes.
+
+Every request sent to the GraphQL endpoint accumulates the time spent and the number of calls
+of each section: parsing and validating the query, authenticating the user, merging
+the data, the MongoDB operations and each resolver. Then:
+
+* if the request has the ``X-Ceiba-Profile`` header, the breakdown is added
+  to the ``extensions`` of the GraphQL reply,
+* if the request takes longer than a threshold, the breakdown is written to the slow-operation log,
+* a sample of the requests can be profiled with :mod:`cProfile`, and with :mod:`tracemalloc`
+  if it is tracing, storing the results in a directory.
+
+API
+---
+.. autoclass:: RequestProfile
+   :members:
+.. autoclass:: ProfilingSettings
+.. autofunction:: section
+.. autofunction:: profiled
+.. autofunction:: profiling_middleware
+.. autofunction:: profiled_response
+
+"""
+
+__all__ = ["PROFILE_HEADER", "ProfilingSettings", "RequestProfile", "profiled", "profiled_response",
+           "profiling_middleware", "record", "section"]
+
+import cProfile
+import contextlib
+import functools
+import json
+import logging
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Awaitable, Callable, DefaultDict, Dict, Iterator, NamedTuple, Optional
+
+from aiohttp import web
+
+#: Header requesting the timing breakdown in the reply
+PROFILE_HEADER = "X-Ceiba-Profile"
+
+DEFAULT_SLOW_THRESHOLD = 1.0
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+slow_logger = logging.getLogger("ceiba.slow_operations")
+
+
+class RequestProfile:
+    """Time spent and number of calls of each section of a request.
+
+    The concurrent sections of a request add their times, so the sum of the
+    sections can be larger than the duration of the request.
+    """
+
+    def __init__(self, attach: bool = False) -> None:
+        self.attach = attach
+        self.start = time.perf_counter()
+        self.seconds: DefaultDict[str, float] = defaultdict(float)
+        self.calls: DefaultDict[str, int] = defaultdict(int)
+
+    def add(self, name: str, seconds: float) -> None:
+        """Add a call of ``seconds`` to the section ``name``."""
+        self.seconds[name] += seconds
+        self.calls[name] += 1
+
+    def report(self) -> Dict[str, Any]:
+        """Return the duration of the request so far and its breakdown by section."""
+        return {
+            "duration": time.perf_counter() - self.start,
+            "sections": {name: {"seconds": seconds, "calls": self.calls[name]}
+                         for name, seconds in sorted(self.seconds.items(), key=lambda x: -x[1])}}
+
+
+#: Profile of the request being handled
+CURRENT: ContextVar[Optional[RequestProfile]] = ContextVar("ceiba_profile", default=None)
+
+
+def record(name: str, seconds: float) -> None:
+    """Add a call of ``seconds`` to the section ``name`` of the current request, if any."""
+    profile = CURRENT.get()
+    if profile is not None:
+        profile.add(name, seconds)
+
+
+@contextlib.contextmanager
+def section(name: str) -> Iterator[None]:
+    """Measure the time spent in the block as part of the section ``name``."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def profiled(name: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Measure the calls to the decorated function as part of the section ``name``."""
+    def decorator(fun: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(fun)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with section(name):
+                return fun(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class ProfilingSettings(NamedTuple):
+    """Settings of the profiling of the requests."""
+    #: Requests slower than this number of seconds are logged
+    slow_threshold: float = DEFAULT_SLOW_THRESHOLD
+    #: Directory where the profiles of the sampled requests are stored, no profiles by default
+    directory: Optional[Path] = None
+    #: Fraction of the requests that are profiled
+    sample_rate: float = 0.0
+
+
+# cProfile can profile a single request at a time
+PROFILER_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def sampled_profile(settings: ProfilingSettings, request_id: str) -> Iterator[None]:
+    """Profile the block with cProfile, and tracemalloc if it is tracing, if the request is sampled.
+
+    Notice that cProfile also measures the other requests handled while the block awaits.
+    """
+    if settings.directory is None or random.random() >= settings.sample_rate \
+            or not PROFILER_LOCK.acquire(blocking=False):
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        yield
+    finally:
+        profiler.disable()
+        PROFILER_LOCK.release()
+        profiler.dump_stats(settings.directory / f"{request_id}.prof")
+        if tracemalloc.is_tracing():
+            tracemalloc.take_snapshot().dump(str(settings.directory / f"{request_id}.tracemalloc"))
+
+
+def profiling_middleware(settings: ProfilingSettings, endpoint: str = "/graphql") -> Callable:
+    """Create a middleware measuring the requests sent to ``endpoint``."""
+    if settings.directory is not None:
+        settings.directory.mkdir(parents=True, exist_ok=True)
+
+    @web.middleware
+    async def middleware(request: web.Request, handler: Handler) -> web.StreamResponse:
+        if request.path != endpoint:
+            return await handler(request)
+
+        profile = RequestProfile(attach=PROFILE_HEADER in request.headers)
+        token = CURRENT.set(profile)
+        request_id = uuid.uuid4().hex
+        status = 500
+        try:
+            with sampled_profile(settings, request_id):
+                response = await handler(request)
+            status = response.status
+            return response
+        finally:
+            CURRENT.reset(token)
+            report = profile.report()
+            if report["duration"] > settings.slow_threshold:
+                slow_logger.warning(json.dumps({
+                    "request_id": request_id, "path": request.path, "status": status,
+                    "request_size": request.content_length, **report}))
+
+    return middleware
+
+
+def profiled_response(request: web.Request, data: Dict[str, Any], ctx: Dict[str, Any]) -> web.Response:
+    """Add the profile of the request to the ``extensions`` of the reply, if it was requested."""
+    profile = CURRENT.get()
+    if profile is not None and profile.attach:
+        data = {**data, "extensions": {**data.get("extensions", {}), "profile": profile.report()}}
+    return web.json_response(data)
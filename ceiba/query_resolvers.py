@@ -1,22 +1,48 @@
 """Module to resolve the queries.
 
+The queries only read, therefore they use the reader of the database, which can
+be served by the secondaries of a replica set (see :class:`ceiba.mongo_interface.AsyncDatabase`).
+
 API
 ---
 
 .. autofunction:: resolver_query_properties
+.. autofunction:: resolver_query_property
+.. autofunction:: resolver_query_properties_by_metadata
+.. autofunction:: resolver_query_properties_by_ids
 .. autofunction:: resolver_query_jobs
+.. autofunction:: resolver_property_data
+.. autofunction:: resolver_property_data_history
+.. autofunction:: requested_projection
 
 """
-from typing import Any, Dict, List, Optional
+import json
+from typing import Any, Dict, List, Optional, Set, Tuple
 
-from more_itertools import take
+from pymongo import ASCENDING
 from tartiflette import Resolver
+from tartiflette.language.ast import FieldNode, FragmentSpreadNode, InlineFragmentNode
+
+from .metrics import timed
+from .registry import read_registry
+
 
+__all__ = ["resolver_query_jobs", "resolver_query_properties", "resolver_query_property",
+           "resolver_query_properties_by_ids", "resolver_query_properties_by_metadata",
+           "resolver_query_collections", "resolver_property_data", "resolver_property_data_history"]
 
-__all__ = ["resolver_query_jobs", "resolver_query_properties", "resolver_query_collections"]
+#: Maximum number of documents returned by a single request of the paginated queries
+MAX_PAGE_SIZE = 1000
+
+#: Sorting keys for the jobs, each one backed by an index (see :data:`ceiba.indexes.JOB_INDEXES`)
+JOB_ORDERINGS = {
+    "ID": [("_id", ASCENDING)],
+    "SCHEDULE_TIME": [("schedule_time", ASCENDING), ("_id", ASCENDING)]
+}
 
 
 @Resolver("Query.properties")
+@timed
 async def resolver_query_properties(
     parent: Optional[Any],
     args: Dict[str, Any],
@@ -39,14 +65,113 @@ async def resolver_query_properties(
 
     Returns
     -------
-    The list of all jobs with the given status.
+    A page with at most ``first`` properties with an identifier larger than ``after``.
+    """
+    limit = page_size(args.get("first"))
+    if limit == 0:
+        return []
+    collection = ctx["mongodb"].reader[args["collection_name"]]
+    query = page_query(args.get("after"))
+    return await collection.find(
+        query, requested_projection(info), sort=[("_id", ASCENDING)], limit=limit)
+
+
+@Resolver("Query.property")
+@timed
+async def resolver_query_property(
+    parent: Optional[Any],
+    args: Dict[str, Any],
+    ctx: Dict[str, Any],
+    info: Dict[str, Any],
+) -> Optional[Dict[str, Any]]:
+    """
+    Resolver in charge of returning the property with a given `metadata`.
+
+    The lookup uses the hashed index on the metadata (see :data:`ceiba.indexes.PROPERTY_INDEXES`).
+
+    Parameters
+    ----------
+    paren
+        initial value filled in to the engine `execute` method
+    args
+        computed arguments related to the field
+    ctx
+        context filled in at engine initialization
+    info
+        information related to the execution and field resolution
+
+    Returns
+    -------
+    The property or None if there is no property with such metadata.
+    """
+    collection = ctx["mongodb"].reader[args["collection_name"]]
+    return await collection.find_one({"metadata": args["metadata"]}, requested_projection(info))
+
+
+@Resolver("Query.propertiesByMetadata")
+@timed
+async def resolver_query_properties_by_metadata(
+    parent: Optional[Any],
+    args: Dict[str, Any],
+    ctx: Dict[str, Any],
+    info: Dict[str, Any],
+) -> List[Dict[str, Any]]:
+    """
+    Resolver in charge of returning the properties with any of the given `metadata`.
+
+    Parameters
+    ----------
+    paren
+        initial value filled in to the engine `execute` method
+    args
+        computed arguments related to the field
+    ctx
+        context filled in at engine initialization
+    info
+        information related to the execution and field resolution
+
+    Returns
+    -------
+    The properties found, sorted by identifier.
+    """
+    collection = ctx["mongodb"].reader[args["collection_name"]]
+    query = {"metadata": {"$in": args["metadata"]}}
+    return await collection.find(query, requested_projection(info), sort=[("_id", ASCENDING)])
+
+
+@Resolver("Query.propertiesByIds")
+@timed
+async def resolver_query_properties_by_ids(
+    parent: Optional[Any],
+    args: Dict[str, Any],
+    ctx: Dict[str, Any],
+    info: Dict[str, Any],
+) -> List[Dict[str, Any]]:
+    """
+    Resolver in charge of returning the properties with any of the given identifiers.
+
+    Parameters
+    ----------
+    paren
+        initial value filled in to the engine `execute` method
+    args
+        computed arguments related to the field
+    ctx
+        context filled in at engine initialization
+    info
+        information related to the execution and field resolution
+
+    Returns
+    -------
+    The properties found, sorted by identifier.
     """
-    collection = ctx["mongodb"][args["collection_name"]]
-    data = collection.find()
-    return list(data)
+    collection = ctx["mongodb"].reader[args["collection_name"]]
+    query = {"_id": {"$in": args["ids"]}}
+    return await collection.find(query, requested_projection(info), sort=[("_id", ASCENDING)])
 
 
 @Resolver("Query.jobs")
+@timed
 async def resolver_query_jobs(
     parent: Optional[Any],
     args: Dict[str, Any],
@@ -69,27 +194,35 @@ async def resolver_query_jobs(
 
     Returns
     -------
-    The list of all jobs with the given status.
+    A page with at most ``max_jobs`` jobs with the given status.
+
+    Raises
+    ------
+    ValueError
+        If ``after`` is used with an ordering other than the identifier, since
+        the identifier alone doesn't tell where the page ends.
     """
+    order_by = args.get("order_by") or "ID"
+    if order_by != "ID" and args.get("after") is not None:
+        raise ValueError(f"The jobs sorted by {order_by} can't be paginated with 'after'")
+    limit = page_size(args.get("max_jobs"))
+    if limit == 0:
+        return []
     # metadata to query the jobs
-    query = {"status": args["status"]}
+    query = {"status": args["status"], **page_query(args.get("after"))}
 
     property_collection = args["collection_name"]
     jobs_collection = f"jobs_{property_collection}"
-    collection = ctx["mongodb"][jobs_collection]
+    collection = ctx["mongodb"].reader[jobs_collection]
+    sort: List[Tuple[str, int]] = JOB_ORDERINGS[order_by]
 
     # Return the first available jobs
-    data = collection.find(query)
-
-    if args["max_jobs"] is not None:
-        jobs = take(args["max_jobs"], data)
-    else:
-        jobs = list(data)
-
-    return jobs
+    return await collection.find(
+        query, requested_projection(info), sort=sort, limit=limit)
 
 
 @Resolver("Query.collections")
+@timed
 async def resolver_query_collections(
     parent: Optional[Any],
     args: Dict[str, Any],
@@ -112,12 +245,145 @@ async def resolver_query_collections(
 
     Returns
     -------
-    The list of all available collection and their size
+    The list of all available collection, their size and number of jobs by status
 
 """
-    db = ctx["mongodb"]
-    # Filter the names that are not in the reserved keywords
-    reserved = {"jobs", "users"}
-    names = filter(lambda name: all(r not in name for r in reserved), db.list_collection_names())
+    entries = await read_registry(ctx["mongodb"].reader)
+
+    return [{"name": entry["_id"], "size": entry.get("size", 0),
+             "jobs": [{"status": status, "count": count} for status, count in entry.get("jobs", {}).items()]}
+            for entry in entries]
+
+
+@Resolver("Property.data")
+@timed
+async def resolver_property_data(
+    parent: Dict[str, Any],
+    args: Dict[str, Any],
+    ctx: Dict[str, Any],
+    info: Dict[str, Any]
+) -> Optional[str]:
+    """
+    Resolver in charge of returning the data of a property encoded as JSON.
+
+    The data stored as a sub-document (see :class:`ceiba.mongo_interface.PropertyStorage`)
+    is serialized, while the data stored as JSON is returned as it is.
+
+    Parameters
+    ----------
+    paren
+        property containing the data
+    args
+        computed arguments related to the field
+    ctx
+        context filled in at engine initialization
+    info
+        information related to the execution and field resolution
+
+    Returns
+    -------
+    The data of the property as JSON
+
+    """
+    return encode_data(parent.get("data"))
+
+
+@Resolver("Property.data_history")
+@timed
+async def resolver_property_data_history(
+    parent: Dict[str, Any],
+    args: Dict[str, Any],
+    ctx: Dict[str, Any],
+    info: Dict[str, Any]
+) -> Optional[List[Optional[str]]]:
+    """
+    Resolver in charge of returning the results appended by the APPEND policy encoded as JSON.
+
+    Parameters
+    ----------
+    paren
+        property containing the history
+    args
+        computed arguments related to the field
+    ctx
+        context filled in at engine initialization
+    info
+        information related to the execution and field resolution
+
+    Returns
+    -------
+    The appended results as JSON, from the oldest to the newest
+
+    """
+    history = parent.get("data_history")
+    return None if history is None else [encode_data(data) for data in history]
+
+
+def encode_data(data: Any) -> Optional[str]:
+    """Return the data of a property as JSON, whether it is stored as JSON or as a document."""
+    return data if data is None or isinstance(data, str) else json.dumps(data)
+
+
+def page_size(requested: Optional[int]) -> int:
+    """Return the number of documents to fetch, at most :data:`MAX_PAGE_SIZE`.
+
+    A missing size means the largest page and a non-positive size means no documents.
+    Mongo treats a zero limit as no limit at all, so the callers must
+    not query the database when the size is zero.
+    """
+    if requested is None:
+        return MAX_PAGE_SIZE
+    return max(0, min(requested, MAX_PAGE_SIZE))
+
+
+def page_query(after: Optional[int]) -> Dict[str, Any]:
+    """Return the query to fetch the documents following the ``after`` identifier."""
+    return {} if after is None else {"_id": {"$gt": after}}
+
+
+def requested_projection(info: Any) -> Optional[Dict[str, bool]]:
+    """Translate the fields selected by the client into a Mongo projection.
+
+    Nested selections are mapped to dotted paths, so the fields
+    that were not requested never leave the database.
+
+    Parameters
+    ----------
+    info
+        information related to the execution and field resolution
+
+    Returns
+    -------
+    The projection or None if all the fields must be retrieved
+
+    """
+    if info is None:
+        return None
+
+    paths: Set[str] = set()
+    for node in info.field_nodes:
+        collect_selected_paths(node.selection_set, info.fragments, "", paths)
+
+    return {path: True for path in sorted(paths)} if paths else None
+
+
+def collect_selected_paths(
+        selection_set: Any, fragments: Dict[str, Any], prefix: str, paths: Set[str]) -> None:
+    """Add to ``paths`` the dotted path of every leaf field in ``selection_set``."""
+    if selection_set is None:
+        return
 
-    return [{"name": name, "size": db[name].estimated_document_count()} for name in names]
+    for selection in selection_set.selections:
+        if isinstance(selection, FieldNode):
+            name = selection.name.value
+            if name.startswith("__"):
+                continue
+            if selection.selection_set is None:
+                paths.add(f"{prefix}{name}")
+            else:
+                collect_selected_paths(selection.selection_set, fragments, f"{prefix}{name}.", paths)
+        elif isinstance(selection, FragmentSpreadNode):
+            fragment = fragments[selection.name.value]
+            collect_selected_paths(fragment.selection_set, fragments, prefix, paths)
+        elif isinstance(selection, InlineFragmentNode):
+            collect_selected_paths(selection.selection_set, fragments, prefix, paths)
@@ -0,0 +1,79 @@
+"""Registry with the size of the property collections and their number of jobs by status.
+
+The mutations keep the registry up to date using atomic increments,
+therefore the collections can be listed with a single read.
+
+API
+---
+.. autofunction:: read_registry
+.. autofunction:: record_changes
+.. autofunction:: rebuild_registry
+
+"""
+
+__all__ = ["REGISTRY_COLLECTION", "ensure_registry", "is_property_collection", "read_registry",
+           "rebuild_registry", "record_changes", "status_change"]
+
+import logging
+from typing import Any, Dict, List, Mapping, Optional
+
+from pymongo import ASCENDING
+from pymongo.database import Database
+
+from .mongo_interface import IMPORTS_COLLECTION, USERS_COLLECTION, AsyncDatabase
+from .user_authentication import REVOKED_COLLECTION
+
+REGISTRY_COLLECTION = "collections_registry"
+
+#: Collections used internally by the server
+INTERNAL_COLLECTIONS = {USERS_COLLECTION, REVOKED_COLLECTION, REGISTRY_COLLECTION, IMPORTS_COLLECTION}
+
+logger = logging.getLogger(__name__)
+
+
+def is_property_collection(name: str) -> bool:
+    """Check if the collection called ``name`` stores properties."""
+    return not (name in INTERNAL_COLLECTIONS or name.startswith(("jobs_", "system.")))
+
+
+def status_change(old_status: str, new_status: str) -> Dict[str, int]:
+    """Return the change in the number of jobs by status when a job changes its status."""
+    return {} if old_status == new_status else {old_status: -1, new_status: 1}
+
+
+async def record_changes(
+        database: AsyncDatabase, collection_name: str, size: int = 0,
+        jobs: Optional[Mapping[str, int]] = None) -> None:
+    """Add ``size`` documents and the ``jobs`` by status to the counters of ``collection_name``."""
+    increments = {"size": size, **{f"jobs.{status}": count for status, count in (jobs or {}).items()}}
+    increments = {key: value for key, value in increments.items() if value != 0}
+    if increments:
+        await database[REGISTRY_COLLECTION].update_one(
+            {"_id": collection_name}, {"$inc": increments}, upsert=True)
+
+
+async def read_registry(database: AsyncDatabase) -> List[Dict[str, Any]]:
+    """Return the registry entry of every property collection."""
+    return await database[REGISTRY_COLLECTION].find({}, sort=[("_id", ASCENDING)])
+
+
+def rebuild_registry(database: Database) -> None:
+    """Count the documents and jobs of all the property collections from scratch."""
+    registry = database[REGISTRY_COLLECTION]
+    names = [name for name in database.list_collection_names() if is_property_collection(name)]
+    for name in names:
+        size = database[name].count_documents({})
+        groups = database[f"jobs_{name}"].aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}])
+        jobs = {group["_id"]: group["count"] for group in groups}
+        registry.replace_one({"_id": name}, {"size": size, "jobs": jobs}, upsert=True)
+        logger.info(f"Collection {name} has {size} properties and jobs {jobs}\n")
+
+    # Remove the collections that have been dropped
+    registry.delete_many({"_id": {"$nin": names}})
+
+
+def ensure_registry(database: Database) -> None:
+    """Build the registry if it doesn't exist yet."""
+    if REGISTRY_COLLECTION not in database.list_collection_names():
+        logger.info("Building the collections registry\n")
+        rebuild_registry(database)
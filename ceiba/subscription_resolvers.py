@@ -0,0 +1,53 @@
+"""Module to resolve the subscriptions.
+
+API
+---
+
+.. autofunction:: subscribe_jobs_available
+
+"""
+from functools import partial
+from typing import Any, AsyncIterator, Dict, Optional
+
+from tartiflette import Subscription
+
+from .mongo_interface import AsyncDatabase
+from .registry import REGISTRY_COLLECTION
+
+__all__ = ["subscribe_jobs_available"]
+
+
+@Subscription("Subscription.jobsAvailable")
+async def subscribe_jobs_available(
+    parent: Optional[Any],
+    args: Dict[str, Any],
+    ctx: Dict[str, Any],
+    info: Dict[str, Any],
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Notify the subscriber each time new jobs become available in ``collection_name``.
+
+    Parameters
+    ----------
+    paren
+        initial value filled in to the engine `execute` method
+    args
+        computed arguments related to the field
+    ctx
+        context filled in at engine initialization
+    info
+        information related to the execution and field resolution
+
+    Returns
+    -------
+    Notifications with the number of new available jobs
+    """
+    name = args["collection_name"]
+    async for count in ctx["notifier"].subscribe(name, partial(available_jobs, ctx["mongodb"], name)):
+        yield {"jobsAvailable": {"collection_name": name, "count": count}}
+
+
+async def available_jobs(database: AsyncDatabase, collection_name: str) -> int:
+    """Return the number of available jobs in ``collection_name`` according to the registry."""
+    entry = await database[REGISTRY_COLLECTION].find_one({"_id": collection_name}, {"jobs": True})
+    return ((entry or {}).get("jobs") or {}).get("AVAILABLE", 0)
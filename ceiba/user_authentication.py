@@ -3,22 +3,177 @@
 API
 ---
 .. autofunction:: authenticate_username
-.. autofunction: add_users_to_db
+.. autoclass:: GitHubClient
+   :members:
+.. autofunction:: is_user_authenticated
+.. autofunction:: restore_user
+.. autofunction:: revoke_user
+.. autoclass:: TokenAuthority
+   :members:
 
 """
+import asyncio
+import base64
+import binascii
+import hashlib
+import hmac
 import json
-from typing import Optional
+import logging
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Dict, Optional, Set, Tuple
 
-import requests
+import aiohttp
 from pymongo.database import Database
-from .mongo_interface import USERS_COLLECTION
 
-__all__ = ["authenticate_username"]
+from .mongo_interface import AsyncDatabase
+from .profiling import profiled
 
+__all__ = ["REVOKED_COLLECTION", "GitHubClient", "TokenAuthority", "authenticate_username",
+           "is_user_authenticated", "restore_user", "revoke_user"]
 
-def authenticate_username(
-        token: str,
-        github_api: str = 'https://api.github.com/graphql') -> Optional[str]:
+GITHUB_API = 'https://api.github.com/graphql'
+
+#: Maximum number of simultaneous connections to GitHub
+GITHUB_CONNECTIONS = 16
+
+#: Seconds during which a login verified by GitHub is cached
+LOGIN_CACHE_TTL = 600
+
+#: Maximum number of cached logins
+LOGIN_CACHE_SIZE = 1024
+
+#: Collection with the users whose session tokens are not accepted anymore
+REVOKED_COLLECTION = "revoked_users"
+
+#: Seconds during which a session token is valid
+TOKEN_LIFETIME = 24 * 3600
+
+#: Seconds between two refreshes of the revoked users
+DENY_LIST_REFRESH = 60
+
+logger = logging.getLogger(__name__)
+
+
+class TokenAuthority:
+    """Issue and verify the HMAC-signed session tokens.
+
+    A token carries the username and its expiration time, so it can be
+    verified in memory without querying the database. Revoked users are
+    kept in a deny list that is periodically refreshed from the
+    :data:`REVOKED_COLLECTION`.
+    """
+
+    def __init__(self, secret: bytes, lifetime: float = TOKEN_LIFETIME) -> None:
+        self.secret = secret
+        self.lifetime = lifetime
+        self.denied: Set[str] = set()
+
+    def _sign(self, payload: str) -> str:
+        return hmac.new(self.secret, payload.encode(), hashlib.sha256).hexdigest()
+
+    def issue(self, username: str) -> str:
+        """Create a new token for ``username``."""
+        data = json.dumps({"username": username, "expires": time.time() + self.lifetime})
+        payload = base64.urlsafe_b64encode(data.encode()).decode()
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify(self, token: Any) -> Optional[str]:
+        """Return the username stored in ``token`` or None if the token is not valid."""
+        if not isinstance(token, str):
+            return None
+        payload, _, signature = token.rpartition(".")
+        # Compare bytes, since compare_digest rejects the strings with non-ASCII characters
+        if not hmac.compare_digest(signature.encode(), self._sign(payload).encode()):
+            return None
+        try:
+            data = json.loads(base64.urlsafe_b64decode(payload))
+        except (binascii.Error, ValueError):
+            return None
+
+        if data["expires"] < time.time() or data["username"] in self.denied:
+            return None
+
+        return data["username"]
+
+    async def refresh_deny_list(self, database: AsyncDatabase) -> None:
+        """Read the revoked users from the database."""
+        revoked = await database[REVOKED_COLLECTION].find()
+        self.denied = {entry["username"] for entry in revoked}
+
+    async def refresh_periodically(
+            self, database: AsyncDatabase, interval: float = DENY_LIST_REFRESH) -> None:
+        """Refresh the deny list every ``interval`` seconds."""
+        while True:
+            try:
+                await self.refresh_deny_list(database)
+            except Exception as ex:  # Keep the previous list if the database is unavailable
+                logger.error(f"Cannot refresh the revoked users: {ex}")
+            await asyncio.sleep(interval)
+
+
+def revoke_user(database: Database, username: str) -> None:
+    """Reject the session tokens of ``username`` once the servers refresh their deny list."""
+    database[REVOKED_COLLECTION].update_one(
+        {"username": username}, {"$set": {"username": username, "revoked": time.time()}}, upsert=True)
+
+
+def restore_user(database: Database, username: str) -> None:
+    """Accept again the session tokens of a revoked user."""
+    database[REVOKED_COLLECTION].delete_many({"username": username})
+
+
+class GitHubClient:
+    """Pooled keep-alive session to GitHub's API with a TTL cache of the logins.
+
+    The cache is indexed by the hash of the token, therefore the tokens are not
+    kept in memory. Concurrent verifications of the same token share a single
+    request to GitHub.
+    """
+
+    def __init__(
+            self, github_api: str = GITHUB_API, ttl: float = LOGIN_CACHE_TTL,
+            maxsize: int = LOGIN_CACHE_SIZE) -> None:
+        self.github_api = github_api
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.logins: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.pending: Dict[str, "asyncio.Future[Optional[str]]"] = {}
+
+    async def start(self) -> None:
+        """Open the HTTP session, it must be called within the event loop."""
+        connector = aiohttp.TCPConnector(limit=GITHUB_CONNECTIONS, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self) -> None:
+        """Close the HTTP session."""
+        if self.session is not None:
+            await self.session.close()
+
+    def cached_login(self, key: str) -> Optional[str]:
+        """Return the login stored under ``key`` if it has not expired."""
+        entry = self.logins.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def store_login(self, key: str, future: "asyncio.Future[Optional[str]]") -> None:
+        """Cache the login returned by GitHub."""
+        del self.pending[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+        login = future.result()
+        if login is None:
+            return
+        self.logins[key] = (time.monotonic() + self.ttl, login)
+        self.logins.move_to_end(key)
+        if len(self.logins) > self.maxsize:
+            self.logins.popitem(last=False)
+
+
+async def authenticate_username(token: str, client: GitHubClient) -> Optional[str]:
     """Check that the token correspond to a valid GitHub username.
 
     Using  `GitHub GraphQL API v4 <https://developer.github.com/v4/>`_
@@ -27,29 +182,63 @@ def authenticate_username(
     ----------
     token
         GitHub token that gives read only authorization
-    github_api
-        URL of GitHub's API
+    client
+        Session to GitHub's API and cache of the known tokens
 
     Return
     ------
     GitHub's username or None
 
     """
+    key = hashlib.sha256(token.encode()).hexdigest()
+    login = client.cached_login(key)
+    if login is not None:
+        return login
+
+    pending = client.pending.get(key)
+    if pending is None:
+        pending = asyncio.ensure_future(request_login(token, client))
+        client.pending[key] = pending
+        pending.add_done_callback(partial(client.store_login, key))
+
+    return await asyncio.shield(pending)
+
+
+async def request_login(token: str, client: GitHubClient) -> Optional[str]:
+    """Ask GitHub for the login of the token's owner."""
+    if client.session is None:
+        raise RuntimeError("The GitHub session has not been started")
+
     headers = {'Authorization': f'bearer {token}'}
     query = "query { viewer { login }}"
-    reply = requests.post(github_api, json={'query': query}, headers=headers)
+    async with client.session.post(client.github_api, json={'query': query}, headers=headers) as reply:
+        if reply.status != 200:
+            return None
+        data = (await reply.json())['data']
 
-    status = reply.status_code
-    if status != 200:
-        return None
-
-    data = json.loads(reply.text)['data']
     return data['viewer']['login']
 
 
-def is_user_authenticated(cookie: str, database: Database) -> bool:
-    """Check if the user is authenticated in the web service."""
-    col = database[USERS_COLLECTION]
-    user_data = json.loads(cookie)
-    data = col.find_one({key: user_data[key] for key in {"username", "token"}})
-    return False if data is None else True
+@profiled("authentication")
+def is_user_authenticated(cookie: str, authority: TokenAuthority) -> bool:
+    """Check if the user is authenticated in the web service.
+
+    Parameters
+    ----------
+    cookie
+        JSON with the username and the session token
+    authority
+        Object verifying the session tokens
+
+    Returns
+    -------
+    Whether the token is valid and belongs to the user
+
+    """
+    try:
+        user_data = json.loads(cookie)
+        username = authority.verify(user_data["token"])
+    except (ValueError, KeyError, TypeError):
+        return False
+
+    return username is not None and username == user_data["username"]
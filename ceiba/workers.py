@@ -0,0 +1,213 @@
+"""Serve the application from several processes sharing the listening socket.
+
+The master process binds the socket and forks the workers, which inherit it and accept
+the connections of the shared port, so executing the GraphQL queries and encoding the replies
+use all the cores. The workers create their own MongoDB clients after the fork, since
+the clients are not fork safe. The master restarts the workers that exit unexpectedly,
+and stops all of them when it receives SIGINT or SIGTERM.
+
+Each worker keeps its own caches, metrics and subscriptions. The master gives each worker
+a pipe and relays the jobs published by a worker to all the others, which the workers use
+to notify the ``jobsAvailable`` subscribers of the jobs created through any worker,
+see :class:`ceiba.notifications.JobsNotifier`. The master only writes to the pipes that
+can take the jobs without blocking, the jobs waiting for a busy worker are added up by
+collection, so a stalled worker never holds up the master and the other workers.
+The metrics are shared through files, see :class:`ceiba.metrics.SharedMetrics`.
+
+API
+---
+.. autofunction:: bind_socket
+.. autoclass:: Supervisor
+   :members:
+
+"""
+
+__all__ = ["Supervisor", "bind_socket"]
+
+import logging
+import multiprocessing
+import select
+import signal
+import socket
+import time
+from collections import Counter
+from multiprocessing.connection import Connection, wait
+from multiprocessing.process import BaseProcess
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+#: Function serving the application on the shared socket, with the pipe to the master
+Target = Callable[[socket.socket, Connection], None]
+
+logger = logging.getLogger(__name__)
+
+#: Seconds to wait before restarting a worker, so a worker failing at startup doesn't spin
+RESTART_DELAY = 1.0
+
+#: Seconds given to the workers to finish the requests in flight when stopping
+SHUTDOWN_TIMEOUT = 10.0
+
+#: Seconds between two checks of the workers
+POLL_INTERVAL = 0.5
+
+#: Seconds between two attempts to relay the jobs to a busy worker
+RETRY_INTERVAL = 0.05
+
+
+def bind_socket(host: str, port: int, backlog: int = 128) -> socket.socket:
+    """Return a socket listening on ``host`` and ``port`` to share with the workers."""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    return socket.create_server((host, port), family=family, backlog=backlog)
+
+
+def run_worker(
+        target: Target, sock: socket.socket, relay: Connection, inherited: List[Connection]) -> None:
+    """Restore the default signal handlers, inherited from the master, and call ``target``.
+
+    The master ends of the pipes of the other workers, ``inherited`` by the fork, are closed.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    for connection in inherited:
+        connection.close()
+    target(sock, relay)
+
+
+class Supervisor:
+    """Keep ``workers`` processes calling ``target`` with the shared socket ``sock``.
+
+    The ``target`` runs the server until the process receives SIGTERM. It also receives
+    its end of a pipe, the ``(collection_name, count)`` jobs published through it are
+    relayed to the other workers.
+    """
+
+    def __init__(
+            self, target: Target, sock: socket.socket, workers: int,
+            restart_delay: float = RESTART_DELAY) -> None:
+        self.target = target
+        self.sock = sock
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.context = multiprocessing.get_context("fork")
+        self.processes: List[BaseProcess] = []
+        # Master end of the pipe of each worker
+        self.relays: List[Connection] = []
+        # Jobs by collection waiting to be relayed to each worker
+        self.unsent: List[Counter] = []
+        # Time at which each exited worker is restarted
+        self.restarts: Dict[int, float] = {}
+        self.stopping = False
+
+    def start_worker(self) -> Tuple[BaseProcess, Connection]:
+        """Fork a new worker, returning it with the master end of its pipe."""
+        relay, worker_relay = self.context.Pipe()
+        process = self.context.Process(
+            target=run_worker, args=(self.target, self.sock, worker_relay, [relay, *self.relays]))
+        process.start()
+        worker_relay.close()
+        logger.info(f"Started worker {process.pid}\n")
+        return process, relay
+
+    def start(self) -> None:
+        """Fork all the workers."""
+        for _ in range(self.workers):
+            process, relay = self.start_worker()
+            self.processes.append(process)
+            self.relays.append(relay)
+            self.unsent.append(Counter())
+
+    def restart_exited(self) -> None:
+        """Replace the workers that have exited ``restart_delay`` seconds ago, unless stopping."""
+        now = time.monotonic()
+        for index, process in enumerate(self.processes):
+            if process.exitcode is None or self.stopping:
+                continue
+            if index not in self.restarts:
+                logger.warning(f"Worker {process.pid} exited with code {process.exitcode}, "
+                               f"restarting it in {self.restart_delay} seconds\n")
+                self.restarts[index] = now + self.restart_delay
+            if self.restarts[index] <= now:
+                del self.restarts[index]
+                self.relays[index].close()
+                self.unsent[index].clear()
+                self.processes[index], self.relays[index] = self.start_worker()
+
+    def relay(self, ready: Iterable[Any]) -> None:
+        """Relay the jobs published through the ``ready`` pipes to the other workers."""
+        for index, sender in enumerate(self.relays):
+            if sender not in ready:
+                continue
+            try:
+                while sender.poll():
+                    collection_name, count = sender.recv()
+                    for other, unsent in enumerate(self.unsent):
+                        if other != index:
+                            unsent[collection_name] += count
+            except (EOFError, OSError):
+                # The worker has exited, it is restarted with a new pipe
+                continue
+        self.flush()
+
+    def flush(self) -> None:
+        """Send the unsent jobs to the workers whose pipe can take them without blocking."""
+        waiting = [relay for relay, unsent in zip(self.relays, self.unsent) if unsent]
+        if not waiting:
+            return
+        _, writable, _ = select.select([], waiting, [], 0)
+        for relay, unsent in zip(self.relays, self.unsent):
+            if relay not in writable:
+                continue
+            try:
+                while unsent:
+                    relay.send(unsent.popitem())
+            except OSError:
+                # The worker has exited, the jobs are not relayed to the new one
+                unsent.clear()
+
+    def watched(self) -> List[Any]:
+        """Return the sentinels and pipes of the workers, to wait until one is ready.
+
+        The exited workers waiting to be restarted are left out, since their sentinel
+        and their pipe, at end of file, would always be ready.
+        """
+        running = [index for index in range(len(self.processes)) if index not in self.restarts]
+        return [*(self.processes[index].sentinel for index in running),
+                *(self.relays[index] for index in running)]
+
+    def timeout(self) -> float:
+        """Return the seconds until the next pending restart or relay."""
+        timeout = RETRY_INTERVAL if any(self.unsent) else POLL_INTERVAL
+        if self.restarts:
+            timeout = min(timeout, max(0.0, min(self.restarts.values()) - time.monotonic()))
+        return timeout
+
+    def stop(self, *_: Any) -> None:
+        """Ask the supervisor to stop, used as signal handler."""
+        self.stopping = True
+
+    def shutdown(self, timeout: float = SHUTDOWN_TIMEOUT) -> None:
+        """Terminate the workers, killing those still alive after ``timeout`` seconds."""
+        for relay in self.relays:
+            relay.close()
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Worker {process.pid} didn't stop in time, killing it\n")
+                process.kill()
+                process.join()
+
+    def run(self) -> None:
+        """Start the workers and restart them until SIGINT or SIGTERM is received."""
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        self.start()
+        try:
+            while not self.stopping:
+                ready = wait(self.watched(), timeout=self.timeout())
+                self.relay(ready)
+                self.restart_exited()
+        finally:
+            self.shutdown()
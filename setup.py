@@ -38,14 +38,18 @@ setup(
         'Programming Language :: Python :: 3.8',
     ],
     entry_points={
-        'console_scripts': ['ceiba=ceiba.app:run']},
+        'console_scripts': ['ceiba=ceiba.app:run', 'ceiba-admin=ceiba.admin:main',
+                            'ceiba-import=ceiba.importer:main']},
     data_files=[('citation/ceiba', ['CITATION.cff'])],
     install_requires=[
-        'aiohttp==3.8.5', 'more-itertools', 'tartiflette', 'tartiflette-aiohttp',
-        'pandas', 'pymongo', 'requests'],
+        'aiohttp==3.8.5', 'tartiflette', 'tartiflette-aiohttp',
+        'pandas', 'pymongo'],
     extras_require={
         'test': ['coverage', 'mypy', 'pycodestyle', 'pytest>=3.9',
                  'pytest-asyncio', 'pytest-cov', 'pytest-mock'],
-        'docs': ['sphinx', 'sphinx_rtd_theme']
+        'docs': ['sphinx', 'sphinx_rtd_theme'],
+        'parquet': ['pyarrow'],
+        'compression': ['brotli', 'zstandard'],
+        'benchmark': ['mongomock']
     }
 )
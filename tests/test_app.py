@@ -1,20 +1,32 @@
 """Test the app instantiation."""
 
 import argparse
+import asyncio
 import sys
 from pathlib import Path
 
 import pytest
 from pytest_mock import MockFixture
 
-from ceiba.app import configure_logger, create_context, read_cli_args
+from ceiba.app import (background_tasks, configure_logger, create_context,
+                       read_cli_args, read_secret)
+from ceiba.indexes import IndexManager
+from ceiba.metrics import SharedMetrics
+from ceiba.mongo_interface import AsyncDatabase
+from ceiba.notifications import JobsNotifier
+from ceiba.user_authentication import (REVOKED_COLLECTION, GitHubClient,
+                                       TokenAuthority)
 
-from .utils_test import PATH_TEST
+from .utils_test import PATH_TEST, MockedCollection, MockedDatabase
 
 PATH_USERS = PATH_TEST / "users.txt"
 
 CLI_ARGS = argparse.Namespace(
-    file=PATH_USERS, mongo_url="localhost", username="juan", password="42")
+    file=PATH_USERS, mongo_url="localhost", username="juan", password="42", mongo_threads=4,
+    secret="CeibaSecret", token_lifetime=60, native_data=False,
+    max_history=None, mongo_pool_size=None, mongo_min_pool_size=None,
+    mongo_server_selection_timeout=None, mongo_connect_timeout=None, mongo_socket_timeout=None,
+    mongo_compressors=None, write_concern=None, read_preference="primary")
 
 
 def test_cli_parser(mocker: MockFixture):
@@ -37,15 +49,73 @@ def test_nonexisting_user_file(mocker: MockFixture):
     print("err: ", error)
 
 
+def test_max_history(mocker: MockFixture):
+    """Check that at least one result must be kept by the APPEND policy."""
+    argv = ["-f", PATH_USERS.absolute().as_posix()]
+    assert read_cli_args([*argv, "--max_history", "3"]).max_history == 3
+    for value in ("0", "-2"):
+        with pytest.raises(SystemExit):
+            read_cli_args([*argv, "--max_history", value])
+
+
+def test_workers():
+    """Check that the number of workers can't be negative."""
+    argv = ["-f", PATH_USERS.absolute().as_posix()]
+    assert read_cli_args([*argv, "--workers", "0"]).workers == 0
+    with pytest.raises(SystemExit):
+        read_cli_args([*argv, "--workers", "-2"])
+
+
 def test_create_context(mocker: MockFixture):
     """Test context generation."""
     mocker.patch("ceiba.app.connect_to_db", return_value="mock")
     mocker.patch("ceiba.app.add_users_to_db", return_value=None)
+    mocker.patch("ceiba.app.ensure_registry", return_value=None)
     ctx = create_context(CLI_ARGS)
     assert "mongodb" in ctx
+    assert ctx["tokens"].secret == b"CeibaSecret"
+
+
+def test_database_options(mocker: MockFixture):
+    """Check that a single client is created with the options of the command line."""
+    connect = mocker.patch("ceiba.app.connect_to_db", return_value=mocker.MagicMock())
+    mocker.patch("ceiba.app.add_users_to_db", return_value=None)
+    mocker.patch("ceiba.app.ensure_registry", return_value=None)
+    args = read_cli_args([
+        "-f", PATH_USERS.absolute().as_posix(), "--mongo_pool_size", "20", "--write_concern", "2",
+        "--mongo_compressors", "zstd,zlib", "--read_preference", "secondaryPreferred"])
+    ctx = create_context(args)
+    connect.assert_called_once()
+    config = connect.call_args.args[0]
+    assert config.max_pool_size == 20 and config.write_concern == 2
+    assert config.compressors == "zstd,zlib"
+    assert ctx["mongodb"].reader is not ctx["mongodb"]
 
 
 def test_logger(tmp_path: Path):
     """Check the logger."""
     workdir = Path(tmp_path)
     configure_logger(workdir, "ceiba")
+
+
+def test_random_secret():
+    """Check that a random secret is generated if none is provided."""
+    assert len(read_secret(None)) == 32
+
+
+@pytest.mark.asyncio
+async def test_background_tasks(tmp_path: Path):
+    """Check that the revoked users are periodically read and the metrics shared."""
+    revoked = MockedCollection([{"username": "RosalindFranklin"}])
+    mongodb = AsyncDatabase(MockedDatabase({REVOKED_COLLECTION: revoked}))
+    context = {"tokens": TokenAuthority(b"secret"), "github": GitHubClient(),
+               "mongodb": mongodb, "indexes": IndexManager(mongodb), "notifier": JobsNotifier()}
+    shared_metrics = SharedMetrics(tmp_path, interval=0.01)
+    tasks = background_tasks(context, shared_metrics, None)
+    await tasks.__anext__()
+    await asyncio.sleep(0.1)
+    assert "RosalindFranklin" in context["tokens"].denied
+    assert shared_metrics.path.exists()
+    with pytest.raises(StopAsyncIteration):
+        await tasks.__anext__()
+    assert context["github"].session.closed
@@ -1,37 +1,109 @@
 """Test the authentication functionality."""
 
-from pytest_mock import MockerFixture
+import asyncio
+import json
 
-from ceiba.user_authentication import (authenticate_username,
-                                                is_user_authenticated)
+import pytest
+from pytest_mock import MockFixture
 
-from .test_mongo_interface import get_database
+from ceiba.admin import main
+from ceiba.mongo_interface import AsyncDatabase
+from ceiba.user_authentication import (REVOKED_COLLECTION, GitHubClient,
+                                       TokenAuthority, authenticate_username,
+                                       is_user_authenticated)
 
+from .utils_test import VALID_GITHUB_TOKEN, MockedCollection, github_stand_in
 
-class MockReply(dict):
-    """Mock requests reply."""
-    def __getattr__(self, attr):
-        """Allow `obj.key` notation."""
-        return self.get(attr)
 
-
-def test_github_user():
+@pytest.mark.asyncio
+async def test_github_user():
     """Check that None is return if an invalid toke is provided."""
-    username = authenticate_username("invalidtoken123")
+    async with github_stand_in() as (url, _):
+        client = GitHubClient(url)
+        await client.start()
+        try:
+            username = await authenticate_username("invalidtoken123", client)
+        finally:
+            await client.close()
     assert username is None
 
 
-def test_correct_token(mocker: MockerFixture):
+@pytest.mark.asyncio
+async def test_correct_token():
     """Check that a username is returns if a valid token is provided."""
-    mocked_reply = MockReply(
-        {"status_code": 200, "text": '{"data": {"viewer": {"login": "felipeZ"}}}'})
-    mocker.patch("requests.post", return_value=mocked_reply)
-    username = authenticate_username("validtoken")
+    async with github_stand_in() as (url, received):
+        client = GitHubClient(url)
+        await client.start()
+        try:
+            usernames = await asyncio.gather(
+                *[authenticate_username(VALID_GITHUB_TOKEN, client) for _ in range(10)])
+            username = await authenticate_username(VALID_GITHUB_TOKEN, client)
+        finally:
+            await client.close()
+
+    assert username == "RosalindFranklin"
+    assert all(name == username for name in usernames)
+    # GitHub is queried only once
+    assert len(received) == 1
+
 
-    assert username == "felipeZ"
+@pytest.mark.asyncio
+async def test_login_cache_expiration():
+    """Check that the logins are forgotten after the TTL."""
+    async with github_stand_in() as (url, received):
+        client = GitHubClient(url, ttl=-1)
+        await client.start()
+        try:
+            for _ in range(2):
+                await authenticate_username(VALID_GITHUB_TOKEN, client)
+        finally:
+            await client.close()
+
+    assert len(received) == 2
 
 
 def test_is_user_authenticated():
-    """Check that the user credentials are searched in the database."""
-    cookie = '{"username": "felipeZ", "token": "Token42"}'
-    assert not is_user_authenticated(cookie, get_database())
+    """Check that the session token is verified."""
+    authority = TokenAuthority(b"secret")
+    token = authority.issue("felipeZ")
+    cookie = json.dumps({"username": "felipeZ", "token": token})
+    assert is_user_authenticated(cookie, authority)
+
+    # Wrong user, tampered token, unknown key and malformed cookies
+    assert not is_user_authenticated(json.dumps({"username": "someone", "token": token}), authority)
+    assert not is_user_authenticated(cookie.replace(token[:4], "AAAA"), authority)
+    assert not is_user_authenticated(cookie, TokenAuthority(b"other secret"))
+    assert not is_user_authenticated('{"username": "felipeZ", "token": "Token42"}', authority)
+    assert not is_user_authenticated("not a JSON", authority)
+    assert not is_user_authenticated('{"username": "felipeZ", "token": 5}', authority)
+    assert not is_user_authenticated('["felipeZ", "token"]', authority)
+    assert authority.verify("caf\u00e9.\u00e9") is None
+
+
+def test_expired_token():
+    """Check that an expired token is rejected."""
+    authority = TokenAuthority(b"secret", lifetime=-1)
+    assert authority.verify(authority.issue("felipeZ")) is None
+
+
+@pytest.mark.asyncio
+async def test_revoked_user():
+    """Check that the tokens of the revoked users are rejected."""
+    authority = TokenAuthority(b"secret")
+    token = authority.issue("felipeZ")
+    database = AsyncDatabase({REVOKED_COLLECTION: MockedCollection([{"username": "felipeZ"}])})
+    await authority.refresh_deny_list(database)
+    assert authority.verify(token) is None
+
+
+def test_revoke_user_command(mocker: MockFixture):
+    """Check that the admin commands revoke and restore the users."""
+    mocker.patch("ceiba.admin.connect_to_db", return_value="mock")
+    revoke = mocker.patch("ceiba.admin.revoke_user", return_value=None)
+    restore = mocker.patch("ceiba.admin.restore_user", return_value=None)
+    main(["revoke-user", "felipeZ", "-m", "localhost"])
+    revoke.assert_called_once_with("mock", "felipeZ")
+    main(["restore-user", "felipeZ"])
+    restore.assert_called_once_with("mock", "felipeZ")
+    with pytest.raises(SystemExit):
+        main(["revoke-user"])
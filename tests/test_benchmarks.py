@@ -0,0 +1,35 @@
+"""Test the helpers of the load test."""
+
+import pytest
+
+from benchmarks.load_test import compare, parse_mix, percentile
+
+
+def report(throughput: float, p99: float, mongo: float) -> dict:
+    operation = {"requests": 10, "p50": p99 / 2, "p99": p99, "mongo_ops_per_request": mongo}
+    return {"throughput": throughput, "errors": 0, "operations": {"reserve": operation}}
+
+
+def test_parse_mix():
+    """Check the weights of the operations."""
+    assert parse_mix("reserve=4,dashboard=1") == {"reserve": 4.0, "dashboard": 1.0}
+    for mix in ("reserve=4,delete=1", "job_input=1", "__init__=1"):
+        with pytest.raises(ValueError):
+            parse_mix(mix)
+
+
+def test_percentile():
+    """Check the percentiles of the latencies."""
+    values = [float(x) for x in range(101)]
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([], 0.5) == 0
+
+
+def test_compare():
+    """Check that only the changes beyond the tolerance are regressions."""
+    baseline = report(100, 0.1, 3)
+    assert not compare(report(90, 0.11, 3), baseline, 0.2)
+    regressions = compare(report(50, 0.2, 4), baseline, 0.2)
+    assert len(regressions) == 4
+    assert regressions[0].startswith("throughput")
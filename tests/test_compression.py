@@ -0,0 +1,70 @@
+"""Test the compression of the requests and replies."""
+
+import gzip
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from ceiba.compression import DEFAULT_MAX_SIZE, compression_middleware, negotiate_encoding
+
+REPLY = {"data": [{"_id": index, "data": json.dumps({"gap": index * 0.1})} for index in range(200)]}
+
+
+async def echo(request: web.Request) -> web.Response:
+    """Reply with the request body, or with some properties if there is no body."""
+    body = await request.read()
+    return web.json_response(json.loads(body) if body else REPLY)
+
+
+def create_client() -> TestClient:
+    app = web.Application(middlewares=[compression_middleware("/graphql", threshold=100)])
+    app.router.add_post("/graphql", echo)
+    app.router.add_post("/other", echo)
+    return TestClient(TestServer(app))
+
+
+def test_negotiate_encoding():
+    """Check that the encoding with the highest weight is chosen."""
+    assert negotiate_encoding("gzip, deflate") == "gzip"
+    assert negotiate_encoding("gzip;q=0, deflate") is None
+    assert negotiate_encoding("*") is not None
+    assert negotiate_encoding("") is None
+
+
+@pytest.mark.asyncio
+async def test_compressed_replies():
+    """Check that only the large replies are compressed."""
+    async with create_client() as client:
+        headers = {"Accept-Encoding": "gzip"}
+        response = await client.post("/graphql", headers=headers)
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert await response.json() == REPLY
+
+        response = await client.post("/graphql", json={"data": None}, headers=headers)
+        assert "Content-Encoding" not in response.headers
+        response = await client.post("/other", headers=headers)
+        assert "Content-Encoding" not in response.headers
+
+
+@pytest.mark.asyncio
+async def test_compressed_requests():
+    """Check that compressed requests are decompressed before reaching the handler."""
+    async with create_client() as client:
+        body = gzip.compress(json.dumps(REPLY).encode())
+        response = await client.post("/graphql", data=body, headers={"Content-Encoding": "gzip"})
+        assert await response.json() == REPLY
+
+        response = await client.post("/graphql", data=body, headers={"Content-Encoding": "lzma"})
+        assert response.status == 415
+
+        zstandard = pytest.importorskip("zstandard")
+        body = zstandard.ZstdCompressor().compress(json.dumps(REPLY).encode())
+        response = await client.post("/graphql", data=body, headers={"Content-Encoding": "zstd"})
+        assert await response.json() == REPLY
+
+        # A small body that decompresses beyond the size of the requests
+        bomb = zstandard.ZstdCompressor().compress(b" " * (DEFAULT_MAX_SIZE + 1))
+        response = await client.post("/graphql", data=bomb, headers={"Content-Encoding": "zstd"})
+        assert response.status == 413
@@ -0,0 +1,169 @@
+"""Test the chunked import of tables."""
+
+import json
+from pathlib import Path
+from typing import Any, Dict, List
+
+import pandas as pd
+import pytest
+from pymongo.errors import BulkWriteError
+from pytest_mock import MockFixture
+
+from ceiba.importer import import_table, insert_chunk, main, read_chunks
+from ceiba.mongo_interface import IMPORTS_COLLECTION
+from ceiba.registry import REGISTRY_COLLECTION
+
+from .test_mongo_interface import get_database
+from .utils_test import PATH_TEST, MockedCollection, MockedDatabase
+
+PATH_CANDIDATES = PATH_TEST / "candidates.csv"
+NUMBER_OF_CANDIDATES = 21
+
+
+class StoringCollection(MockedCollection):
+    """Keep the documents inserted in the collection."""
+
+    def __init__(self, data: Any = None) -> None:
+        super().__init__(data)
+        self.documents: List[Dict[str, Any]] = []
+
+    def insert_many(self, documents, ordered=True):
+        self.documents.extend(documents)
+        return type("InsertManyResult", (), {"inserted_ids": [doc["_id"] for doc in documents]})
+
+    def replace_one(self, query, replacement, upsert=False):
+        self.data = {**query, **replacement}
+
+
+class RecordingRegistry(MockedCollection):
+    """Add up the increments of the collection sizes."""
+
+    def __init__(self) -> None:
+        super().__init__(None)
+        self.size = 0
+
+    def update_one(self, query, update, **kwargs):
+        self.size += update["$inc"]["size"]
+        return super().update_one(query, update, **kwargs)
+
+
+def write_jsonl(path: Path) -> List[Dict[str, Any]]:
+    """Write the candidates as a JSONL file."""
+    data = pd.read_csv(PATH_CANDIDATES, index_col=0).reset_index().rename(columns={"index": "_id"})
+    records = data.to_dict("records")
+    with open(path, 'w') as handler:
+        handler.write("\n".join(json.dumps(record) for record in records))
+    return records
+
+
+def test_read_csv_chunks():
+    """Check that the CSV is read in chunks of the same size."""
+    chunks = list(read_chunks(PATH_CANDIDATES, chunk_size=5))
+    assert [len(chunk) for chunk in chunks] == [5, 5, 5, 5, 1]
+    assert chunks[0][0]["_id"] == 0
+
+    # Skip the first rows
+    chunks = list(read_chunks(PATH_CANDIDATES, chunk_size=5, skip=15))
+    assert [len(chunk) for chunk in chunks] == [5, 1]
+
+
+def test_read_jsonl_chunks(tmp_path: Path):
+    """Check that the JSONL file is read in chunks of the same size."""
+    path = tmp_path / "candidates.jsonl"
+    records = write_jsonl(path)
+    chunks = list(read_chunks(path, chunk_size=8, skip=4))
+    assert [len(chunk) for chunk in chunks] == [8, 8, 1]
+    assert chunks[0][0] == records[4]
+
+
+def test_read_rows_without_identifier(tmp_path: Path):
+    """Check that the rows of a JSONL file must have an identifier."""
+    path = tmp_path / "candidates.jsonl"
+    path.write_text('{"_id": 0, "smiles": "C"}\n{"smiles": "CC"}\n')
+    with pytest.raises(ValueError, match="Row 1 has no _id"):
+        list(read_chunks(path, chunk_size=5))
+
+
+def test_read_parquet_chunks(tmp_path: Path):
+    """Check that the row groups of a Parquet file are regrouped in chunks of the same size."""
+    pytest.importorskip("pyarrow")
+    path = tmp_path / "candidates.parquet"
+    data = pd.read_csv(PATH_CANDIDATES, index_col=0).reset_index().rename(columns={"index": "_id"})
+    data.to_parquet(path, row_group_size=3)
+    chunks = list(read_chunks(path, chunk_size=5, skip=2))
+    assert [len(chunk) for chunk in chunks] == [5, 5, 5, 4]
+    assert chunks[0][0]["_id"] == data["_id"][2]
+
+
+def test_unknown_format():
+    """Check that the format of the file must be known."""
+    with pytest.raises(ValueError):
+        read_chunks(Path("candidates.xlsx"))
+
+
+def test_insert_duplicated_chunk():
+    """Check that the rows already stored are ignored."""
+    class DuplicatedCollection(MockedCollection):
+        def insert_many(self, documents, ordered=True):
+            raise BulkWriteError({"nInserted": 1, "writeErrors": [{"code": 11000, "errmsg": "E11000"}]})
+
+    assert insert_chunk(DuplicatedCollection(None), [{"_id": 1}, {"_id": 2}]) == 1
+
+
+def test_import_table():
+    """Check that all the chunks are stored and committed."""
+    collections: Dict[str, Any] = {name: StoringCollection() for name in ("candidates", IMPORTS_COLLECTION)}
+    collections[REGISTRY_COLLECTION] = registry = RecordingRegistry()
+    database = MockedDatabase(collections)
+    rows = import_table(database, "candidates", PATH_CANDIDATES, chunk_size=4, in_flight=2)
+    assert rows == NUMBER_OF_CANDIDATES
+    assert registry.size == NUMBER_OF_CANDIDATES
+    assert len(collections["candidates"].documents) == NUMBER_OF_CANDIDATES
+    checkpoint = collections[IMPORTS_COLLECTION].data
+    assert checkpoint["_id"] == "candidates/candidates.csv" and checkpoint["rows"] == rows
+    assert checkpoint["rate"] > 0
+
+    # Resume an import that was interrupted after 16 rows
+    collections["candidates"].documents.clear()
+    collections[IMPORTS_COLLECTION].data["rows"] = 16
+    registry.size = 16
+    import_table(database, "candidates", PATH_CANDIDATES, chunk_size=4, resume=True)
+    assert len(collections["candidates"].documents) == NUMBER_OF_CANDIDATES - 16
+    assert registry.size == NUMBER_OF_CANDIDATES
+
+
+def test_import_builds_registry():
+    """Check that the collections stored before the first import are kept in the registry."""
+    mongomock = pytest.importorskip("mongomock")
+    database = mongomock.MongoClient()["properties"]
+    database["legacy"].insert_many([{"_id": 1}, {"_id": 2}])
+    import_table(database, "imported", PATH_CANDIDATES, chunk_size=4)
+    registry = {entry["_id"]: entry["size"] for entry in database[REGISTRY_COLLECTION].find()}
+    assert registry == {"legacy": 2, "imported": NUMBER_OF_CANDIDATES}
+
+
+def test_import_command(mocker: MockFixture):
+    """Check the command line interface."""
+    mocker.patch("ceiba.importer.connect_to_db", return_value="mock")
+    run = mocker.patch("ceiba.importer.import_table", return_value=NUMBER_OF_CANDIDATES)
+    main([PATH_CANDIDATES.as_posix(), "-c", "candidates", "--chunk_size", "4", "--resume"])
+    assert run.call_args.kwargs["chunk_size"] == 4
+    assert run.call_args.kwargs["resume"]
+    for option in ("--chunk_size", "--in_flight"):
+        with pytest.raises(SystemExit):
+            main([PATH_CANDIDATES.as_posix(), "-c", "candidates", option, "0"])
+
+
+def test_import_table_mongo(tmp_path: Path):
+    """Check that a file is imported into MongoDB twice without duplicating the rows."""
+    mongodb = get_database()
+    path = tmp_path / "candidates.jsonl"
+    write_jsonl(path)
+    try:
+        for _ in range(2):
+            import_table(mongodb, "candidates", path, chunk_size=4)
+        assert mongodb["candidates"].count_documents({}) == NUMBER_OF_CANDIDATES
+        assert mongodb[REGISTRY_COLLECTION].find_one({"_id": "candidates"})["size"] == NUMBER_OF_CANDIDATES
+    finally:
+        for name in ("candidates", IMPORTS_COLLECTION, REGISTRY_COLLECTION):
+            mongodb.drop_collection(name)
@@ -0,0 +1,115 @@
+"""Test the index provisioning."""
+
+from typing import Any, List
+
+import pytest
+from pymongo.errors import AutoReconnect, DuplicateKeyError
+
+from ceiba.indexes import (JOB_INDEXES, PROPERTY_INDEXES, RETRY_DELAY, USER_INDEXES,
+                           IndexManager, IndexSpec, deduplicate_jobs, indexes_for)
+from ceiba.mongo_interface import USERS_COLLECTION, AsyncDatabase
+from ceiba.user_authentication import REVOKED_COLLECTION
+
+from .test_mongo_interface import get_database
+from .utils_test import MockedCollection, MockedDatabase, read_jobs
+
+
+class RecordingCollection(MockedCollection):
+    """Remember the indexes created in the collection."""
+
+    def __init__(self, data: Any) -> None:
+        super().__init__(data)
+        self.indexes: List[Any] = []
+
+    def create_index(self, keys, **kwargs):
+        self.indexes.append(IndexSpec(keys, **kwargs))
+        return super().create_index(keys)
+
+
+def test_indexes_for():
+    """Check the indexes required by each kind of collection."""
+    assert indexes_for("jobs_awesome_data") == JOB_INDEXES
+    assert indexes_for("awesome_data") == PROPERTY_INDEXES
+    assert indexes_for(USERS_COLLECTION) == USER_INDEXES
+    assert indexes_for(REVOKED_COLLECTION) == []
+
+
+@pytest.mark.asyncio
+async def test_provision():
+    """Check that the indexes are created once for the existing collections."""
+    collections = {name: RecordingCollection(None) for name in (USERS_COLLECTION, "jobs_awesome_data")}
+    manager = IndexManager(AsyncDatabase(MockedDatabase(collections)))
+    await manager.provision()
+    await manager.ensure("jobs_awesome_data")
+    assert collections["jobs_awesome_data"].indexes == JOB_INDEXES
+    assert collections[USERS_COLLECTION].indexes == USER_INDEXES
+
+
+@pytest.mark.asyncio
+async def test_ensure_rejected():
+    """Check that an index rejected by the server is not built again."""
+    class RejectingCollection(RecordingCollection):
+        def create_index(self, keys, **kwargs):
+            super().create_index(keys, **kwargs)
+            if kwargs.get("unique"):
+                raise DuplicateKeyError("E11000 duplicate key error", 11000)
+            return "index"
+
+    collection = RejectingCollection(None)
+    manager = IndexManager(AsyncDatabase({"jobs_awesome_data": collection}))
+    for _ in range(2):
+        await manager.ensure("jobs_awesome_data")
+    assert "jobs_awesome_data" in manager.provisioned
+    # The other indexes are built anyway
+    assert collection.indexes == JOB_INDEXES
+
+
+@pytest.mark.asyncio
+async def test_ensure_transient_failure():
+    """Check that a collection is provisioned again after a transient error with a backoff."""
+    class FailingCollection(RecordingCollection):
+        def create_index(self, keys, **kwargs):
+            super().create_index(keys, **kwargs)
+            raise AutoReconnect("Connection lost")
+
+    collection = FailingCollection(None)
+    manager = IndexManager(AsyncDatabase({"jobs_awesome_data": collection}))
+    for _ in range(2):
+        await manager.ensure("jobs_awesome_data")
+    assert "jobs_awesome_data" not in manager.provisioned
+    assert len(collection.indexes) == 1
+
+    # The next attempt is due, after failing again the delay doubles
+    manager.retries["jobs_awesome_data"] = (0.0, RETRY_DELAY)
+    await manager.ensure("jobs_awesome_data")
+    assert len(collection.indexes) == 2
+    assert manager.retries["jobs_awesome_data"][1] == 2 * RETRY_DELAY
+
+
+@pytest.mark.asyncio
+async def test_provision_mongo():
+    """Check that the indexes are created in the jobs collections."""
+    mongodb = get_database()
+    col = mongodb["jobs_test"]
+    col.insert_many(read_jobs())
+    try:
+        await IndexManager(AsyncDatabase(mongodb)).provision()
+        # The _id index is always available
+        assert len(col.index_information()) == len(JOB_INDEXES) + 1
+    finally:
+        col.drop()
+
+
+def test_deduplicate_jobs():
+    """Check that a single job is kept for each property."""
+    mongomock = pytest.importorskip("mongomock")
+    database = mongomock.MongoClient()["properties"]
+    database["jobs_awesome_data"].insert_many([
+        {"_id": 1, "status": "AVAILABLE", "property": {"_id": 42}},
+        {"_id": 2, "status": "DONE", "property": {"_id": 42}},
+        {"_id": 3, "status": "FAILED", "property": {"_id": 43}},
+        {"_id": 4, "status": "AVAILABLE", "property": {"_id": 43}},
+        {"_id": 5, "status": "AVAILABLE", "property": {"_id": 44}}])
+    database["awesome_data"].insert_one({"_id": 42})
+    assert deduplicate_jobs(database) == 2
+    assert sorted(job["_id"] for job in database["jobs_awesome_data"].find()) == [2, 3, 5]
@@ -0,0 +1,51 @@
+"""Test the storage of the large objects."""
+
+import hashlib
+from pathlib import Path
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from ceiba.large_objects import LargeObjectStore, register_large_object_handlers
+from ceiba.user_authentication import TokenAuthority
+
+AUTHORITY = TokenAuthority(b"secret")
+
+
+async def chunks(data: bytes, size: int = 1000):
+    """Send the data using chunked transfer encoding."""
+    for start in range(0, len(data), size):
+        yield data[start: start + size]
+
+
+@pytest.mark.asyncio
+async def test_large_objects(tmp_path: Path):
+    """Check that the large objects are uploaded and downloaded by parts."""
+    app = web.Application()
+    store = LargeObjectStore(tmp_path)
+    register_large_object_handlers(app, store, AUTHORITY)
+    data = bytes(range(256)) * 100
+    handle = hashlib.sha256(data).hexdigest()
+    async with TestClient(TestServer(app)) as client:
+        response = await client.post("/large_objects", data=chunks(data))
+        assert response.status == 401
+
+        headers = {"Authorization": f"Bearer {AUTHORITY.issue('RosalindFranklin')}"}
+        response = await client.post("/large_objects", data=chunks(data), headers=headers)
+        assert response.status == 201
+        answer = await response.json()
+        assert answer["handle"] == handle and answer["size"] == len(data)
+        assert store.path(handle).read_bytes() == data
+        assert not list(store.incoming.iterdir())
+
+        response = await client.get(answer["url"])
+        assert await response.read() == data
+        response = await client.get(answer["url"], headers={"Range": "bytes=1000-1999"})
+        assert response.status == 206
+        assert await response.read() == data[1000:2000]
+
+        response = await client.get(f"/large_objects/{'0' * 64}")
+        assert response.status == 404
+        response = await client.get("/large_objects/not-a-handle")
+        assert response.status == 400
@@ -0,0 +1,135 @@
+"""Test the metrics of the web service."""
+
+import asyncio
+import json
+import os
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from ceiba.metrics import (REGISTRY, MetricsRegistry, MongoMetricsListener, SharedMetrics,
+                           TimedEngine, measure_event_loop_lag, metrics_handler, metrics_middleware,
+                           timed)
+
+
+def test_render_metrics():
+    """Check the Prometheus text format."""
+    registry = MetricsRegistry()
+    counter = registry.counter("jobs_total", "Number of jobs", ["status"])
+    histogram = registry.histogram("latency_seconds", "Latency", buckets=[0.1, 1.0])
+    counter.inc(status='DONE "ok"')
+    counter.inc(2, status='DONE "ok"')
+    histogram.observe(0.1)
+    histogram.observe(0.5)
+    histogram.observe(3)
+    text = registry.render()
+    assert 'jobs_total{status="DONE \\"ok\\""} 3' in text
+    assert '# TYPE latency_seconds histogram' in text
+    assert 'latency_seconds_bucket{le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{le="1.0"} 2' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 3' in text
+    assert 'latency_seconds_count 3' in text
+
+
+def test_shared_metrics(tmp_path: Path):
+    """Check that the metrics of the other workers are added, without the gauges of the exited ones."""
+    registry = MetricsRegistry()
+    counter = registry.counter("jobs_total", "Number of jobs", ["status"])
+    gauge = registry.gauge("connections", "Connections in use")
+    histogram = registry.histogram("latency_seconds", "Latency", buckets=[0.1, 1.0])
+    counter.inc(status="DONE")
+    gauge.inc(2)
+    histogram.observe(0.5)
+    snapshot = registry.snapshot()
+    (tmp_path / "1.json").write_text(json.dumps(snapshot))
+    (tmp_path / "2.json").write_text(json.dumps(snapshot))
+    os.utime(tmp_path / "2.json", (0, 0))
+
+    shared = SharedMetrics(tmp_path, registry=registry)
+    shared.write()
+    text = shared.render()
+    assert 'jobs_total{status="DONE"} 3' in text
+    assert 'connections 4' in text
+    assert 'latency_seconds_bucket{le="1.0"} 3' in text
+    assert 'latency_seconds_sum 1.5' in text
+
+
+@pytest.mark.asyncio
+async def test_timed_resolver():
+    """Check that the latency of the resolvers is labelled by field."""
+    @timed
+    async def resolver(parent, args, ctx, info):
+        if args.get("fail"):
+            raise RuntimeError("Oops")
+        return 42
+
+    info = SimpleNamespace(parent_type=SimpleNamespace(name="Query"), field_name="answer")
+    assert await resolver(None, {}, {}, info) == 42
+    with pytest.raises(RuntimeError):
+        await resolver(None, {"fail": True}, {}, info)
+    text = REGISTRY.render()
+    assert 'ceiba_resolver_duration_seconds_count{resolver="Query.answer",outcome="success"} 1' in text
+    assert 'ceiba_resolver_duration_seconds_count{resolver="Query.answer",outcome="error"} 1' in text
+
+
+@pytest.mark.asyncio
+async def test_timed_engine():
+    """Check that the latency of the operations is labelled by operation name."""
+    engine = TimedEngine(sdl="type Query { answer: Int }", schema_name="test_timed_engine")
+    await engine.cook()
+    engine.operation_names.update(f"Operation{index}" for index in range(99))
+    await engine.execute("query Answer { answer }", operation_name="Answer")
+    await engine.execute("query Other { answer }", operation_name="Other")
+    await engine.execute("{ answer }")
+    await engine.execute("{ question }")
+    text = REGISTRY.render()
+    name = "ceiba_graphql_operation_duration_seconds_count"
+    assert f'{name}{{operation="Answer",outcome="success"}} 1' in text
+    assert f'{name}{{operation="other",outcome="success"}} 1' in text
+    assert f'{name}{{operation="anonymous",outcome="success"}} 1' in text
+    assert f'{name}{{operation="anonymous",outcome="error"}} 1' in text
+
+
+def test_mongo_listener():
+    """Check that the commands and the connections in use are measured."""
+    listener = MongoMetricsListener()
+    listener.succeeded(SimpleNamespace(command_name="findAndModify", duration_micros=1500))
+    listener.failed(SimpleNamespace(command_name="findAndModify", duration_micros=500))
+    listener.connection_checked_out(None)
+    listener.connection_checked_out(None)
+    listener.connection_checked_in(None)
+    text = REGISTRY.render()
+    assert 'ceiba_mongo_command_duration_seconds_count{command="findAndModify",outcome="success"} 1' in text
+    assert 'ceiba_mongo_command_duration_seconds_count{command="findAndModify",outcome="failure"} 1' in text
+    assert 'ceiba_mongo_pool_connections{state="in_use"} 1' in text
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint():
+    """Check that the HTTP requests are measured and reported in the metrics endpoint."""
+    async def echo(request: web.Request) -> web.Response:
+        return web.Response(body=await request.read())
+
+    app = web.Application(middlewares=[metrics_middleware])
+    app.router.add_post("/echo/{name}", echo)
+    app.router.add_get("/metrics", metrics_handler)
+    async with TestClient(TestServer(app)) as client:
+        await client.post("/echo/test", data=b"x" * 100)
+        response = await client.get("/metrics")
+        assert response.headers["Content-Type"] == "text/plain; version=0.0.4; charset=utf-8"
+        text = await response.text()
+    assert 'ceiba_http_request_duration_seconds_count{path="/echo/{name}",method="POST",status="200"} 1' in text
+    assert 'ceiba_http_response_size_bytes_sum{path="/echo/{name}"} 100' in text
+
+
+@pytest.mark.asyncio
+async def test_event_loop_lag():
+    """Check that the event loop lag is measured periodically."""
+    histogram = MetricsRegistry().histogram("lag", "Lag")
+    task = asyncio.ensure_future(measure_event_loop_lag(0.01, histogram))
+    await asyncio.sleep(0.05)
+    task.cancel()
+    assert histogram.values[()][0]
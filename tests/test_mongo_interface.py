@@ -1,16 +1,19 @@
 """Module to test the interface to Mongodb."""
 
-
+import threading
 from typing import List
 
-from pymongo import MongoClient
+import pytest
+from pymongo import MongoClient, ReadPreference
 from pymongo.database import Database
+from pytest_mock import MockFixture
 
-from ceiba.mongo_interface import (USERS_COLLECTION, DatabaseConfig,
-                                   add_users_to_db, connect_to_db,
-                                   store_dataframe_in_mongo)
+from ceiba.mongo_interface import (USERS_COLLECTION, AsyncDatabase,
+                                   DatabaseConfig, PropertyStorage, add_users_to_db,
+                                   connect_to_db, store_dataframe_in_mongo)
+from ceiba.profiling import CURRENT, RequestProfile
 
-from .utils_test import PATH_TEST, read_jobs
+from .utils_test import PATH_TEST, MockedCollection, MockedDatabase, read_jobs
 
 DB_NAME = "test_mutations"
 COLLECTION_NAME = "candidates"
@@ -70,3 +73,56 @@ def test_add_user_to_db():
         add_users_to_db(db, path_users)
     finally:
         db.drop_collection(USERS_COLLECTION)
+
+
+@pytest.mark.asyncio
+async def test_async_database():
+    """Check that the blocking calls run outside the event loop thread."""
+    class ThreadCollection(MockedCollection):
+        def find_one(self, query=None):
+            return threading.current_thread().name
+
+    database = AsyncDatabase({"threads": ThreadCollection(None)}, max_workers=2)
+    thread_name = await database["threads"].find_one({})
+    assert thread_name.startswith("ceiba-mongo")
+
+    profile = RequestProfile()
+    token = CURRENT.set(profile)
+    try:
+        names = await AsyncDatabase(MockedDatabase({"foo": 1})).list_collection_names()
+    finally:
+        CURRENT.reset(token)
+    assert names == ["foo"]
+    assert profile.calls["mongo"] == 1
+
+
+def test_connection_options(mocker: MockFixture):
+    """Check that only the options that are set are passed to the client."""
+    client = mocker.patch("ceiba.mongo_interface.MongoClient")
+    connect_to_db(DatabaseConfig(DB_NAME, max_pool_size=20, socket_timeout=2.5, write_concern="majority"))
+    options = client.call_args.kwargs
+    assert options["maxPoolSize"] == 20
+    assert options["socketTimeoutMS"] == 2500
+    assert options["w"] == "majority"
+    assert "compressors" not in options and "connectTimeoutMS" not in options
+
+
+def test_read_preference(mocker: MockFixture):
+    """Check that the reader uses the requested servers and the same executor."""
+    database = mocker.MagicMock()
+    default = AsyncDatabase(database)
+    assert default.reader is default
+    mongodb = AsyncDatabase(database, read_preference="secondaryPreferred")
+    database.with_options.assert_called_once_with(read_preference=ReadPreference.SECONDARY_PREFERRED)
+    assert mongodb.reader.database is database.with_options.return_value
+    assert mongodb.reader.executor is mongodb.executor
+
+
+def test_property_storage():
+    """Check that the data is stored as a document only if requested."""
+    prop = {"_id": 0, "data": '{"gap": 1.5}'}
+    assert PropertyStorage().encode(prop) == prop
+    assert PropertyStorage(native_data=True).encode(prop)["data"] == {"gap": 1.5}
+    for data in ("not a JSON", "[1.5, 2.0]"):
+        with pytest.raises(ValueError):
+            PropertyStorage(native_data=True).encode({"_id": 0, "data": data})
@@ -2,23 +2,65 @@
 
 import itertools
 import json
+from collections import Counter
 from typing import Any, Dict
 
 import pytest
+from pymongo.errors import BulkWriteError
 from pytest_mock import MockFixture
-
-from ceiba.mongo_interface import USERS_COLLECTION
+from tartiflette import create_engine
+
+from ceiba.app import PATH_LIB
+from ceiba.indexes import IndexManager
+from ceiba.mongo_interface import USERS_COLLECTION, AsyncDatabase, PropertyStorage
+from ceiba.notifications import JobsNotifier
+from ceiba.query_resolvers import MAX_PAGE_SIZE
+from ceiba.registry import REGISTRY_COLLECTION
+from ceiba.user_authentication import (GitHubClient, TokenAuthority,
+                                       is_user_authenticated)
 from ceiba.mutation_resolvers import (
-    resolve_mutation_add_job, resolve_mutation_authentication,
-    resolve_mutation_update_job, resolve_mutation_update_job_status,
+    handle_duplication, resolve_duplication, resolve_mutation_add_job, resolve_mutation_add_jobs,
+    resolve_mutation_authentication, resolve_mutation_report_jobs,
+    resolve_mutation_reserve_jobs, resolve_mutation_update_job, resolve_mutation_update_job_status,
     resolve_mutation_update_property)
 
-from .utils_test import MockedCollection, read_jobs
+from .utils_test import MockedCollection, MockUpdateResult, github_stand_in, read_jobs
 
 # Constant to mock the call
 PARENT = None
 INFO = None
 COOKIE = '{"username": "felipeZ", "token": "Token"}'
+AUTHORITY = TokenAuthority(b"secret")
+
+
+class JobsCollection(MockedCollection):
+    """Look up the jobs by identifier, the updates return the stored job."""
+
+    def find_one(self, query=None, projection=None):
+        return next((job for job in self.data if job["_id"] == query["_id"]), None)
+
+    def find_one_and_update(self, query, update, **kwargs):
+        return self.find_one(query)
+
+
+class RegistryCollection(MockedCollection):
+    """Add up the increments of the registry counters."""
+
+    def __init__(self) -> None:
+        super().__init__(None)
+        self.counters: Counter = Counter()
+
+    def update_one(self, query, update, **kwargs):
+        self.counters.update(update["$inc"])
+        return super().update_one(query, update, **kwargs)
+
+
+def mutation_context(
+        collections: Dict[str, MockedCollection], storage: PropertyStorage = PropertyStorage()) -> Dict[str, Any]:
+    """Return the context of the mutations using a mocked database with ``collections``."""
+    database = AsyncDatabase({REGISTRY_COLLECTION: MockedCollection(None), **collections})
+    return {"mongodb": database, "tokens": AUTHORITY, "storage": storage, "notifier": JobsNotifier(),
+            "indexes": IndexManager(database)}
 
 
 def check_reply(reply: Dict[str, str]) -> None:
@@ -35,9 +77,9 @@ async def run_mutation_update_job(
         "duplication_policy": policy
     }
     # Mock database
-    ctx = {"mongodb": {
+    ctx = mutation_context({
         "jobs_awesome_data": MockedCollection(old),
-        "awesome_data": MockedCollection({'data': '{"prop": 42}'})}}
+        "awesome_data": MockedCollection({'data': '{"prop": 42}'})})
 
     reply = await resolve_mutation_update_job(PARENT, args, ctx, INFO)
     return reply
@@ -50,13 +92,14 @@ async def test_mutation_add_job(mocker: MockFixture):
 
     args = {"input": job, "cookie": COOKIE}
     # Mock database
-    ctx = {"mongodb": {
+    ctx = mutation_context({
         "jobs_awesome_data": MockedCollection(job),
-        "awesome_data": MockedCollection(None)}}
+        "awesome_data": MockedCollection(None)})
 
     mocker.patch("ceiba.mutation_resolvers.is_user_authenticated", return_value=True)
     reply = await resolve_mutation_add_job(PARENT, args, ctx, INFO)
     check_reply(reply)
+    assert "is already in collection" in reply["text"]
 
 
 @pytest.mark.asyncio
@@ -66,13 +109,215 @@ async def test_mutation_add_nonexisting_job(mocker: MockFixture):
 
     args = {"input": job, 'cookie': COOKIE}
     # Mock database
-    ctx = {"mongodb": {
+    ctx = mutation_context({
         "jobs_awesome_data": MockedCollection(None),
-        "awesome_data": MockedCollection(None)}}
+        "awesome_data": MockedCollection(None)})
 
     mocker.patch("ceiba.mutation_resolvers.is_user_authenticated", return_value=True)
     reply = await resolve_mutation_add_job(PARENT, args, ctx, INFO)
     check_reply(reply)
+    assert "Stored job" in reply["text"]
+
+
+@pytest.mark.asyncio
+async def test_mutation_add_jobs(mocker: MockFixture):
+    """Test the resolver for adding a batch of jobs."""
+    class DuplicatedCollection(MockedCollection):
+        def bulk_write(self, operations, **kwargs):
+            raise BulkWriteError({"upserted": [], "writeErrors": [
+                {"index": 0, "errmsg": "E11000 duplicate key error"}]})
+
+    jobs = read_jobs()
+    args = {"input": jobs, "cookie": COOKIE}
+    ctx = mutation_context({
+        "jobs_awesome_data": MockedCollection(None),
+        "awesome_data": MockedCollection(None)})
+
+    mocker.patch("ceiba.mutation_resolvers.is_user_authenticated", return_value=True)
+    reply = await resolve_mutation_add_jobs(PARENT, args, ctx, INFO)
+    assert reply["status"] == "DONE"
+    assert reply["created"] == 2
+    assert [item["_id"] for item in reply["results"]] == [job["_id"] for job in jobs]
+
+    # The first job fails, the second one is a duplicate
+    ctx = mutation_context({
+        "jobs_awesome_data": DuplicatedCollection(None),
+        "awesome_data": MockedCollection(None)})
+    args["input"] = [jobs[1], jobs[1]]
+    reply = await resolve_mutation_add_jobs(PARENT, args, ctx, INFO)
+    assert reply["status"] == "FAILED"
+    assert reply["duplicates"] == 1
+    assert "duplicate key" in reply["results"][0]["text"]
+
+    # The job with invalid data fails, the rest are stored
+    ctx = mutation_context({
+        "jobs_awesome_data": MockedCollection(None),
+        "awesome_data": MockedCollection(None)}, PropertyStorage(native_data=True))
+    invalid = {**jobs[0], "property": {**jobs[0]["property"], "data": "not a JSON"}}
+    args["input"] = [invalid, jobs[1]]
+    reply = await resolve_mutation_add_jobs(PARENT, args, ctx, INFO)
+    assert [item["status"] for item in reply["results"]] == ["FAILED", "DONE"]
+    assert reply["created"] == 1
+
+
+@pytest.mark.asyncio
+async def test_batch_results_in_engine(mocker: MockFixture):
+    """Check that the outcome of each job of a batch reaches the client."""
+    engine = await create_engine(
+        (PATH_LIB / "sdl").as_posix(),
+        modules=["ceiba.query_resolvers", "ceiba.mutation_resolvers", "ceiba.subscription_resolvers"])
+    jobs = [{"_id": index, "status": "AVAILABLE", "settings": "{}", "property": {
+        "_id": index, "collection_name": "awesome_data", "metadata": f"molecule-{index}"}}
+        for index in range(2)]
+    ctx = mutation_context({
+        "jobs_awesome_data": MockedCollection(None),
+        "awesome_data": MockedCollection(None)})
+
+    mocker.patch("ceiba.mutation_resolvers.is_user_authenticated", return_value=True)
+    query = """
+    mutation CreateJobs($input: [InputJob!]!) {
+      createJobs(cookie: "cookie", input: $input) { status created results { _id status duplicate } }
+    }"""
+    reply = await engine.execute(query, context=ctx, variables={"input": jobs})
+    assert "errors" not in reply
+    results = reply["data"]["createJobs"]["results"]
+    assert results == [{"_id": index, "status": "DONE", "duplicate": False} for index in range(2)]
+
+
+@pytest.mark.asyncio
+async def test_mutation_report_jobs(mocker: MockFixture):
+    """Test the resolver for reporting a batch of jobs."""
+    done, available = read_jobs()
+    # A new result, a repeated result and a job without results
+    args = {"input": [done, done, available], "cookie": COOKIE, "duplication_policy": "MERGE"}
+    old_jobs = [{"_id": done["_id"], "status": "RESERVED"}, {"_id": available["_id"], "status": "RESERVED"}]
+    old_props = [{"_id": job["property"]["_id"], "data": '{"prop": 42}'} for job in (done, available)]
+    ctx = mutation_context({
+        "jobs_awesome_data": JobsCollection(old_jobs),
+        "awesome_data": MockedCollection(old_props)})
+
+    mocker.patch("ceiba.mutation_resolvers.is_user_authenticated", return_value=True)
+    reply = await resolve_mutation_report_jobs(PARENT, args, ctx, INFO)
+    assert reply["status"] == "DONE"
+    assert reply["created"] == 1
+    assert reply["duplicates"] == 1
+    assert [item["duplicate"] for item in reply["results"]] == [False, True, False]
+
+    # Another request reported the job first, so it isn't counted again
+    ctx = mutation_context({
+        "jobs_awesome_data": JobsCollection([{"_id": done["_id"], "status": "DONE"}]),
+        "awesome_data": MockedCollection(old_props)})
+    args["input"] = [done]
+    reply = await resolve_mutation_report_jobs(PARENT, args, ctx, INFO)
+    assert reply["created"] == 0
+    assert reply["duplicates"] == 1
+    args["input"] = [done, done, available]
+
+    # Jobs that are not in the database cannot be reported
+    ctx = mutation_context({
+        "jobs_awesome_data": JobsCollection([]),
+        "awesome_data": MockedCollection(old_props)})
+    reply = await resolve_mutation_report_jobs(PARENT, args, ctx, INFO)
+    assert reply["status"] == "FAILED"
+    assert all(item["status"] == "FAILED" for item in reply["results"])
+
+
+@pytest.mark.asyncio
+async def test_mutation_report_jobs_native(mocker: MockFixture):
+    """Check that the reports of the same property are chained in a single update."""
+    class RecordingCollection(MockedCollection):
+        def bulk_write(self, operations, **kwargs):
+            self.operations = operations
+            return super().bulk_write(operations, **kwargs)
+
+    done = read_jobs()[0]
+    args = {"input": [done, done], "cookie": COOKIE, "duplication_policy": "MERGE"}
+    properties = RecordingCollection([{"_id": done["property"]["_id"], "data": {"prop": 42}}])
+    ctx = mutation_context({
+        "jobs_awesome_data": JobsCollection([{"_id": done["_id"], "status": "DONE"}]),
+        "awesome_data": properties}, PropertyStorage(native_data=True))
+
+    mocker.patch("ceiba.mutation_resolvers.is_user_authenticated", return_value=True)
+    reply = await resolve_mutation_report_jobs(PARENT, args, ctx, INFO)
+    assert reply["duplicates"] == 2
+    [operation] = properties.operations
+    stages = operation._doc
+    assert len(stages) == 2
+    assert "$mergeObjects" in stages[0]["$set"]["data"]["$cond"][1]
+
+
+@pytest.mark.asyncio
+async def test_merge_native_data():
+    """Check that the data stored as a document is merged without reading it."""
+    class WriteOnlyCollection(MockedCollection):
+        def find_one(self, query=None, projection=None):
+            raise AssertionError("The property must not be read")
+
+        def update_one(self, query, update, **kwargs):
+            self.update = update
+            return super().update_one(query, update, **kwargs)
+
+    storage = PropertyStorage(native_data=True)
+    prop_data = storage.encode({"_id": 0, "data": '{"gap": 1.5}', "metadata": "$C"})
+    collection = WriteOnlyCollection({})
+    await handle_duplication(AsyncDatabase({"props": collection})["props"], prop_data, "MERGE", storage)
+    [stage] = collection.update
+    assert stage["$set"]["metadata"] == {"$literal": "$C"}
+    assert stage["$set"]["data"]["$cond"][1]["$mergeObjects"][0] == {"$literal": {"gap": 1.5}}
+
+    # Data stored as JSON is merged by the server keeping the stored values
+    old_prop = {"data": '{"gap": 2.0, "homo": -1}'}
+    new_prop = resolve_duplication({"data": '{"gap": 1.5}'}, old_prop, "MERGE")
+    assert json.loads(new_prop["data"]) == {"gap": 2.0, "homo": -1}
+    new_prop = resolve_duplication(prop_data, {"data": {"gap": 2.0}}, "MERGE")
+    assert new_prop["data"] == {"gap": 2.0}
+
+
+@pytest.mark.asyncio
+async def test_merge_flipped_storage():
+    """Check that the data stored before switching native_data on or off is merged."""
+    class JSONCollection(MockedCollection):
+        def update_one(self, query, update, **kwargs):
+            # The stored data is JSON, so it doesn't match the mergeable data
+            self.update = update
+            return MockUpdateResult(None if "$or" in query else self.data)
+
+    storage = PropertyStorage(native_data=True)
+    prop_data = storage.encode({"_id": 0, "data": '{"gap": 1.5, "lumo": 1}', "metadata": "$C"})
+    collection = JSONCollection({"_id": 0, "data": '{"gap": 2.0, "homo": -1}'})
+    await handle_duplication(AsyncDatabase({"props": collection})["props"], prop_data, "MERGE", storage)
+    [stage] = collection.update
+    _, _, replacement = stage["$set"]["data"]["$cond"]
+    assert replacement == {"$literal": {"gap": 2.0, "homo": -1, "lumo": 1}}
+
+    # Data stored as a document is merged when native_data is turned off
+    old_prop = {"data": {"gap": 2.0, "homo": -1}}
+    new_prop = resolve_duplication({"data": '{"gap": 1.5, "lumo": 1}'}, old_prop, "MERGE")
+    assert json.loads(new_prop["data"]) == {"gap": 2.0, "homo": -1, "lumo": 1}
+
+
+@pytest.mark.asyncio
+async def test_append_data():
+    """Check that the new data is appended atomically keeping the latest results."""
+    class WriteOnlyCollection(MockedCollection):
+        def update_one(self, query, update, **kwargs):
+            self.update = update
+            return super().update_one(query, update, **kwargs)
+
+    storage = PropertyStorage(max_history=3)
+    prop_data = storage.encode({"_id": 0, "data": '{"gap": 1.5}', "metadata": "$C"})
+    collection = WriteOnlyCollection({})
+    await handle_duplication(AsyncDatabase({"props": collection})["props"], prop_data, "APPEND", storage)
+    [stage] = collection.update
+    assert "data" not in stage["$set"]
+    history, size = stage["$set"]["data_history"]["$slice"]
+    assert size == -3
+    assert history["$concatArrays"][1] == [{"$literal": '{"gap": 1.5}'}]
+
+    old_prop = {"data": '{"gap": 2.0}', "data_history": ['{"gap": 1.8}']}
+    new_prop = resolve_duplication(prop_data, old_prop, "APPEND")
+    assert "data" not in new_prop
+    assert new_prop["data_history"] == ['{"gap": 1.8}', '{"gap": 1.5}']
 
 
 @pytest.mark.asyncio
@@ -97,6 +342,35 @@ async def test_mutation_update_job(mocker: MockFixture):
         check_reply(reply)
 
 
+@pytest.mark.asyncio
+async def test_registry_deleted_property(mocker: MockFixture):
+    """Check that the registry counts the writes done when the property has been deleted."""
+    mocker.patch("ceiba.mutation_resolvers.is_user_authenticated", return_value=True)
+    done = read_jobs()[0]
+    old_job = {"_id": done["_id"], "status": "RESERVED"}
+
+    # The job is moved to DONE but the property is not updated
+    registry = RegistryCollection()
+    ctx = mutation_context({
+        REGISTRY_COLLECTION: registry,
+        "jobs_awesome_data": MockedCollection(old_job),
+        "awesome_data": MockedCollection(None)})
+    args = {"input": done, "cookie": COOKIE, "duplication_policy": "KEEP"}
+    with pytest.raises(RuntimeError):
+        await resolve_mutation_update_job(PARENT, args, ctx, INFO)
+    assert registry.counters == Counter({"jobs.RESERVED": -1, "jobs.DONE": 1})
+
+    # The property deleted after reading it is stored again
+    registry = RegistryCollection()
+    ctx = mutation_context({
+        REGISTRY_COLLECTION: registry,
+        "jobs_awesome_data": JobsCollection([old_job]),
+        "awesome_data": MockedCollection([{"_id": done["property"]["_id"], "data": '{"prop": 42}'}])})
+    args = {"input": [done], "cookie": COOKIE, "duplication_policy": "KEEP"}
+    await resolve_mutation_report_jobs(PARENT, args, ctx, INFO)
+    assert registry.counters == Counter({"size": 1, "jobs.RESERVED": -1, "jobs.DONE": 1})
+
+
 @pytest.mark.asyncio
 async def test_mutation_update_job_status(mocker: MockFixture):
     """Check the job status updater."""
@@ -107,14 +381,44 @@ async def test_mutation_update_job_status(mocker: MockFixture):
         'cookie': COOKIE
     }
     # Mock database
-    ctx = {"mongodb": {
-        "jobs_awesome_data": MockedCollection(read_jobs())}}
+    ctx = mutation_context({"jobs_awesome_data": MockedCollection(read_jobs()[1])})
 
     mocker.patch("ceiba.mutation_resolvers.is_user_authenticated", return_value=True)
     reply = await resolve_mutation_update_job_status(PARENT, args, ctx, INFO)
     assert reply['status'] == 'DONE'
 
 
+@pytest.mark.asyncio
+async def test_mutation_reserve_jobs(mocker: MockFixture):
+    """Check that the available jobs are reserved one by one."""
+    class MockedQueue(MockedCollection):
+        def find_one_and_update(self, query, update, **kwargs):
+            return self.data.pop(0) if self.data else None
+
+    args = {"collection_name": "awesome_data", "max_jobs": 5, "worker": "felipeZ", 'cookie': COOKIE}
+    ctx = mutation_context({"jobs_awesome_data": MockedQueue(read_jobs())})
+
+    mocker.patch("ceiba.mutation_resolvers.is_user_authenticated", return_value=True)
+    reply = await resolve_mutation_reserve_jobs(PARENT, args, ctx, INFO)
+    assert reply['status'] == 'DONE'
+    assert len(reply['jobs']) == 2
+
+
+@pytest.mark.asyncio
+async def test_mutation_reserve_jobs_limit(mocker: MockFixture):
+    """Check that a request reserves at most a page of jobs."""
+    class EndlessQueue(MockedCollection):
+        def find_one_and_update(self, query, update, **kwargs):
+            return {"_id": 1, "status": "RESERVED"}
+
+    args = {"collection_name": "awesome_data", "max_jobs": 10 ** 6, "worker": "felipeZ", 'cookie': COOKIE}
+    ctx = mutation_context({"jobs_awesome_data": EndlessQueue(None)})
+
+    mocker.patch("ceiba.mutation_resolvers.is_user_authenticated", return_value=True)
+    reply = await resolve_mutation_reserve_jobs(PARENT, args, ctx, INFO)
+    assert len(reply['jobs']) == MAX_PAGE_SIZE
+
+
 @pytest.mark.asyncio
 async def test_mutation_update_property(mocker: MockFixture):
     """Check the job status updater."""
@@ -124,23 +428,35 @@ async def test_mutation_update_property(mocker: MockFixture):
         "data": '{"pi": "3.14159265358979323846"}'},
         'cookie': COOKIE}
     # Mock database
-    ctx = {"mongodb": {
-        "awesome_data": MockedCollection(None)}}
+    ctx = mutation_context({"awesome_data": MockedCollection(None)})
 
     mocker.patch("ceiba.mutation_resolvers.is_user_authenticated", return_value=True)
     reply = await resolve_mutation_update_property(PARENT, args, ctx, INFO)
     assert reply['status'] == 'DONE'
 
+    # The data stored as a document must be a JSON object
+    ctx["storage"] = PropertyStorage(native_data=True)
+    args["input"]["data"] = "[3.14]"
+    reply = await resolve_mutation_update_property(PARENT, args, ctx, INFO)
+    assert reply['status'] == 'FAILED'
+    assert "not a JSON object" in reply['text']
+
 
 @pytest.mark.asyncio
 async def test_mutation_authentication_invalid_token():
     """Check the authentication resolver for an invalid_token."""
     args = {"token": "InvalidToken"}
-    # Mock database
-    ctx = {"mongodb": {
-        USERS_COLLECTION: MockedCollection(None)}}
-
-    reply = await resolve_mutation_authentication(PARENT, args, ctx, INFO)
+    async with github_stand_in() as (url, _):
+        # Mock database
+        ctx = {"mongodb": AsyncDatabase({
+            USERS_COLLECTION: MockedCollection(None)}),
+            "tokens": AUTHORITY, "github": GitHubClient(url)}
+
+        await ctx["github"].start()
+        try:
+            reply = await resolve_mutation_authentication(PARENT, args, ctx, INFO)
+        finally:
+            await ctx["github"].close()
     assert reply['status'] == "FAILED"
     assert "Invalid Token" in reply['text']
 
@@ -150,8 +466,9 @@ async def test_mutation_authentication_invalid_user(mocker: MockFixture):
     """Check the authentication resolver for an invalid_token."""
     args = {"token": "VeryLongToken"}
     # Mock database
-    ctx = {"mongodb": {
-        USERS_COLLECTION: MockedCollection(None)}}
+    ctx = {"mongodb": AsyncDatabase({
+        USERS_COLLECTION: MockedCollection(None)}),
+        "tokens": AUTHORITY, "github": None}
 
     mocker.patch("ceiba.mutation_resolvers.authenticate_username", return_value="someone")
     reply = await resolve_mutation_authentication(PARENT, args, ctx, INFO)
@@ -164,14 +481,21 @@ async def test_mutation_authentication_valid_user(mocker: MockFixture):
     """Check the authentication resolver for an invalid_token."""
     args = {"token": "RosalindToken"}
     # Mock database
-    ctx = {"mongodb": {
-        USERS_COLLECTION: MockedCollection({"username": "RosalindFranklin"})}}
+    ctx = {"mongodb": AsyncDatabase({
+        USERS_COLLECTION: MockedCollection({"username": "RosalindFranklin"})}),
+        "tokens": TokenAuthority(b"secret"), "github": None}
 
     mocker.patch("ceiba.mutation_resolvers.authenticate_username", return_value="RosalindFranklin")
     reply = await resolve_mutation_authentication(PARENT, args, ctx, INFO)
     cookie = json.loads(reply['text'])
     assert reply['status'] == "DONE"
     assert cookie['username'] == "RosalindFranklin"
+    assert is_user_authenticated(reply['text'], ctx["tokens"])
+
+    # Revoked users cannot authenticate
+    ctx["tokens"].denied.add("RosalindFranklin")
+    reply = await resolve_mutation_authentication(PARENT, args, ctx, INFO)
+    assert reply['status'] == "FAILED"
 
 
 async def check_non_authenticated_user(fun, mocker: MockFixture) -> None:
@@ -180,7 +504,7 @@ async def check_non_authenticated_user(fun, mocker: MockFixture) -> None:
         'cookie': COOKIE,
     }
     # Mock database
-    ctx = {"mongodb": None}
+    ctx = {"mongodb": None, "tokens": None}
 
     mocker.patch("ceiba.mutation_resolvers.is_user_authenticated",
                  return_value=False)
@@ -194,6 +518,8 @@ async def check_non_authenticated_user(fun, mocker: MockFixture) -> None:
 async def test_nonauthenticated_user(mocker: MockFixture):
     """Check that an error message is return if the user is not authenticated."""
     functions = {resolve_mutation_update_job, resolve_mutation_update_job_status,
-                 resolve_mutation_update_property, resolve_mutation_add_job}
+                 resolve_mutation_update_property, resolve_mutation_add_job,
+                 resolve_mutation_add_jobs, resolve_mutation_reserve_jobs,
+                 resolve_mutation_report_jobs}
     for fun in functions:
         await check_non_authenticated_user(fun, mocker)
@@ -0,0 +1,105 @@
+"""Test the notifications of the available jobs."""
+
+import asyncio
+import select
+from collections import Counter
+from multiprocessing import Pipe
+
+import pytest
+
+from ceiba.mongo_interface import AsyncDatabase
+from ceiba.notifications import JobsNotifier
+from ceiba.registry import REGISTRY_COLLECTION
+from ceiba.subscription_resolvers import subscribe_jobs_available
+
+from .utils_test import MockedCollection
+
+
+@pytest.mark.asyncio
+async def test_jobs_notifier():
+    """Check that the jobs published while the subscriber is busy are received together."""
+    notifier = JobsNotifier()
+
+    async def available() -> int:
+        # Jobs published while reading the available jobs are not missed
+        notifier.publish("awesome_data", 1)
+        return 2
+
+    notifications = notifier.subscribe("awesome_data", available)
+    assert await notifications.__anext__() == 3
+
+    notifier.publish("awesome_data", 5)
+    notifier.publish("other_data", 7)
+    notifier.publish("awesome_data", 1)
+    assert await notifications.__anext__() == 6
+
+    waiting = asyncio.ensure_future(notifications.__anext__())
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+    notifier.publish("awesome_data", 2)
+    assert await waiting == 2
+
+    await notifications.aclose()
+    assert not notifier.waiters
+
+
+@pytest.mark.asyncio
+async def test_relayed_notifier():
+    """Check that the jobs are published to and received from the other workers."""
+    relay, supervisor = Pipe()
+    notifier = JobsNotifier(relay)
+    notifier.start()
+    notifications = notifier.subscribe("awesome_data")
+
+    waiting = asyncio.ensure_future(notifications.__anext__())
+    await asyncio.sleep(0.01)
+    notifier.publish("awesome_data", 2)
+    assert supervisor.recv() == ("awesome_data", 2)
+    assert await asyncio.wait_for(waiting, 1) == 2
+
+    waiting = asyncio.ensure_future(notifications.__anext__())
+    supervisor.send(("awesome_data", 3))
+    assert await asyncio.wait_for(waiting, 1) == 3
+
+    supervisor.close()
+    await asyncio.sleep(0.01)
+    notifier.stop()
+    await notifications.aclose()
+
+
+@pytest.mark.asyncio
+async def test_relay_full_pipe():
+    """Check that publishing doesn't block when the pipe to the supervisor is full."""
+    relay, supervisor = Pipe()
+    notifier = JobsNotifier(relay)
+    filled = 0
+    while select.select([], [relay], [], 0)[1]:
+        relay.send(("filler", 1))
+        filled += 1
+    notifier.publish("awesome_data", 2)
+    notifier.publish("awesome_data", 3)
+    assert notifier.unsent == Counter({"awesome_data": 5})
+
+    # The jobs are sent once the supervisor reads the pipe
+    for _ in range(filled):
+        supervisor.recv()
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if supervisor.poll():
+            break
+    assert supervisor.recv() == ("awesome_data", 5)
+    assert not notifier.writing
+
+
+@pytest.mark.asyncio
+async def test_subscription_jobs_available():
+    """Check that the subscribers start with the available jobs of the registry."""
+    registry = MockedCollection({"_id": "awesome_data", "jobs": {"AVAILABLE": 4, "DONE": 1}})
+    ctx = {"mongodb": AsyncDatabase({REGISTRY_COLLECTION: registry}), "notifier": JobsNotifier()}
+    notifications = subscribe_jobs_available(None, {"collection_name": "awesome_data"}, ctx, None)
+    first = await notifications.__anext__()
+    assert first == {"jobsAvailable": {"collection_name": "awesome_data", "count": 4}}
+
+    ctx["notifier"].publish("awesome_data", 1)
+    assert (await notifications.__anext__())["jobsAvailable"]["count"] == 1
+    await notifications.aclose()
@@ -0,0 +1,68 @@
+"""Test the automatic persisted queries."""
+
+import hashlib
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from ceiba.persisted_queries import PersistedQueries, persisted_queries_middleware
+
+QUERY = "query { collections { name } }"
+QUERY_HASH = hashlib.sha256(QUERY.encode()).hexdigest()
+
+
+async def echo(request: web.Request) -> web.Response:
+    """Reply with the request body."""
+    return web.json_response(await request.json())
+
+
+def test_persisted_queries_store():
+    """Check that the least recently used queries are discarded."""
+    store = PersistedQueries(maxsize=2)
+    queries = [f"query {{ collections{index} }}" for index in range(3)]
+    hashes = [hashlib.sha256(query.encode()).hexdigest() for query in queries]
+    store.register(hashes[0], queries[0])
+    store.register(hashes[1], queries[1])
+    assert store.get(hashes[0]) == queries[0]
+    store.register(hashes[2], queries[2])
+    assert store.get(hashes[1]) is None
+    assert store.get(hashes[0]) == queries[0]
+
+    with pytest.raises(ValueError):
+        store.register(hashes[0], queries[1])
+
+
+@pytest.mark.asyncio
+async def test_persisted_queries():
+    """Check that the queries are registered and then retrieved by their hash."""
+    app = web.Application(middlewares=[persisted_queries_middleware(PersistedQueries())])
+    app.router.add_post("/graphql", echo)
+    extensions = {"persistedQuery": {"version": 1, "sha256Hash": QUERY_HASH}}
+    request = {"extensions": extensions, "variables": {"cookie": "{}"}}
+    async with TestClient(TestServer(app)) as client:
+        response = await client.post("/graphql", json=request)
+        [error] = (await response.json())["errors"]
+        assert error["extensions"]["code"] == "PERSISTED_QUERY_NOT_FOUND"
+
+        response = await client.post("/graphql", json={"query": "query { jobs }", **request})
+        assert "errors" in await response.json()
+
+        response = await client.post("/graphql", json={"query": QUERY, **request})
+        assert (await response.json())["query"] == QUERY
+
+        response = await client.post("/graphql", json=request)
+        assert await response.json() == {"query": QUERY, **request}
+
+        response = await client.post("/graphql", json={"query": None, **request})
+        assert await response.json() == {"query": QUERY, **request}
+
+        response = await client.post("/graphql", json={"query": "query { jobs }"})
+        assert await response.json() == {"query": "query { jobs }"}
+
+        # The query and its hash must be strings
+        for invalid in ({"query": 42, **request}, {"query": {"text": QUERY}, **request},
+                        {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": [QUERY_HASH]}}}):
+            response = await client.post("/graphql", json=invalid)
+            assert response.status == 200
+            assert "must be strings" in (await response.json())["errors"][0]["message"]
@@ -0,0 +1,61 @@
+"""Test the profiling of the requests."""
+
+import asyncio
+import json
+import logging
+from pathlib import Path
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from ceiba.profiling import (PROFILE_HEADER, ProfilingSettings, profiled, profiled_response,
+                             profiling_middleware, section)
+
+
+@profiled("parse")
+def parse(query: str) -> str:
+    return query.strip()
+
+
+async def handler(request: web.Request) -> web.Response:
+    """Stand-in for the GraphQL handler."""
+    parse(" query ")
+    for _ in range(2):
+        with section("mongo"):
+            await asyncio.sleep(0.01)
+    return profiled_response(request, {"data": {"answer": 42}}, {})
+
+
+def create_client(settings: ProfilingSettings) -> TestClient:
+    app = web.Application(middlewares=[profiling_middleware(settings)])
+    app.router.add_post("/graphql", handler)
+    return TestClient(TestServer(app))
+
+
+@pytest.mark.asyncio
+async def test_profile_extensions():
+    """Check that the timing breakdown is added only if it is requested."""
+    async with create_client(ProfilingSettings()) as client:
+        reply = await (await client.post("/graphql")).json()
+        assert "extensions" not in reply
+
+        reply = await (await client.post("/graphql", headers={PROFILE_HEADER: "1"})).json()
+    profile = reply["extensions"]["profile"]
+    assert reply["data"] == {"answer": 42}
+    assert profile["sections"]["mongo"]["calls"] == 2
+    assert profile["sections"]["parse"]["calls"] == 1
+    assert profile["duration"] >= profile["sections"]["mongo"]["seconds"]
+
+
+@pytest.mark.asyncio
+async def test_slow_operations(tmp_path: Path, caplog: pytest.LogCaptureFixture):
+    """Check that the slow requests are logged and the sampled requests profiled."""
+    settings = ProfilingSettings(slow_threshold=0.0, directory=tmp_path, sample_rate=1.0)
+    with caplog.at_level(logging.WARNING, logger="ceiba.slow_operations"):
+        async with create_client(settings) as client:
+            await client.post("/graphql")
+    [entry] = [json.loads(record.message) for record in caplog.records]
+    assert entry["status"] == 200
+    assert entry["sections"]["mongo"]["calls"] == 2
+    assert (tmp_path / f"{entry['request_id']}.prof").exists()
@@ -1,13 +1,27 @@
 """Test the query interface."""
 
+from types import SimpleNamespace
+from typing import Any
+
 import pytest
+from tartiflette.language.ast import (FieldNode, FragmentDefinitionNode,
+                                      FragmentSpreadNode, NamedTypeNode,
+                                      NameNode, SelectionSetNode)
 
-from ceiba.query_resolvers import (resolver_query_collections,
+from ceiba.mongo_interface import AsyncDatabase
+from ceiba.registry import REGISTRY_COLLECTION
+from ceiba.query_resolvers import (MAX_PAGE_SIZE, page_query, page_size,
+                                   requested_projection,
+                                   resolver_property_data,
+                                   resolver_property_data_history,
+                                   resolver_query_collections,
                                    resolver_query_jobs,
-                                   resolver_query_properties)
+                                   resolver_query_properties,
+                                   resolver_query_properties_by_ids,
+                                   resolver_query_properties_by_metadata,
+                                   resolver_query_property)
 
-from .utils_test import (MockedCollection, MockedDatabase,
-                         read_properperties_and_jobs)
+from .utils_test import MockedCollection, read_properperties_and_jobs
 
 PARENT = None
 INFO = None
@@ -19,7 +33,7 @@ MOCKED_DATA = read_properperties_and_jobs()
 async def test_query_properties():
     """Test the properties query resolver."""
     mocked_properties = MOCKED_DATA["PROPERTIES"].copy()
-    ctx = {"mongodb": {"awesome_data": MockedCollection(mocked_properties)}}
+    ctx = {"mongodb": AsyncDatabase({"awesome_data": MockedCollection(mocked_properties)})}
     args = {"collection_name": "awesome_data"}
     results = await resolver_query_properties(PARENT, args, ctx, INFO)
     print("received results: ", results)
@@ -27,23 +41,148 @@ async def test_query_properties():
     assert all((first['metadata']['smile'] == "O=O", first['_id'] == 0))
 
 
+class RecordingCollection(MockedCollection):
+    """Keep the arguments used to query the collection."""
+
+    def find(self, query=None, projection=None, **kwargs):
+        self.query = query
+        self.kwargs = kwargs
+        return self.data
+
+    def find_one(self, query=None, projection=None):
+        self.query = query
+        return self.data[0]
+
+
+@pytest.mark.asyncio
+async def test_query_properties_page():
+    """Check that only the requested page is fetched from the database."""
+    collection = RecordingCollection(MOCKED_DATA["PROPERTIES"].copy())
+    ctx = {"mongodb": AsyncDatabase({"awesome_data": collection})}
+    args = {"collection_name": "awesome_data", "first": 2, "after": 0}
+    await resolver_query_properties(PARENT, args, ctx, INFO)
+    assert collection.query == {"_id": {"$gt": 0}}
+    assert collection.kwargs["limit"] == 2
+    assert page_query(None) == {}
+
+
+def test_page_size():
+    """Check that a request never fetches more than a page."""
+    assert page_size(10) == 10
+    assert page_size(10 ** 6) == MAX_PAGE_SIZE
+    assert page_size(None) == MAX_PAGE_SIZE
+    for requested in (0, -1):
+        assert page_size(requested) == 0
+
+
+@pytest.mark.asyncio
+async def test_query_property():
+    """Check that a single property is looked up by its metadata."""
+    collection = RecordingCollection(MOCKED_DATA["PROPERTIES"].copy())
+    ctx = {"mongodb": AsyncDatabase({"awesome_data": collection})}
+    args = {"collection_name": "awesome_data", "metadata": "O=O"}
+    prop = await resolver_query_property(PARENT, args, ctx, INFO)
+    assert prop["_id"] == 0
+    assert collection.query == {"metadata": "O=O"}
+
+
+@pytest.mark.asyncio
+async def test_query_properties_batch():
+    """Check that the batched lookups fetch all the properties in one query."""
+    collection = RecordingCollection(MOCKED_DATA["PROPERTIES"].copy())
+    ctx = {"mongodb": AsyncDatabase({"awesome_data": collection})}
+    args = {"collection_name": "awesome_data", "metadata": ["O=O", "C=C"]}
+    await resolver_query_properties_by_metadata(PARENT, args, ctx, INFO)
+    assert collection.query == {"metadata": {"$in": ["O=O", "C=C"]}}
+
+    args = {"collection_name": "awesome_data", "ids": [0, 343]}
+    props = await resolver_query_properties_by_ids(PARENT, args, ctx, INFO)
+    assert collection.query == {"_id": {"$in": [0, 343]}}
+    assert len(props) == len(MOCKED_DATA["PROPERTIES"])
+
+
+@pytest.mark.asyncio
+async def test_property_data():
+    """Check that the data is always returned as JSON."""
+    for data in ('{"gap": 1.5}', {"gap": 1.5}):
+        assert await resolver_property_data({"data": data}, {}, {}, INFO) == '{"gap": 1.5}'
+    assert await resolver_property_data({}, {}, {}, INFO) is None
+    history = ['{"gap": 1.5}', {"gap": 2.0}]
+    assert await resolver_property_data_history({"data_history": history}, {}, {}, INFO) == [
+        '{"gap": 1.5}', '{"gap": 2.0}']
+    assert await resolver_property_data_history({}, {}, {}, INFO) is None
+
+
 @pytest.mark.asyncio
 async def test_query_jobs():
     """Test the job query resolver."""
     args = {"status": "DONE", "max_jobs": 10, "collection_name": "awesome_data", "job_size": None}
     mocked_jobs = MOCKED_DATA["JOBS"].copy()
-    ctx = {"mongodb": {"jobs_awesome_data": MockedCollection(mocked_jobs)}}
+    ctx = {"mongodb": AsyncDatabase({"jobs_awesome_data": MockedCollection(mocked_jobs)})}
 
     jobs = await resolver_query_jobs(PARENT, args, ctx, INFO)
     first = jobs[0]
     assert first["_id"] == 33444
 
 
+@pytest.mark.asyncio
+async def test_query_jobs_sorted():
+    """Check that the limit and sorting are applied by the database."""
+    args = {"status": "AVAILABLE", "max_jobs": 3, "collection_name": "awesome_data",
+            "order_by": "SCHEDULE_TIME"}
+    collection = RecordingCollection(MOCKED_DATA["JOBS"].copy())
+    ctx = {"mongodb": AsyncDatabase({"jobs_awesome_data": collection})}
+
+    await resolver_query_jobs(PARENT, args, ctx, INFO)
+    assert collection.query == {"status": "AVAILABLE"}
+    assert collection.kwargs["limit"] == 3
+    assert collection.kwargs["sort"][0] == ("schedule_time", 1)
+
+    with pytest.raises(ValueError):
+        await resolver_query_jobs(PARENT, {**args, "after": 42}, ctx, INFO)
+
+
+@pytest.mark.asyncio
+async def test_query_jobs_empty_page():
+    """Check that asking for no jobs doesn't query the database."""
+    args = {"status": "AVAILABLE", "max_jobs": 0, "collection_name": "awesome_data"}
+    collection = RecordingCollection(MOCKED_DATA["JOBS"].copy())
+    ctx = {"mongodb": AsyncDatabase({"jobs_awesome_data": collection})}
+
+    assert await resolver_query_jobs(PARENT, args, ctx, INFO) == []
+    assert not hasattr(collection, "query")
+
+
 @pytest.mark.asyncio
 async def test_query_collections():
-    """Test the job query resolver."""
-    data = MockedDatabase({"collection_foo": 3, "collection_bar": 2})
-    ctx = {"mongodb": data}
+    """Test the collections query resolver."""
+    entries = [{"_id": "collection_bar", "size": 2, "jobs": {"AVAILABLE": 2}},
+               {"_id": "collection_foo", "size": 3}]
+    ctx = {"mongodb": AsyncDatabase({REGISTRY_COLLECTION: MockedCollection(entries)})}
     cols = await resolver_query_collections(PARENT, None, ctx, INFO)
     assert len(cols) == 2
-    assert cols[0]['name'] == "collection_foo"
+    assert cols[0] == {"name": "collection_bar", "size": 2,
+                       "jobs": [{"status": "AVAILABLE", "count": 2}]}
+    assert cols[1]["jobs"] == []
+
+
+def field(name: str, *selections: Any) -> FieldNode:
+    """Create the AST node of a field with the given ``selections``."""
+    selection_set = SelectionSetNode(list(selections)) if selections else None
+    return FieldNode(NameNode(name), selection_set=selection_set)
+
+
+def test_requested_projection():
+    """Check that the selection set is translated into a projection."""
+    # jobs { status __typename property { metadata ...Identifier } }
+    identifier = FragmentDefinitionNode(
+        NameNode("Identifier"), NamedTypeNode(NameNode("Property")),
+        SelectionSetNode([field("_id")]))
+    spread = FragmentSpreadNode(NameNode("Identifier"))
+    jobs = field("jobs", field("status"), field("__typename"),
+                 field("property", field("metadata"), spread))
+    info = SimpleNamespace(field_nodes=[jobs], fragments={"Identifier": identifier})
+
+    projection = requested_projection(info)
+    assert projection == {"property._id": True, "property.metadata": True, "status": True}
+    assert requested_projection(None) is None
@@ -0,0 +1,84 @@
+"""Test the collections registry."""
+
+from typing import Any, Dict, List
+
+import pytest
+from pytest_mock import MockFixture
+
+from ceiba.admin import main
+from ceiba.mongo_interface import USERS_COLLECTION, AsyncDatabase
+from ceiba.registry import (REGISTRY_COLLECTION, ensure_registry,
+                            is_property_collection, read_registry,
+                            rebuild_registry, record_changes, status_change)
+
+from .test_mongo_interface import get_database
+from .utils_test import MockedCollection, read_jobs
+
+
+class RecordingCollection(MockedCollection):
+    """Remember the updates sent to the collection."""
+
+    def __init__(self, data: Any) -> None:
+        super().__init__(data)
+        self.updates: List[Dict[str, Any]] = []
+
+    def update_one(self, query, update, **kwargs):
+        self.updates.append({"query": query, **update})
+        return super().update_one(query, update, **kwargs)
+
+
+def test_property_collections():
+    """Check that only the property collections are registered."""
+    assert is_property_collection("awesome_data")
+    assert not any(is_property_collection(name) for name in (
+        "jobs_awesome_data", USERS_COLLECTION, REGISTRY_COLLECTION, "system.profile"))
+
+
+def test_status_change():
+    """Check the change in the job counters."""
+    assert status_change("AVAILABLE", "AVAILABLE") == {}
+    assert status_change("RESERVED", "DONE") == {"RESERVED": -1, "DONE": 1}
+
+
+@pytest.mark.asyncio
+async def test_record_changes():
+    """Check that the counters are atomically increased."""
+    registry = RecordingCollection([{"_id": "awesome_data", "size": 1}])
+    database = AsyncDatabase({REGISTRY_COLLECTION: registry})
+    await record_changes(database, "awesome_data", size=1, jobs={"AVAILABLE": 1, "DONE": 0})
+    # Nothing changes
+    await record_changes(database, "awesome_data", jobs={})
+    assert registry.updates == [
+        {"query": {"_id": "awesome_data"}, "$inc": {"size": 1, "jobs.AVAILABLE": 1}}]
+    assert await read_registry(database) == registry.data
+
+
+def test_admin_command(mocker: MockFixture):
+    """Check that the admin command rebuilds the registry."""
+    mocker.patch("ceiba.admin.connect_to_db", return_value="mock")
+    rebuild = mocker.patch("ceiba.admin.rebuild_registry", return_value=None)
+    main(["rebuild-registry", "-m", "localhost"])
+    rebuild.assert_called_once_with("mock")
+
+    # The registry is rebuilt after removing the duplicated jobs
+    deduplicate = mocker.patch("ceiba.admin.deduplicate_jobs", return_value=3)
+    main(["deduplicate-jobs"])
+    deduplicate.assert_called_once_with("mock")
+    assert rebuild.call_count == 2
+
+
+def test_rebuild_registry():
+    """Check that the registry is rebuilt from the collections."""
+    mongodb = get_database()
+    jobs = read_jobs()
+    mongodb["awesome_data"].insert_many([job["property"] for job in jobs])
+    mongodb["jobs_awesome_data"].insert_many(jobs)
+    mongodb[REGISTRY_COLLECTION].insert_one({"_id": "dropped_data", "size": 42})
+    try:
+        rebuild_registry(mongodb)
+        ensure_registry(mongodb)
+        entries = list(mongodb[REGISTRY_COLLECTION].find())
+        assert entries == [{"_id": "awesome_data", "size": 2, "jobs": {"DONE": 1, "AVAILABLE": 1}}]
+    finally:
+        for name in ("awesome_data", "jobs_awesome_data", REGISTRY_COLLECTION):
+            mongodb.drop_collection(name)
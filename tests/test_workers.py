@@ -0,0 +1,121 @@
+"""Test the supervision of the server processes."""
+
+import os
+import select
+import signal
+import socket
+import threading
+import time
+import urllib.request
+from collections import Counter
+from multiprocessing import Pipe
+from multiprocessing.connection import Connection, wait
+
+from aiohttp import web
+from pytest_mock import MockFixture
+
+from ceiba import workers
+from ceiba.workers import Supervisor, bind_socket
+
+
+def serve_pid(sock: socket.socket, relay: Connection) -> None:
+    """Reply with the process identifier of the worker."""
+    async def pid(request: web.Request) -> web.Response:
+        return web.Response(text=str(os.getpid()))
+
+    app = web.Application()
+    app.router.add_get("/", pid)
+    web.run_app(app, sock=sock, print=None)
+
+
+def exit_soon(sock: socket.socket, relay: Connection) -> None:
+    """Exit shortly after starting."""
+    time.sleep(0.2)
+
+
+def fetch_pid(port: int, timeout: float = 10) -> int:
+    """Return the process that replied, retrying while the workers start."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as reply:
+                return int(reply.read())
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def test_supervisor():
+    """Check that the workers share the port and are restarted if they die."""
+    sock = bind_socket("127.0.0.1", 0)
+    port = sock.getsockname()[1]
+    supervisor = Supervisor(serve_pid, sock, workers=2, restart_delay=0)
+    supervisor.start()
+    try:
+        pids = {process.pid for process in supervisor.processes}
+        assert fetch_pid(port) in pids
+
+        dead = supervisor.processes[0]
+        os.kill(dead.pid, signal.SIGKILL)
+        dead.join()
+        supervisor.restart_exited()
+        assert supervisor.processes[0].pid != dead.pid
+        assert all(process.is_alive() for process in supervisor.processes)
+        assert fetch_pid(port) in {process.pid for process in supervisor.processes}
+    finally:
+        supervisor.shutdown()
+        sock.close()
+    assert all(process.exitcode is not None for process in supervisor.processes)
+
+
+def test_relay():
+    """Check that the messages of a worker are relayed to the other workers."""
+    supervisor = Supervisor(serve_pid, socket.socket(), workers=3)
+    pipes = [Pipe() for _ in range(3)]
+    supervisor.relays = [relay for relay, _ in pipes]
+    supervisor.unsent = [Counter() for _ in pipes]
+    workers = [worker for _, worker in pipes]
+    workers[0].send(("awesome_data", 2))
+    supervisor.relay(wait(supervisor.relays, timeout=1))
+    assert workers[1].recv() == ("awesome_data", 2)
+    assert workers[2].recv() == ("awesome_data", 2)
+    assert not workers[0].poll()
+
+    # The pipes of the workers that exited are skipped
+    workers[2].close()
+    workers[1].send(("other_data", 1))
+    supervisor.relay(wait(supervisor.relays, timeout=1))
+    assert workers[0].recv() == ("other_data", 1)
+    assert not any(supervisor.unsent)
+
+
+def test_relay_stalled_worker():
+    """Check that the jobs for a worker that doesn't read its pipe are added up without blocking."""
+    supervisor = Supervisor(serve_pid, socket.socket(), workers=2)
+    pipes = [Pipe() for _ in range(2)]
+    supervisor.relays = [relay for relay, _ in pipes]
+    supervisor.unsent = [Counter() for _ in pipes]
+    publisher, stalled = [worker for _, worker in pipes]
+    # Fill the pipe of the stalled worker
+    while select.select([], [supervisor.relays[1]], [], 0)[1]:
+        supervisor.relays[1].send(("filler", 1))
+
+    for _ in range(100):
+        publisher.send(("awesome_data", 1))
+        supervisor.relay(wait(supervisor.relays, timeout=1))
+    assert supervisor.unsent[1] == Counter({"awesome_data": 100})
+
+
+def test_pending_restart(mocker: MockFixture):
+    """Check that the master doesn't spin while an exited worker waits to be restarted."""
+    supervisor = Supervisor(exit_soon, socket.socket(), workers=1, restart_delay=1.0)
+    waits = mocker.spy(workers, "wait")
+    timer = threading.Timer(1.0, supervisor.stop)
+    timer.start()
+    try:
+        supervisor.run()
+    finally:
+        timer.cancel()
+    assert supervisor.restarts
+    assert waits.call_count < 100
@@ -1,12 +1,16 @@
 """Functions use for testing."""
 
 import json
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, AsyncIterator, Dict, List, Tuple
 
 import pkg_resources as pkg
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 
-__all__ = ["PATH_CEIBA", "PATH_TEST", "read_jobs", "read_properperties_and_jobs"]
+__all__ = ["PATH_CEIBA", "PATH_TEST", "VALID_GITHUB_TOKEN", "github_stand_in", "read_jobs",
+           "read_properperties_and_jobs"]
 
 # Environment data
 PATH_CEIBA = Path(pkg.resource_filename('ceiba', ''))
@@ -14,6 +18,9 @@ ROOT = PATH_CEIBA.parent
 
 PATH_TEST = ROOT / "tests" / "files"
 
+# Token accepted by the GitHub stand-in
+VALID_GITHUB_TOKEN = "RosalindToken"
+
 
 def read_properperties_and_jobs() -> Dict[str, Any]:
     """Read the mocked data."""
@@ -36,6 +43,31 @@ def read_jobs() -> List[Dict[str, Any]]:
     return new_jobs
 
 
+@asynccontextmanager
+async def github_stand_in() -> AsyncIterator[Tuple[str, List[str]]]:
+    """Serve a local replacement of GitHub's GraphQL API.
+
+    Yield the URL of the API and the list of tokens that it has received.
+    """
+    received: List[str] = []
+
+    async def viewer(request: web.Request) -> web.Response:
+        token = request.headers["Authorization"].split()[-1]
+        received.append(token)
+        if token != VALID_GITHUB_TOKEN:
+            return web.json_response({"message": "Bad credentials"}, status=401)
+        return web.json_response({"data": {"viewer": {"login": "RosalindFranklin"}}})
+
+    app = web.Application()
+    app.router.add_post("/graphql", viewer)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        yield str(server.make_url("/graphql")), received
+    finally:
+        await server.close()
+
+
 class MockInsertion:
     """Mock the result of inserting some data in a collection."""
 
@@ -43,24 +75,50 @@ class MockInsertion:
         return 42
 
 
+class MockUpdateResult:
+    """Mock the result of updating a document that exists if the collection has data."""
+
+    def __init__(self, data: Any) -> None:
+        self.matched_count = int(data is not None)
+        self.upserted_id = None if data is not None else 42
+
+
+class MockBulkResult:
+    """Mock the result of a bulk write where all the upserts insert a document."""
+
+    def __init__(self, operations: List[Any]) -> None:
+        self.bulk_api_result = {
+            "upserted": [{"index": i, "_id": i} for i in range(len(operations))],
+            "writeErrors": []}
+
+
 class MockedCollection:
     """Mock a Mongodb collection."""
 
     def __init__(self, data: Any) -> None:
         self.data = data
 
-    def find_one(self, query: Any = None) -> Any:
+    def find_one(self, query: Any = None, projection: Any = None) -> Any:
         return self.data
 
-    def find(self, query: Any = None) -> Any:
+    def find(self, query: Any = None, projection: Any = None, **kwargs) -> Any:
         return self.data
 
-    def update_one(self, query: Dict[str, Any], update: Dict[str, Any], **kwargs) -> None:
-        return None
+    def update_one(self, query: Dict[str, Any], update: Dict[str, Any], **kwargs) -> MockUpdateResult:
+        return MockUpdateResult(self.data)
+
+    def find_one_and_update(self, query: Dict[str, Any], update: Dict[str, Any], **kwargs) -> Any:
+        return self.data
+
+    def bulk_write(self, operations: List[Any], **kwargs) -> MockBulkResult:
+        return MockBulkResult(operations)
 
     def insert_one(self, query: Dict[str, Any]) -> MockInsertion:
         return MockInsertion()
 
+    def create_index(self, keys: List[Any], **kwargs) -> str:
+        return "_".join(f"{key}_{direction}" for key, direction in keys)
+
     def estimated_document_count(self) -> int:
         return 42
 
@@ -77,4 +135,5 @@ class MockedDatabase:
         return list(self.data.keys())
 
     def __getitem__(self, item: str) -> MockedCollection:
-        return MockedCollection({})
+        collection = self.data.get(item)
+        return collection if isinstance(collection, MockedCollection) else MockedCollection({})